@@ -1,14 +1,28 @@
 import argparse
-from flask import Flask, request, jsonify
+from flask import Blueprint, Flask, Response, current_app, g, request, jsonify
 from flask_cors import CORS
 import os
+import sys
 import csv
 import io
 from datetime import datetime
 import logging
-from typing import Any, Union
+import math
+import time
+from typing import Any, Iterable, Union, cast
+from werkzeug.http import quote_etag
 from master_csv_manager import MasterCSVManager
-from categorizer_manager import CategorizerManager
+from sqlite_manager import SQLiteTransactionManager
+from transaction_storage import FIELDNAMES, TransactionStorage
+from transaction_query import TransactionQuery, parse_date, MISSING_DATE
+from cash_flow_summary import CashFlowSummarizer, DEFAULT_EXCLUDED_CATEGORIES
+from cash_flow_rollups import CashFlowRollups
+from categorizer_manager import CategorizerManager, SpooledCategorizer, TRAIN_JOB_OPTION
+from process_coordination import (
+    FileLock, SpoolConsumer, TaskSpool, TaskStatusStore, get_last_updated)
+from task_scheduler import FINISHED_STATES, RUNNING
+from metrics import CSV_OPERATION_SECONDS, REQUEST_SECONDS, TASK_QUEUE_DEPTH, render_metrics
+from json_stream import compress_stream, get_supported_encodings, stream_json_rows
 import json
 
 
@@ -16,188 +30,454 @@ import json
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-app = Flask(__name__)
-CORS(app)
+routes = Blueprint('routes', __name__)
 
-parser = argparse.ArgumentParser(description="Server for a cash flow app")
-parser.add_argument("--data_folder", type=str, help="Directory of data folder", required=True)
 
-args = parser.parse_args()
+class ServerState:
+    """The services of one app, created by create_app."""
 
-# Configuration
-app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
-app.config['DATA_FOLDER'] = args.data_folder
-app.config['ALLOWED_EXTENSIONS'] = {'csv'}
+    def __init__(self, master_csv_manager: TransactionStorage,
+                 categorized_manager: Union[CategorizerManager, SpooledCategorizer],
+                 cash_flow_summarizer: CashFlowSummarizer,
+                 spool_consumer: Union[SpoolConsumer, None],
+                 categorizer_lock: Union[FileLock, None]):
+        self.master_csv_manager = master_csv_manager
+        self.categorized_manager = categorized_manager
+        self.cash_flow_summarizer = cash_flow_summarizer
+        self.spool_consumer = spool_consumer
+        self.categorizer_lock = categorizer_lock
 
-# Create uploads directory if it doesn't exist
-os.makedirs(app.config['DATA_FOLDER'], exist_ok=True)
 
-master_csv_manager = MasterCSVManager(
-    os.path.join(
-        os.path.abspath(os.path.dirname(__file__)),
-        app.config['DATA_FOLDER']
-    )
-)
+def get_state() -> ServerState:
+    return current_app.extensions['cash_flow']
+
+
+def get_storage() -> TransactionStorage:
+    return get_state().master_csv_manager
+
+
+def get_categorizer() -> Union[CategorizerManager, SpooledCategorizer]:
+    return get_state().categorized_manager
+
+
+@routes.before_app_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
 
-categorized_manager = CategorizerManager(master_csv_manager, os.path.join(
-    os.path.abspath(os.path.dirname(__file__)),
-    app.config['DATA_FOLDER']))
+
+@routes.after_app_request
+def record_request_latency(response):
+    # The route pattern keeps label values bounded, unmatched paths share one
+    route = request.url_rule.rule if request.url_rule is not None else '<unmatched>'
+    request_start = g.request_start
+    labels = (request.method, route, str(response.status_code))
+    # Streamed bodies are encoded and compressed after this hook returns,
+    # the request ends when the server closes the response
+    response.call_on_close(lambda: REQUEST_SECONDS.observe(
+        time.perf_counter() - request_start, *labels))
+    return response
 
 
 def allowed_file(filename):
     """Check if the file extension is allowed."""
     return '.' in filename and \
            filename.rsplit('.', 1)[1].lower(
-           ) in app.config['ALLOWED_EXTENSIONS']
-
+           ) in current_app.config['ALLOWED_EXTENSIONS']
+
+
+class CountingReader(io.RawIOBase):
+    """Binary stream wrapper counting the bytes read from the request body."""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.bytes_read = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = self.stream.read(len(buffer))
+        self.bytes_read += len(data)
+        buffer[:len(data)] = data
+        return len(data)
+
+
+def ingest_csv_stream(binary_stream, chunk_size: int):
+    """Parse a CSV stream in chunks, adding each chunk to the master store.
+
+    Only one chunk of parsed rows is held in memory at a time. Added rows
+    are queued for categorization as soon as their chunk is stored.
+    """
+    counting_reader = CountingReader(binary_stream)
+    text_stream = io.TextIOWrapper(io.BufferedReader(counting_reader),
+                                   encoding='utf-8-sig', newline='')
+    reader = csv.DictReader(text_stream)
+
+    preview: list[dict[Union[str, Any], Union[str, Any]]] = []
+    row_count = 0
+    added_rows = 0
+    duplicate_rows = 0
+    total_rows = 0
+    chunk: list[dict[Union[str, Any], Union[str, Any]]] = []
+    error = None
+    parse_start = time.perf_counter()
+
+    task_ids: list[str] = []
+
+    def store_chunk():
+        nonlocal added_rows, duplicate_rows, total_rows, parse_start
+        CSV_OPERATION_SECONDS.observe(time.perf_counter() - parse_start, 'parse')
+        master_result = get_storage().add_rows_to_master_csv(
+            chunk, defer_write=True)
+        if master_result['added_rows']:
+            scheduled_task = get_categorizer().add_categorized_task(
+                master_result['added_rows'])
+            task_ids.append(scheduled_task.task_id)
+        added_rows += len(master_result['added_rows'])
+        duplicate_rows += master_result['duplicate_rows']
+        total_rows = master_result['total_rows']
+        chunk.clear()
+        parse_start = time.perf_counter()
 
-def parse_csv_content(file_content):
-    """Parse CSV content and return structured data."""
     try:
-        # Decode content if it's bytes
-        if isinstance(file_content, bytes):
-            file_content = file_content.decode('utf-8')
-
-        # Create a StringIO object to read the CSV
-        csv_file = io.StringIO(file_content)
-        reader = csv.DictReader(csv_file)
-
-        # Read all rows
-        rows: list[dict[Union[str, Any], Union[str, Any]]] = []
         for row in reader:
-            rows.append(row)
-
-        return {
-            'success': True,
-            'row_count': len(rows),
-            'columns': list(rows[0].keys()) if rows else [],
-            'data': rows,  # Return all rows for master CSV processing
-            'preview': rows[:10],  # Return first 10 rows as preview
-            'total_rows': len(rows)
-        }
-    except Exception as e:
+            row_count += 1
+            if len(preview) < 10:
+                preview.append(row)
+            chunk.append(row)
+            if len(chunk) >= chunk_size:
+                store_chunk()
+        if chunk:
+            store_chunk()
+    except (csv.Error, UnicodeDecodeError) as e:
         logger.error(f"Error parsing CSV: {str(e)}")
-        return {
-            'success': False,
-            'error': f"Failed to parse CSV: {str(e)}"
+        error = f"Failed to parse CSV at row {row_count + 1}: {str(e)}"
+    finally:
+        get_storage().flush()
+
+    return {
+        'success': error is None,
+        'error': error,
+        'row_count': row_count,
+        'columns': reader.fieldnames or [],
+        'preview': preview,
+        'file_size': counting_reader.bytes_read,
+        'task_ids': task_ids,
+        'master_csv': {
+            'total_rows': total_rows,
+            'added_rows': added_rows,
+            'duplicate_rows': duplicate_rows
         }
+    }
 
 
-@app.route('/health', methods=['GET'])
+@routes.route('/health', methods=['GET'])
 def health_check():
-    """Health check endpoint."""
+    """Liveness, the server answers as soon as it starts. The readiness
+    block tells whether the classifier is loaded."""
     return jsonify({
         'status': 'healthy',
         'timestamp': datetime.now().isoformat(),
-        'service': 'CSV Upload Server'
+        'service': 'CSV Upload Server',
+        'readiness': get_categorizer().get_readiness()
     })
 
 
-@app.route('/transactions', methods=['GET'])
-def get_transactions():
-    # Read master file rows using the manager
-    result = master_csv_manager.read_master_csv_list()
+@routes.route('/health/ready', methods=['GET'])
+def readiness_check():
+    """Readiness, 503 until the taxonomy and the classifier are loaded.
+    Processes spooling categorization to another one are always ready."""
+    readiness = get_categorizer().get_readiness()
+    ready = readiness['initialized'] and readiness['model_ready'] is not False
     return jsonify({
+        'ready': ready,
+        **readiness
+    }), 200 if ready else 503
+
+
+@routes.route('/metrics', methods=['GET'])
+def get_metrics():
+    """Latency histograms and queue depths in the Prometheus text format."""
+    return Response(render_metrics(),
+                    mimetype='text/plain; version=0.0.4')
+
+
+def stream_json_response(fields: dict[str, Any], rows_key: str, rows: Iterable[Any],
+                         headers: Union[dict[str, str], None] = None) -> Response:
+    """Stream fields and rows as one JSON object, compressed with the best
+    coding the client accepts."""
+    encoding = request.accept_encodings.best_match(get_supported_encodings())
+    response_headers = {'Vary': 'Accept-Encoding', **(headers or {})}
+    if encoding is not None:
+        response_headers['Content-Encoding'] = encoding
+    return Response(
+        compress_stream(stream_json_rows(fields, rows_key, rows), encoding),
+        mimetype='application/json', headers=response_headers)
+
+
+@routes.route('/transactions', methods=['GET'])
+def get_transactions():
+    """Return transactions, optionally filtered, sorted and paged.
+
+    Query parameters: start_date, end_date, category, sub_category (both
+    repeatable), min_amount, max_amount, q (text search over Name and Memo),
+    sort (date, amount, name, category or sub_category, prefix '-' for
+    descending), limit and cursor (the next_cursor of the previous page).
+
+    The response is streamed and carries an ETag of the ledger version, a
+    request with a matching If-None-Match gets a 304 without querying.
+    """
+    try:
+        query = TransactionQuery.from_args(request.args)
+    except ValueError as e:
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 400
+    # Read before querying, a change in between only makes the ETag older
+    etag = get_storage().get_etag()
+    headers = {'ETag': quote_etag(etag, weak=True), 'Cache-Control': 'no-cache'}
+    if request.if_none_match.contains_weak(etag):
+        return Response(status=304, headers=headers)
+    result = get_storage().query_transactions(query)
+    return stream_json_response({
         'columns': result['columns'],
-        'data': result['rows']
-    })
+        'total': result['total'],
+        'next_cursor': result['next_cursor']
+    }, 'data', result['rows'], headers)
+
+@routes.route('/summary', methods=['GET'])
+def get_summary():
+    """Return income, expenses and net cash flow by month, category and
+    sub-category. Optional start_date and end_date limit the range and the
+    Ignore category is left out unless include_ignored=true."""
+    dates = {}
+    for name in ('start_date', 'end_date'):
+        value = request.args.get(name)
+        dates[name] = parse_date(value) if value else None
+        if dates[name] == MISSING_DATE:
+            return jsonify({
+                'success': False,
+                'error': f"Invalid {name}: {value}"
+            }), 400
+    excluded_categories = () \
+        if request.args.get('include_ignored') == 'true' \
+        else DEFAULT_EXCLUDED_CATEGORIES
+    return jsonify(get_state().cash_flow_summarizer.get_summary(
+        dates['start_date'], dates['end_date'], excluded_categories))
 
-@app.route('/categories', methods=['GET'])
+@routes.route('/categories', methods=['GET'])
 def get_categories():
-    result = categorized_manager.get_categories()
+    result = get_categorizer().get_categories()
     return jsonify({
         'data': result
     })
 
-@app.route('/categories', methods=['POST'])
+@routes.route('/categories', methods=['POST'])
 def update_categories():
     data = json.loads(request.data.decode('utf-8'))
-    result = categorized_manager.update_categories(data["changes"])
+    scheduled_task = get_categorizer().update_categories(data["changes"])
     return jsonify({
-        'data': result
+        'data': True,
+        'task_id': scheduled_task.task_id
     })
 
-@app.route('/train', methods=['POST'])
+@routes.route('/train', methods=['POST'])
 def train_transactions():
-    categorized_manager.add_train_task()
+    scheduled_task = get_categorizer().add_train_task()
     return jsonify({
+        'task_id': scheduled_task.task_id
     })
 
-@app.route('/update_transactions_categories', methods=['POST'])
+
+# Longest a long-poll request is held open, in seconds
+MAX_TASK_WAIT = 60.0
+
+def get_task_status_store() -> TaskStatusStore:
+    """Task states published by the categorization process, read by the
+    processes that spool work to it."""
+    return cast(SpooledCategorizer, get_categorizer()).status_store
+
+def get_task_wait() -> tuple[float, Union[int, None]]:
+    """Read the wait (seconds) and since (change count) long-poll arguments."""
+    wait = float(request.args.get('wait', 0))
+    # nan passes the clamp below and would spin the wait loop
+    if not math.isfinite(wait):
+        raise ValueError(f"Invalid wait: {wait}")
+    since = request.args.get('since')
+    return min(max(wait, 0.0), MAX_TASK_WAIT), \
+        int(since) if since is not None else None
+
+@routes.route('/tasks', methods=['GET'])
+def get_tasks():
+    """List tasks and queue depths, with wait and since it returns once any
+    task changed after the change count since."""
+    try:
+        wait, since = get_task_wait()
+    except ValueError:
+        return jsonify({'error': 'wait and since must be finite numbers'}), 400
+    scheduler = get_categorizer().get_scheduler()
+    if scheduler is None:
+        # Only the spooled tasks are known here, the queues are elsewhere
+        status_store = get_task_status_store()
+        descriptions = status_store.read_all()
+        if wait:
+            descriptions = status_store.wait_for_any_change(
+                since if since is not None else get_last_updated(descriptions), wait)
+        return jsonify({
+            'tasks': descriptions,
+            'queue_depth': {},
+            'running': sum(1 for description in descriptions
+                           if description['state'] == RUNNING),
+            'updated': get_last_updated(descriptions),
+        })
+    if wait:
+        scheduler.wait_for_change(
+            since if since is not None else scheduler.get_change_count(), wait)
+    return jsonify(scheduler.describe_tasks())
+
+@routes.route('/tasks/<task_id>', methods=['GET'])
+def get_task(task_id):
+    """Describe one task, with wait and since it returns once the task
+    changed after the change count since."""
+    try:
+        wait, since = get_task_wait()
+    except ValueError:
+        return jsonify({'error': 'wait and since must be finite numbers'}), 400
+    scheduler = get_categorizer().get_scheduler()
+    if scheduler is None:
+        status_store = get_task_status_store()
+        description = status_store.read(task_id)
+        if description is not None and wait:
+            description = status_store.wait_for_change(
+                task_id, since if since is not None else description['updated'], wait)
+        if description is None:
+            return jsonify({'error': 'Task not found'}), 404
+        return jsonify(description)
+    scheduled_task = scheduler.get_task(task_id)
+    if scheduled_task is None:
+        return jsonify({'error': 'Task not found'}), 404
+    if wait:
+        scheduler.wait_for_change(
+            since if since is not None else scheduled_task.updated, wait,
+            scheduled_task)
+    return jsonify(scheduler.describe_task(scheduled_task))
+
+@routes.route('/tasks/<task_id>/events', methods=['GET'])
+def get_task_events(task_id):
+    """Stream the task as server-sent events on every change until it finishes."""
+    scheduler = get_categorizer().get_scheduler()
+    if scheduler is None:
+        status_store = get_task_status_store()
+        if status_store.read(task_id) is None:
+            return jsonify({'error': 'Task not found'}), 404
+
+        def describe(since: int) -> Union[dict[str, Any], None]:
+            return status_store.wait_for_change(task_id, since, MAX_TASK_WAIT)
+    else:
+        scheduled_task = scheduler.get_task(task_id)
+        if scheduled_task is None:
+            return jsonify({'error': 'Task not found'}), 404
+
+        def describe(since: int) -> Union[dict[str, Any], None]:
+            scheduler.wait_for_change(since, MAX_TASK_WAIT, scheduled_task)
+            return scheduler.describe_task(scheduled_task)
+
+    def generate():
+        since = -1
+        while True:
+            description = describe(since)
+            if description is None:
+                # Pruned by the categorization process
+                return
+            if description['updated'] > since:
+                since = description['updated']
+                yield f"data: {json.dumps(description)}\n\n"
+            else:
+                # Nothing changed within MAX_TASK_WAIT, keeps proxies from closing the stream
+                yield ": keep-alive\n\n"
+            if description['state'] in FINISHED_STATES:
+                return
+
+    return Response(generate(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache'})
+
+@routes.route('/update_transactions_categories', methods=['POST'])
 def update_transactions_categories():    
     data = json.loads(request.data.decode('utf-8'))
-    master_csv_manager.update_rows_with_categories(data["rows"])
-    result = master_csv_manager.read_master_csv_list()
-    return jsonify({
-        'columns': result['columns'],
-        'data': result['rows']
-    })
-
-@app.route('/upload', methods=['POST'])
+    changed_rows = get_storage().update_rows_with_categories(data["rows"])
+    get_categorizer().add_label_corrections(changed_rows)
+    # Only the rows that changed are returned, clients merge them in place
+    return stream_json_response(
+        {'columns': FIELDNAMES}, 'data',
+        ([row[field] for field in FIELDNAMES] for row in changed_rows))
+
+@routes.route('/upload', methods=['POST'])
 def upload_csv():
     """Upload and process CSV file."""
     try:
-        # Check if file is present in request
-        if 'file' not in request.files:
-            return jsonify({
-                'success': False,
-                'error': 'No file provided'
-            }), 400
-
-        file = request.files['file']
-
-        # Check if file was selected
-        if file.filename == '':
-            return jsonify({
-                'success': False,
-                'error': 'No file selected'
-            }), 400
+        # A raw CSV body is read straight from the socket, multipart
+        # uploads are spooled to a temporary file by the form parser
+        if request.mimetype == 'text/csv':
+            filename = request.args.get('filename', 'upload.csv')
+            stream = request.stream
+        else:
+            # Check if file is present in request
+            if 'file' not in request.files:
+                return jsonify({
+                    'success': False,
+                    'error': 'No file provided'
+                }), 400
+
+            file = request.files['file']
+            filename = file.filename
+
+            # Check if file was selected
+            if filename == '':
+                return jsonify({
+                    'success': False,
+                    'error': 'No file selected'
+                }), 400
+            stream = file.stream
 
         # Check file extension
-        if not allowed_file(file.filename):
+        if not allowed_file(filename):
             return jsonify({
                 'success': False,
                 'error': 'Invalid file type. Only CSV files are allowed.'
             }), 400
 
-        # Read file content
-        file_content = file.read()
-
-        # Parse CSV content
-        result = parse_csv_content(file_content)
-
-        if not result['success']:
-            return jsonify(result), 400
-
-        # Update master CSV with new data
         print("Adding rows to master file")
-        master_result = master_csv_manager.add_rows_to_master_csv(
-            result['data'])
-
-        categorized_manager.add_categorized_task(master_result['added_rows'])
+        result = ingest_csv_stream(stream, current_app.config['UPLOAD_CHUNK_SIZE'])
         print("Finish adding rows to master file")
 
+        if not result['success']:
+            # Chunks before the malformed row are already stored
+            return jsonify({
+                'success': False,
+                'error': result['error'],
+                'task_ids': result['task_ids'],
+                'master_csv': result['master_csv']
+            }), 400
+
         logger.info(
-            f"File processed successfully: {file.filename} and added {len(master_result['added_rows'])} rows")
+            f"File processed successfully: {filename} and added {result['master_csv']['added_rows']} rows")
 
         return jsonify({
             'success': True,
             'message': 'File processed successfully',
-            'original_filename': file.filename,
+            'original_filename': filename,
             'upload_time': datetime.now().isoformat(),
-            'file_size': len(file_content),
+            'file_size': result['file_size'],
             'csv_data': {
                 'success': result['success'],
                 'row_count': result['row_count'],
                 'columns': result['columns'],
                 'data': result['preview'],  # Show preview in response
-                'total_rows': result['total_rows']
+                'total_rows': result['row_count']
             },
-            'master_csv': {
-                'total_rows': master_result['total_rows'],
-                'added_rows': len(master_result['added_rows']),
-                'duplicate_rows': master_result['duplicate_rows']
-            }
+            'task_ids': result['task_ids'],
+            'master_csv': result['master_csv']
         })
 
     except Exception as e:
@@ -208,16 +488,16 @@ def upload_csv():
         }), 500
 
 
-@app.errorhandler(413)
+@routes.app_errorhandler(413)
 def too_large(e):
     """Handle file too large error."""
     return jsonify({
         'success': False,
-        'error': 'File too large. Maximum size is 16MB.'
+        'error': f"File too large. Maximum size is {current_app.config['MAX_CONTENT_LENGTH'] // (1024 * 1024)}MB."
     }), 413
 
 
-@app.errorhandler(404)
+@routes.app_errorhandler(404)
 def not_found(e):
     """Handle 404 errors."""
     return jsonify({
@@ -226,8 +506,174 @@ def not_found(e):
     }), 404
 
 
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="Server for a cash flow app")
+    parser.add_argument("--data_folder", type=str, help="Directory of data folder", required=True)
+    parser.add_argument("--storage", choices=["csv", "sqlite"], default="csv",
+                        help="Storage engine for the master transactions")
+    parser.add_argument("--journal", action="store_true",
+                        help="Append uploads and category changes to a journal that is compacted into the master CSV in the background")
+    parser.add_argument("--batch_size", type=int, default=32,
+                        help="Number of transactions classified per forward pass")
+    parser.add_argument("--interactive_workers", type=int, default=1,
+                        help="Worker threads for categorization and category edits")
+    parser.add_argument("--max_categorize_rows", type=int, default=20000,
+                        help="Most rows merged from queued uploads into one categorization batch")
+    parser.add_argument("--max_categorize_wait", type=float, default=0.25,
+                        help="Seconds to wait for more uploads before categorizing a batch")
+    parser.add_argument("--train_mode", choices=["incremental", "full"], default="incremental",
+                        help="Warm-start training from the saved model on newly labeled transactions, or retrain from the base model")
+    parser.add_argument("--replay_ratio", type=float, default=1.0,
+                        help="Previously trained transactions replayed per new one in incremental training")
+    parser.add_argument("--inference_backend", choices=["pytorch", "onnx"], default="pytorch",
+                        help="Serve the trained classifier with PyTorch or as an int8 quantized ONNX Runtime model")
+    parser.add_argument("--lexical_threshold", type=float, default=0.9,
+                        help="Confidence above which the character n-gram tier's prediction is kept instead of asking the transformer, above 1 disables the tier")
+    parser.add_argument("--categorize_mode", choices=["finetune", "knn"], default="finetune",
+                        help="Categorize with the fine-tuned classifier or by the nearest labeled names in DistilBERT embedding space")
+    parser.add_argument("--knn_k", type=int, default=5,
+                        help="Number of nearest labeled names voting in knn mode")
+    parser.add_argument("--offline", action="store_true",
+                        help="Never look models up on the network, the base model must already be in the data folder's model store")
+    parser.add_argument("--max_upload_mb", type=int, default=None,
+                        help="Reject uploads larger than this many megabytes, unlimited by default")
+    parser.add_argument("--upload_chunk_size", type=int, default=5000,
+                        help="Number of uploaded rows parsed and stored at a time")
+    parser.add_argument("--multi_process", action="store_true",
+                        help="Share the data folder with other server processes, set by wsgi.py")
+    return parser
+
+
+def get_default_config() -> dict[str, Any]:
+    # Every option but the required data folder has a default
+    config = vars(build_parser().parse_args(['--data_folder', '']))
+    # Whether to start categorization in the background, the benchmarks
+    # leave it off
+    config['start_background_work'] = True
+    return config
+
+
+def create_app(config: dict[str, Any]) -> Flask:
+    """Build the app for config, keyed like the command line options, the
+    missing ones take their defaults.
+
+    With multi_process set the first process to start on a data folder
+    runs categorization and training, the others spool that work to it
+    and serve requests from their own copy of the ledger.
+    """
+    config = {**get_default_config(), **config}
+    if not config['data_folder']:
+        raise ValueError("data_folder is required")
+
+    app = Flask(__name__)
+    CORS(app)
+    # Uploads are streamed in chunks so there is no size limit unless configured
+    app.config['MAX_CONTENT_LENGTH'] = config['max_upload_mb'] * 1024 * 1024 \
+        if config['max_upload_mb'] else None
+    app.config['UPLOAD_CHUNK_SIZE'] = config['upload_chunk_size']
+    app.config['DATA_FOLDER'] = config['data_folder']
+    app.config['ALLOWED_EXTENSIONS'] = {'csv'}
+
+    # Create uploads directory if it doesn't exist
+    os.makedirs(app.config['DATA_FOLDER'], exist_ok=True)
+
+    data_folder_path = os.path.join(
+        os.path.abspath(os.path.dirname(__file__)),
+        app.config['DATA_FOLDER']
+    )
+    multi_process = config['multi_process']
+
+    master_csv_manager: TransactionStorage
+    if config['storage'] == "sqlite":
+        master_csv_manager = SQLiteTransactionManager(data_folder_path)
+    else:
+        master_csv_manager = MasterCSVManager(
+            data_folder_path, use_journal=config['journal'], shared=multi_process)
+
+    cash_flow_rollups = CashFlowRollups(
+        os.path.join(data_folder_path, 'cash_flow_rollups.json'))
+    cash_flow_rollups.load_and_verify(master_csv_manager)
+    master_csv_manager.add_change_listener(cash_flow_rollups)
+    cash_flow_summarizer = CashFlowSummarizer(master_csv_manager, cash_flow_rollups)
+
+    categorizer_lock = None
+    spool = None
+    task_status_store = None
+    if multi_process:
+        # Held for the life of the process that runs categorization
+        categorizer_lock = FileLock(os.path.join(data_folder_path, 'categorizer.lock'))
+        if not categorizer_lock.acquire(blocking=False):
+            categorizer_lock.close()
+            categorizer_lock = None
+        spool = TaskSpool(os.path.join(data_folder_path, 'task_spool'))
+        task_status_store = TaskStatusStore(os.path.join(data_folder_path, 'task_status'))
+
+    categorized_manager: Union[CategorizerManager, SpooledCategorizer]
+    spool_consumer = None
+    if multi_process and categorizer_lock is None:
+        assert spool is not None and task_status_store is not None
+        categorized_manager = SpooledCategorizer(data_folder_path, spool, task_status_store)
+    else:
+        categorized_manager = CategorizerManager(
+            master_csv_manager, data_folder_path, batch_size=config['batch_size'],
+            interactive_workers=config['interactive_workers'],
+            max_categorize_rows=config['max_categorize_rows'],
+            max_categorize_wait=config['max_categorize_wait'],
+            train_mode=config['train_mode'], replay_ratio=config['replay_ratio'],
+            inference_backend=config['inference_backend'],
+            lexical_threshold=config['lexical_threshold'],
+            categorize_mode=config['categorize_mode'], knn_k=config['knn_k'],
+            offline=config['offline'])
+        if spool is not None:
+            scheduler = categorized_manager.get_scheduler()
+            spool_consumer = SpoolConsumer(
+                spool, categorized_manager.submit_spooled,
+                status_store=task_status_store, describe=scheduler.describe_task,
+                finished_states=FINISHED_STATES)
+            print("This process runs categorization")
+
+    def get_queue_depths():
+        scheduler = categorized_manager.get_scheduler()
+        if scheduler is None:
+            return {}
+        return {(lane,): depth for lane, depth in scheduler.get_queue_depths().items()}
+
+    TASK_QUEUE_DEPTH.set_callback(get_queue_depths)
+
+    app.extensions['cash_flow'] = ServerState(
+        master_csv_manager, categorized_manager, cash_flow_summarizer,
+        spool_consumer, categorizer_lock)
+    app.register_blueprint(routes)
+
+    if config['start_background_work'] and isinstance(categorized_manager, CategorizerManager):
+        categorized_manager.add_initialized_task()
+        if spool_consumer is not None:
+            spool_consumer.start()
+    return app
+
+
+def stop_app(app: Flask):
+    """Finish background work and persist the ledger."""
+    state: ServerState = app.extensions['cash_flow']
+    if state.spool_consumer is not None:
+        state.spool_consumer.stop()
+    state.categorized_manager.stop()
+    state.master_csv_manager.stop()
+    if state.cash_flow_summarizer.rollups is not None:
+        state.cash_flow_summarizer.rollups.stop()
+    if state.categorizer_lock is not None:
+        state.categorizer_lock.release()
+        state.categorizer_lock.close()
+
+
 if __name__ == '__main__':
-    categorized_manager.add_initialized_task()
+    # Started by a TrainTask of a frozen build, which cannot run
+    # classifier_training.py with an interpreter
+    if len(sys.argv) == 3 and sys.argv[1] == TRAIN_JOB_OPTION:
+        from classifier_training import run_job_file
+        run_job_file(sys.argv[2])
+        sys.exit(0)
+    app = create_app(vars(build_parser().parse_args()))
     app.run(debug=False, host='0.0.0.0', port=5000)
     print("App Finish")
-    categorized_manager.stop()
+    stop_app(app)
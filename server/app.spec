@@ -9,7 +9,8 @@ a = Analysis(
     pathex=[],
     binaries=[],
     datas=[],
-    hiddenimports=[],
+    # classifier_training runs in its own process through app --train_job
+    hiddenimports=['classifier_training'],
     hookspath=[],
     hooksconfig={},
     runtime_hooks=[],
@@ -0,0 +1,215 @@
+"""Time the ledger operations on a generated data set and save the results.
+
+Generate the CSVs with test_data/main.py first, for example
+
+    python ../test_data/main.py 2015 bench --rows 1000000 --years 10 --accounts 3 --seed 1
+    python benchmark.py --csv_folder bench --output results/1m.json
+
+The server runs in process on a fresh temporary data folder. Measured are
+/upload with deduplication (the first upload of every file and a repeat
+upload of all of them), update_rows_with_categories over the whole
+ledger, an UpdateCategoriesTask renaming a sub-category, /transactions
+serialization plain, gzip compressed and revalidated, and with
+--classify N the per-row categorization time of N rows with the
+configured model. Pass --baseline with an earlier results file to print
+the change of every timing.
+"""
+import argparse
+import hashlib
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any, Union
+
+
+def get_git_commit() -> Union[str, None]:
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def timed(results: dict[str, Any], name: str, rows: int, function):
+    """Run function, record its time under name and return its result."""
+    start = time.perf_counter()
+    value = function()
+    seconds = time.perf_counter() - start
+    results[name] = {
+        'seconds': seconds,
+        'rows': rows,
+        'rows_per_second': rows / seconds if seconds > 0 else None,
+    }
+    print(f"{name}: {seconds:.3f}s for {rows} rows")
+    return value
+
+
+def pick_sub_category(name: str, sub_categories: list[str]) -> str:
+    """A stable label per merchant, so relabeling touches every row."""
+    digest = hashlib.md5(name.encode('utf-8')).digest()
+    return sub_categories[int.from_bytes(digest[:4], 'little') % len(sub_categories)]
+
+
+def run_benchmarks(args, data_folder: str) -> dict[str, Any]:
+    from app import create_app, stop_app
+    from categorizer_constants import default_categories
+    from categorizer_manager import CategorizedTask, UpdateCategoriesTask
+
+    # Initialization is started by --classify only
+    app = create_app({'data_folder': data_folder, 'storage': args.storage,
+                      'journal': args.journal, 'start_background_work': False})
+    client = app.test_client()
+    state = app.extensions['cash_flow']
+    storage = state.master_csv_manager
+    categorizer_manager = state.categorized_manager
+    scheduler = categorizer_manager.get_scheduler()
+    results: dict[str, Any] = {}
+
+    csv_files = sorted(
+        os.path.join(args.csv_folder, name) for name in os.listdir(args.csv_folder)
+        if name.endswith('.csv'))
+    file_rows = 0
+    for csv_file in csv_files:
+        with open(csv_file, 'rb') as f:
+            file_rows += sum(1 for _line in f) - 1
+
+    task_ids: list[str] = []
+
+    def upload_all():
+        for csv_file in csv_files:
+            with open(csv_file, 'rb') as f:
+                response = client.post(
+                    f'/upload?filename={os.path.basename(csv_file)}',
+                    data=f.read(), content_type='text/csv')
+            if response.status_code != 200:
+                raise RuntimeError(f"Upload of {csv_file} failed: {response.get_json()}")
+            task_ids.extend(response.get_json()['task_ids'])
+
+    timed(results, 'upload', file_rows, upload_all)
+    timed(results, 'upload_duplicates', file_rows, upload_all)
+    # The categorization of the uploads is not part of these timings
+    for task_id in task_ids:
+        scheduled_task = scheduler.get_task(task_id)
+        if scheduled_task is not None:
+            scheduler.cancel(scheduled_task)
+    results['ledger_rows'] = len(storage.read_master_csv_dict())
+
+    categorizer_manager.set_categories(default_categories)
+    taxonomy = categorizer_manager.get_taxonomy()
+    sub_categories = list(taxonomy.labels)
+    labeled_rows = storage.read_master_csv_dict()
+    for row in labeled_rows:
+        row['Sub Category'] = pick_sub_category(row['Name'], sub_categories)
+        row['Category'] = taxonomy.get_category(row['Sub Category'])
+    timed(results, 'update_rows_with_categories', len(labeled_rows),
+          lambda: storage.update_rows_with_categories(labeled_rows))
+
+    # Rename the most used sub-category and every row of it
+    counts: dict[str, int] = {}
+    for row in labeled_rows:
+        counts[row['Sub Category']] = counts.get(row['Sub Category'], 0) + 1
+    renamed = max(counts, key=counts.get)
+    update_task = UpdateCategoriesTask(
+        [{'type': 'update', 'change': {'subCategory': renamed,
+                                       'newName': renamed + ' Renamed'}}],
+        categorizer_manager.get_category_file_path(), categorizer_manager.lock,
+        storage, categorizer_manager)
+    timed(results, 'update_categories_task', counts[renamed], update_task.doWork)
+
+    def get_transactions(headers: dict[str, str]):
+        response = client.get('/transactions', headers=headers)
+        return response.status_code, response.headers.get('ETag'), len(response.get_data())
+
+    _status, etag, size = timed(results, 'transactions', results['ledger_rows'],
+                                lambda: get_transactions({'Accept-Encoding': 'identity'}))
+    results['transactions']['bytes'] = size
+    _status, _etag, size = timed(results, 'transactions_gzip', results['ledger_rows'],
+                                 lambda: get_transactions({'Accept-Encoding': 'gzip'}))
+    results['transactions_gzip']['bytes'] = size
+    status, _etag, _size = timed(results, 'transactions_not_modified', 0,
+                                 lambda: get_transactions({'If-None-Match': etag or ''}))
+    results['transactions_not_modified']['status'] = status
+
+    if args.classify:
+        categorizer_manager.add_initialized_task()
+        timed(results, 'model_ready', 0, lambda: categorizer_manager.model_ready_event.wait(
+            args.model_timeout))
+        readiness = categorizer_manager.get_readiness()
+        if not readiness['model_ready']:
+            results['categorize'] = {'skipped': readiness['model_error'] or 'model not ready'}
+            print(f"categorize skipped: {results['categorize']['skipped']}")
+        else:
+            rows = storage.read_master_csv_dict()[:args.classify]
+            categorizer_manager.get_prediction_cache().clear()
+            task = CategorizedTask(rows, categorizer_manager, storage)
+            timed(results, 'categorize', len(rows), task.doWork)
+            results['categorize']['seconds_per_row'] = \
+                results['categorize']['seconds'] / max(len(rows), 1)
+
+    scheduler.join()
+    stop_app(app)
+    return results
+
+
+def print_comparison(results: dict[str, Any], baseline: dict[str, Any]):
+    print(f"Compared with {baseline.get('commit')} of {baseline.get('timestamp')}:")
+    if baseline['results'].get('ledger_rows') != results.get('ledger_rows'):
+        print("  The baseline was run on a different data set")
+    for name, result in results.items():
+        previous = baseline['results'].get(name)
+        if not isinstance(result, dict) or not isinstance(previous, dict) \
+                or 'seconds' not in result or 'seconds' not in previous:
+            continue
+        change = (result['seconds'] / previous['seconds'] - 1) * 100 \
+            if previous['seconds'] > 0 else 0.0
+        print(f"  {name}: {previous['seconds']:.3f}s -> {result['seconds']:.3f}s ({change:+.1f}%)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the ledger operations")
+    parser.add_argument("--csv_folder", required=True, help="Folder of CSVs from test_data/main.py")
+    parser.add_argument("--output", default="benchmark_results.json", help="Results JSON file")
+    parser.add_argument("--storage", choices=["csv", "sqlite"], default="csv")
+    parser.add_argument("--journal", action="store_true")
+    parser.add_argument("--classify", type=int, default=0,
+                        help="Time categorizing this many rows with the model, 0 skips it")
+    parser.add_argument("--model_timeout", type=float, default=600,
+                        help="Seconds to wait for the model to load")
+    parser.add_argument("--baseline", default=None, help="Earlier results file to compare with")
+    args = parser.parse_args()
+
+    data_folder = tempfile.mkdtemp(prefix='cash_flow_benchmark_')
+    try:
+        results = run_benchmarks(args, data_folder)
+    finally:
+        shutil.rmtree(data_folder, ignore_errors=True)
+
+    report = {
+        'commit': get_git_commit(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'storage': args.storage,
+        'journal': args.journal,
+        'csv_folder': os.path.abspath(args.csv_folder),
+        'results': results,
+    }
+    output_folder = os.path.dirname(os.path.abspath(args.output))
+    os.makedirs(output_folder, exist_ok=True)
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=4)
+    print(f"Results written to {args.output}")
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            print_comparison(results, json.load(f))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,163 @@
+import json
+import math
+import os
+import threading
+from typing import Union
+import numpy as np
+from cash_flow_summary import (
+    DEFAULT_EXCLUDED_CATEGORIES, encode_names, encode_sub_categories,
+    summarize, to_month)
+from transaction_query import MISSING_DATE, parse_amount, parse_date
+from transaction_storage import TransactionRows, TransactionStorage
+
+
+# Month (months since 1970-01), category, sub-category
+RollupKey = tuple[int, str, str]
+
+
+class CashFlowRollups:
+    """Income, expense and count totals per month, category and sub-category.
+
+    The totals are updated with deltas as rows are added or recategorized,
+    so summaries cost O(number of buckets). Change listeners run with the
+    storage lock held, so they only mark the totals dirty, a background
+    thread persists them to the data folder every save_interval seconds
+    and on stop. They are checked against a full rebuild at startup.
+    """
+
+    def __init__(self, rollup_file_path: str, save_interval: float = 30.0):
+        self.rollup_file_path = rollup_file_path
+        self.lock = threading.Lock()
+        # Bucket key to [income, expenses, count], expenses as a positive number
+        self.buckets: dict[RollupKey, list[float]] = {}
+        self.is_dirty = False
+        self.save_interval = save_interval
+        self.stop_event = threading.Event()
+        self.save_thread = threading.Thread(target=self.save_worker)
+        self.save_thread.daemon = True
+        self.save_thread.start()
+
+    def _apply(self, buckets: dict[RollupKey, list[float]], month: int,
+               amount: float, category: str, sub_category: str, sign: int):
+        key = (month, category, sub_category)
+        bucket = buckets.setdefault(key, [0.0, 0.0, 0])
+        if amount > 0:
+            bucket[0] += sign * amount
+        else:
+            bucket[1] -= sign * amount
+        bucket[2] += sign
+        if bucket[2] == 0:
+            del buckets[key]
+
+    def _apply_row(self, row: dict, category: str, sub_category: str, sign: int):
+        date_ordinal = parse_date(row['Date'])
+        if date_ordinal == MISSING_DATE:
+            return
+        self._apply(self.buckets, to_month(date_ordinal),
+                    parse_amount(row['Amount']), category, sub_category, sign)
+
+    def on_rows_added(self, rows: TransactionRows):
+        with self.lock:
+            for row in rows:
+                self._apply_row(
+                    row, row['Category'], row['Sub Category'], 1)
+            self.is_dirty = True
+
+    def on_rows_recategorized(self, changes: list[tuple[dict, dict]]):
+        with self.lock:
+            for old_row, new_row in changes:
+                self._apply_row(old_row, old_row['Category'],
+                                old_row['Sub Category'], -1)
+                self._apply_row(new_row, new_row['Category'],
+                                new_row['Sub Category'], 1)
+            self.is_dirty = True
+
+    def on_rows_reloaded(self, columns: dict[str, list]):
+        buckets = self.rebuild(columns)
+        with self.lock:
+            self.buckets = buckets
+            self.is_dirty = True
+
+    def rebuild(self, columns: dict[str, list]) -> dict[RollupKey, list[float]]:
+        buckets: dict[RollupKey, list[float]] = {}
+        for date_ordinal, amount, category, sub_category in zip(
+                columns['dates'], columns['amounts'],
+                columns['categories'], columns['sub_categories']):
+            if date_ordinal == MISSING_DATE:
+                continue
+            self._apply(buckets, to_month(date_ordinal), amount,
+                        category, sub_category, 1)
+        return buckets
+
+    def load(self) -> Union[dict[RollupKey, list[float]], None]:
+        if not os.path.exists(self.rollup_file_path):
+            return None
+        with open(self.rollup_file_path, 'r', encoding='utf-8') as f:
+            entries = json.load(f)
+        return {(month, category, sub_category): [income, expenses, count]
+                for month, category, sub_category, income, expenses, count in entries}
+
+    def save(self):
+        with self.lock:
+            entries = [[*key, *bucket] for key, bucket in self.buckets.items()]
+            self.is_dirty = False
+        # Server processes sharing the data folder save their own copy
+        temp_file_path = f'{self.rollup_file_path}.{os.getpid()}.tmp'
+        with open(temp_file_path, 'w', encoding='utf-8') as f:
+            json.dump(entries, f)
+        os.replace(temp_file_path, self.rollup_file_path)
+
+    def save_if_dirty(self):
+        if self.is_dirty:
+            self.save()
+
+    def save_worker(self):
+        while not self.stop_event.wait(self.save_interval):
+            self.save_if_dirty()
+
+    def stop(self):
+        self.stop_event.set()
+        self.save_thread.join()
+        self.save_if_dirty()
+
+    def load_and_verify(self, storage: TransactionStorage):
+        """Load the persisted rollups and replace them if a full rebuild disagrees."""
+        persisted = self.load()
+        rebuilt = self.rebuild(storage.read_columns())
+        if persisted is None:
+            print("Built cash flow rollups")
+        elif not self.is_same(persisted, rebuilt):
+            print("Persisted cash flow rollups are out of date, using a rebuild")
+        with self.lock:
+            self.buckets = rebuilt
+        self.save()
+
+    @staticmethod
+    def is_same(buckets: dict[RollupKey, list[float]],
+                other_buckets: dict[RollupKey, list[float]]) -> bool:
+        if buckets.keys() != other_buckets.keys():
+            return False
+        return all(
+            math.isclose(value, other_value, abs_tol=0.005)
+            for key, bucket in buckets.items()
+            for value, other_value in zip(bucket, other_buckets[key]))
+
+    def get_summary(self, start_month: Union[int, None] = None,
+                    end_month: Union[int, None] = None,
+                    excluded_categories=DEFAULT_EXCLUDED_CATEGORIES):
+        with self.lock:
+            items = [(key, bucket) for key, bucket in self.buckets.items()
+                     if (start_month is None or key[0] >= start_month) and
+                     (end_month is None or key[0] <= end_month) and
+                     key[1] not in excluded_categories]
+        months = np.array([key[0] for key, _bucket in items], dtype=np.int64)
+        categories = [key[1] for key, _bucket in items]
+        sub_categories = [key[2] for key, _bucket in items]
+        values = np.array([bucket for _key, bucket in items],
+                          dtype=np.float64).reshape(-1, 3)
+        category_names, category_codes = encode_names(categories)
+        sub_category_names, sub_category_codes = encode_sub_categories(
+            categories, sub_categories)
+        return summarize(months, category_codes, category_names,
+                         sub_category_codes, sub_category_names,
+                         values[:, 0], values[:, 1], values[:, 2])
@@ -0,0 +1,202 @@
+from datetime import date
+import threading
+from typing import TYPE_CHECKING, Union
+import numpy as np
+from transaction_storage import TransactionStorage
+
+if TYPE_CHECKING:
+    from cash_flow_rollups import CashFlowRollups
+
+
+UNIX_EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+
+# Transfers and card payments move money between accounts, they are not cash flow
+DEFAULT_EXCLUDED_CATEGORIES = ('Ignore',)
+
+
+def month_label(month: int) -> str:
+    return str(np.datetime64(month, 'M'))
+
+
+def encode_names(names) -> tuple[np.ndarray, np.ndarray]:
+    """Return the unique names and the integer code of every name."""
+    unique_names, codes = np.unique(np.asarray(names, dtype=str),
+                                    return_inverse=True)
+    return unique_names, codes.astype(np.int64)
+
+
+def encode_sub_categories(categories, sub_categories) -> tuple[list[tuple[str, str]], np.ndarray]:
+    """Code (category, sub-category) pairs, the same name may exist in two categories."""
+    pairs = np.char.add(np.char.add(
+        np.asarray(categories, dtype=str), '\x1f'),
+        np.asarray(sub_categories, dtype=str))
+    pair_names, pair_codes = encode_names(pairs)
+    return ([tuple(str(name).split('\x1f', 1)) for name in pair_names],
+            pair_codes)
+
+
+class ColumnarLedger:
+    """Column arrays of the master transactions for vectorized aggregation."""
+
+    def __init__(self, columns: dict[str, list]):
+        dates = np.asarray(columns['dates'], dtype=np.int64)
+        self.has_date = dates >= 0
+        self.dates = dates
+        days = (dates - UNIX_EPOCH_ORDINAL).astype('datetime64[D]')
+        self.months = days.astype('datetime64[M]').astype(np.int64)
+        self.amounts = np.asarray(columns['amounts'], dtype=np.float64)
+
+        # Categories are stored as integer codes into the name arrays, a
+        # sub-category is coded together with its category
+        self.category_names, self.category_codes = encode_names(
+            columns['categories'])
+        self.sub_category_names, self.sub_category_codes = encode_sub_categories(
+            columns['categories'], columns['sub_categories'])
+
+
+def sum_by_code(codes: np.ndarray, weights: np.ndarray, size: int) -> np.ndarray:
+    return np.bincount(codes, weights=weights, minlength=size)
+
+
+def summarize(months: np.ndarray,
+              category_codes: np.ndarray, category_names: np.ndarray,
+              sub_category_codes: np.ndarray, sub_category_names: list[tuple[str, str]],
+              income: np.ndarray, expenses: np.ndarray, counts: np.ndarray):
+    """Roll per-item income, expenses (positive) and counts up by month,
+    category and sub-category. Items are transactions or pre-aggregated
+    buckets, the running balance is taken at the end of each month."""
+    month_values, month_codes = np.unique(months, return_inverse=True)
+    month_income = sum_by_code(month_codes, income, len(month_values))
+    month_expenses = sum_by_code(month_codes, expenses, len(month_values))
+    month_counts = sum_by_code(month_codes, counts, len(month_values))
+    month_net = month_income - month_expenses
+    balances = np.cumsum(month_net)
+
+    category_income = sum_by_code(category_codes, income, len(category_names))
+    category_expenses = sum_by_code(
+        category_codes, expenses, len(category_names))
+    category_counts = sum_by_code(category_codes, counts, len(category_names))
+    sub_category_income = sum_by_code(
+        sub_category_codes, income, len(sub_category_names))
+    sub_category_expenses = sum_by_code(
+        sub_category_codes, expenses, len(sub_category_names))
+    sub_category_counts = sum_by_code(
+        sub_category_codes, counts, len(sub_category_names))
+
+    total_income = float(month_income.sum())
+    total_expenses = float(month_expenses.sum())
+    return {
+        'totals': {
+            'income': total_income,
+            'expenses': total_expenses,
+            'net': total_income - total_expenses,
+            'count': int(counts.sum()),
+        },
+        'months': [
+            {
+                'month': month_label(int(month)),
+                'income': float(month_income[i]),
+                'expenses': float(month_expenses[i]),
+                'net': float(month_net[i]),
+                'balance': float(balances[i]),
+                'count': int(month_counts[i]),
+            }
+            for i, month in enumerate(month_values)
+        ],
+        'categories': [
+            {
+                'category': str(name),
+                'income': float(category_income[i]),
+                'expenses': float(category_expenses[i]),
+                'net': float(category_income[i] - category_expenses[i]),
+                'count': int(category_counts[i]),
+            }
+            for i, name in enumerate(category_names)
+            if category_counts[i]
+        ],
+        'sub_categories': [
+            {
+                'category': category,
+                'sub_category': sub_category,
+                'income': float(sub_category_income[i]),
+                'expenses': float(sub_category_expenses[i]),
+                'net': float(sub_category_income[i] - sub_category_expenses[i]),
+                'count': int(sub_category_counts[i]),
+            }
+            for i, (category, sub_category) in enumerate(sub_category_names)
+            if sub_category_counts[i]
+        ],
+    }
+
+
+def compute_summary(ledger: ColumnarLedger,
+                    start_date: Union[int, None] = None,
+                    end_date: Union[int, None] = None,
+                    excluded_categories=DEFAULT_EXCLUDED_CATEGORIES):
+    """Aggregate the transactions of a columnar ledger within a date range."""
+    mask = ledger.has_date.copy()
+    if start_date is not None:
+        mask &= ledger.dates >= start_date
+    if end_date is not None:
+        mask &= ledger.dates <= end_date
+    if len(excluded_categories):
+        excluded_codes = np.flatnonzero(
+            np.isin(ledger.category_names, list(excluded_categories)))
+        mask &= ~np.isin(ledger.category_codes, excluded_codes)
+
+    amounts = ledger.amounts[mask]
+    return summarize(
+        ledger.months[mask],
+        ledger.category_codes[mask], ledger.category_names,
+        ledger.sub_category_codes[mask], ledger.sub_category_names,
+        np.where(amounts > 0, amounts, 0.0),
+        np.where(amounts < 0, -amounts, 0.0),
+        np.ones(len(amounts)))
+
+
+def to_month(date_ordinal: int) -> int:
+    """Return the month of a date ordinal as months since 1970-01."""
+    day = date.fromordinal(date_ordinal)
+    return (day.year - 1970) * 12 + day.month - 1
+
+
+def is_month_range(start_date: Union[int, None], end_date: Union[int, None]) -> bool:
+    """Whether a date range covers whole months, so monthly rollups can serve it."""
+    if start_date is not None and date.fromordinal(start_date).day != 1:
+        return False
+    return end_date is None or date.fromordinal(end_date + 1).day == 1
+
+
+class CashFlowSummarizer:
+    """Serves summaries from the monthly rollups when the range covers whole
+    months, otherwise from a columnar copy of the ledger that is rebuilt
+    when the storage version changes."""
+
+    def __init__(self, storage: TransactionStorage,
+                 rollups: Union['CashFlowRollups', None] = None):
+        self.storage = storage
+        self.rollups = rollups
+        self.lock = threading.Lock()
+        self.ledger: Union[ColumnarLedger, None] = None
+        self.ledger_version: Union[int, None] = None
+
+    def get_ledger(self) -> ColumnarLedger:
+        with self.lock:
+            version = self.storage.get_version()
+            if self.ledger is None or self.ledger_version != version:
+                self.ledger = ColumnarLedger(self.storage.read_columns())
+                self.ledger_version = version
+            return self.ledger
+
+    def get_summary(self, start_date: Union[int, None] = None,
+                    end_date: Union[int, None] = None,
+                    excluded_categories=DEFAULT_EXCLUDED_CATEGORIES):
+        if self.rollups is not None and is_month_range(start_date, end_date):
+            # The rollups follow changes of other processes once they are seen
+            self.storage.refresh()
+            return self.rollups.get_summary(
+                to_month(start_date) if start_date is not None else None,
+                to_month(end_date) if end_date is not None else None,
+                excluded_categories)
+        return compute_summary(self.get_ledger(), start_date, end_date,
+                               excluded_categories)
@@ -1,48 +1,197 @@
-from itertools import chain
-import queue
-from typing import Union, cast
+import itertools
+import time
+from typing import TYPE_CHECKING, Union
 import threading
 from categorizer_constants import default_categories, CategoriesDict
-from master_csv_manager import MasterCSVManager, TransactionRows
-from datasets import load_dataset
+from category_taxonomy import CategoryTaxonomy
+from transaction_storage import TransactionStorage, TransactionRows, SubCategoryChanges
+from prediction_cache import PredictionCache, normalize_name
+from training_history import PROGRESS_PREFIX, TrainingHistory, TrainingPair, get_training_pairs
+from metrics import (
+    CATEGORIZED_NAMES, INFERENCE_BATCH_SECONDS, INFERENCE_ROWS_PER_SECOND,
+    TRAIN_STEP_SECONDS, TimedLock)
+from task_scheduler import (
+    BACKGROUND_LANE, INTERACTIVE_LANE, PRIORITY_INITIALIZE,
+    PRIORITY_INTERACTIVE, PRIORITY_TRAIN, QUEUED, ScheduledTask, TaskScheduler)
+from model_registry import ModelRegistry
+from model_loading import load_mmap_model, set_offline
+from process_coordination import TaskSpool, TaskStatusStore
+from lexical_classifier import LexicalClassifier
+from embedding_index import EmbeddingIndex, NameEmbedder
 import os
 import json
-import evaluate
-import numpy as np
-from transformers import AutoModelForSequenceClassification, AutoTokenizer, TrainingArguments, Trainer, DataCollatorWithPadding
-from datasets import load_dataset
-from transformers import pipeline, Pipeline
+import subprocess
+import sys
+
+if TYPE_CHECKING:
+    from transformers import Pipeline
+
+
+TRAINING_SCRIPT_PATH = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), 'classifier_training.py')
+# Option of app.py that runs a training job, used by frozen builds
+TRAIN_JOB_OPTION = '--train_job'
+
+# Incremental runs replay at least this many previously trained pairs
+MIN_REPLAY_PAIRS = 200
+
+
+def get_training_command(job_file_path: str) -> list[str]:
+    """Command running classifier_training on the job file. In a frozen
+    build sys.executable is the server binary itself."""
+    if getattr(sys, 'frozen', False):
+        return [sys.executable, TRAIN_JOB_OPTION, job_file_path]
+    return [sys.executable, TRAINING_SCRIPT_PATH, job_file_path]
+
+
+def get_prediction(result) -> tuple[Union[str, None], float]:
+    """Return the label and score of a single text-classification result."""
+    if isinstance(result, list):
+        result = result[0] if result else None
+    if isinstance(result, dict) and 'label' in result:
+        return result['label'], float(result.get('score', 0.0))
+    return None, 0.0
 
 
 class CategorizedTask:
-    def __init__(self, rows: TransactionRows, categorizer_manager: 'CategorizerManager', master_csv_manager: MasterCSVManager):
+    def __init__(self, rows: TransactionRows, categorizer_manager: 'CategorizerManager', master_csv_manager: TransactionStorage):
         self.rows = rows
         self.categorizer_manager = categorizer_manager
         self.master_csv_manager = master_csv_manager
+        self.progress_reporter = None
+
+    def report_progress(self, **values):
+        if self.progress_reporter is not None:
+            self.progress_reporter(**values)
+
+    def size(self) -> int:
+        return len(self.rows)
+
+    def merge(self, other: 'CategorizedTask'):
+        """Take over the rows of another queued task so both share one
+        inference batch and one write."""
+        self.rows.extend(other.rows)
 
     def doWork(self):
         print("Start work on categorizing")
+        taxonomy = self.categorizer_manager.get_taxonomy()
+        prediction_cache = self.categorizer_manager.get_prediction_cache()
+        predictions: dict[str, tuple[Union[str, None], float]] = {}
+        unseen_names: dict[str, str] = {}
         for row in self.rows:
-            type_result = self.categorizer_manager.get_classifier()(
-                row['Name'])
-            type_label = None
-            if type_result and isinstance(type_result, list):
-                first_result = type_result[0]
-                if isinstance(first_result, dict) and 'label' in first_result:
-                    type_label = first_result['label']
+            name_key = normalize_name(row['Name'])
+            if name_key in predictions or name_key in unseen_names:
+                continue
+            cached_prediction = prediction_cache.get(row['Name'])
+            if cached_prediction is not None:
+                predictions[name_key] = cached_prediction
+            else:
+                unseen_names[name_key] = row['Name']
+        self.report_progress(rows_total=len(self.rows),
+                             names_total=len(unseen_names),
+                             names_classified=0, rows_categorized=0)
+
+        # The lexical tier keeps confident predictions, the transformer only
+        # sees the names it is unsure about
+        lexical_count = 0
+        lexical_classifier = self.categorizer_manager.get_lexical_classifier()
+        if unseen_names and lexical_classifier is not None:
+            threshold = self.categorizer_manager.get_lexical_threshold()
+            name_keys = list(unseen_names)
+            lexical_predictions = lexical_classifier.predict(
+                [unseen_names[name_key] for name_key in name_keys])
+            for name_key, (type_label, score) in zip(name_keys, lexical_predictions):
+                if score >= threshold and type_label in taxonomy.label_to_id:
+                    predictions[name_key] = (type_label, score)
+                    prediction_cache.put(unseen_names.pop(name_key), type_label, score)
+                    lexical_count += 1
+            self.report_progress(names_lexical=lexical_count,
+                                 names_classified=lexical_count)
+
+        embedding_index = self.categorizer_manager.get_embedding_index()
+        if unseen_names and embedding_index is not None:
+            name_keys = list(unseen_names)
+            neighbour_predictions = embedding_index.predict(
+                [unseen_names[name_key] for name_key in name_keys])
+            for name_key, (type_label, score) in zip(name_keys, neighbour_predictions):
+                predictions[name_key] = (type_label, score)
+                if type_label:
+                    prediction_cache.put(unseen_names[name_key], type_label, score)
+            self.report_progress(names_classified=lexical_count + len(name_keys))
+        elif unseen_names:
+            classifier = self.categorizer_manager.get_classifier()
+            batch_size = self.categorizer_manager.get_batch_size()
+            # Sorting by length groups similar sized names so batches need less padding
+            ordered_names = sorted(unseen_names.items(),
+                                   key=lambda item: len(item[1]))
+            for start in range(0, len(ordered_names), batch_size):
+                batch = ordered_names[start:start + batch_size]
+                batch_start = time.perf_counter()
+                results = classifier([name for _key, name in batch],
+                                     batch_size=batch_size, truncation=True)
+                batch_seconds = time.perf_counter() - batch_start
+                INFERENCE_BATCH_SECONDS.observe(batch_seconds)
+                if batch_seconds > 0:
+                    INFERENCE_ROWS_PER_SECOND.observe(len(batch) / batch_seconds)
+                for (name_key, name), result in zip(batch, results):
+                    type_label, score = get_prediction(result)
+                    predictions[name_key] = (type_label, score)
+                    if type_label:
+                        prediction_cache.put(name, type_label, score)
+                self.report_progress(
+                    names_classified=lexical_count + start + len(batch))
+        if unseen_names or lexical_count:
+            prediction_cache.save()
+        cached_count = len(predictions) - len(unseen_names) - lexical_count
+        print(f"Classified {len(unseen_names)} unique names with the model, "
+              f"{lexical_count} with the lexical tier, {cached_count} served from cache")
+        CATEGORIZED_NAMES.inc(len(unseen_names),
+                              'knn' if embedding_index is not None else 'model')
+        CATEGORIZED_NAMES.inc(lexical_count, 'lexical')
+        CATEGORIZED_NAMES.inc(cached_count, 'cache')
+
+        for row in self.rows:
+            type_label, _score = predictions[normalize_name(row['Name'])]
             category = "unknown"
             if (type_label):
-                category = self.categorizer_manager.get_category_from_subcategory(
-                    type_label)
+                category = taxonomy.get_category(type_label)
             row['Category'] = category
             row['Sub Category'] = type_label if type_label else "Unknown"
         self.master_csv_manager.update_rows_with_categories(
             updated_rows=self.rows)
+        self.report_progress(rows_categorized=len(self.rows))
         print("Finish work on categorizing")
 
 
+def compile_sub_category_edits(edits: list[dict]) -> SubCategoryChanges:
+    """Fold a batch of renames and deletes into one mapping from the original
+    sub-category to its final (category, sub-category).
+
+    Edits apply in order, so renaming A to B and then B to C moves rows of
+    both A and B to C. A category of None keeps the row's category.
+    """
+    changes: SubCategoryChanges = {}
+    for edit in edits:
+        if edit["type"] not in ('update', 'delete'):
+            continue
+        sub_category = edit["change"]["subCategory"]
+        # Every original whose rows currently carry this sub-category
+        originals = [original for original, (_category, current) in changes.items()
+                     if current == sub_category]
+        if sub_category not in changes:
+            originals.append(sub_category)
+        for original in originals:
+            if edit["type"] == 'update':
+                category = changes.get(original, (None, original))[0]
+                changes[original] = (category, edit["change"]["newName"])
+            else:
+                changes[original] = ("", "")
+    return {original: change for original, change in changes.items()
+            if change != (None, original)}
+
+
 class UpdateCategoriesTask:
-    def __init__(self, new_categories_updates: list[dict], category_file_path: str, lock: threading.Lock, master_csv_manager: MasterCSVManager, categorizer_manager: 'CategorizerManager'):
+    def __init__(self, new_categories_updates: list[dict], category_file_path: str, lock: TimedLock, master_csv_manager: TransactionStorage, categorizer_manager: 'CategorizerManager'):
         self.new_categories_updates = new_categories_updates
         self.category_file_path = category_file_path
         self.master_csv_manager = master_csv_manager
@@ -51,29 +200,24 @@ class UpdateCategoriesTask:
 
     def doWork(self):
         print("Start updating categories", self.new_categories_updates)
-        transactions = self.master_csv_manager.read_master_csv_dict()
-        updated_rows: TransactionRows = []
-        for edit in self.new_categories_updates:
-            for row in transactions:
-                if (edit["type"] == 'update' and
-                        edit["change"]["subCategory"] == row["Sub Category"]):
-                    row['Sub Category'] = edit["change"]["newName"]
-                    updated_rows.append(row)
-                elif (edit["type"] == 'delete' and
-                      edit["change"]["subCategory"] == row["Sub Category"]):
-                    row['Category'] = ""
-                    row['Sub Category'] = ""
-                    updated_rows.append(row)
-
-        self.master_csv_manager.update_rows_with_categories(
-            updated_rows=updated_rows)
+        sub_category_changes = compile_sub_category_edits(
+            self.new_categories_updates)
+        changed_rows = self.master_csv_manager.change_sub_categories(
+            sub_category_changes)
+        print(f"Updated {len(changed_rows)} transactions")
+        embedding_index = self.categorizer_manager.get_embedding_index()
+        if embedding_index is not None:
+            embedding_index.rename_labels(sub_category_changes)
+
+        # Cached predictions of renamed or deleted sub-categories are stale
+        stale_labels = {edit["change"]["subCategory"]
+                        for edit in self.new_categories_updates
+                        if edit["type"] in ('update', 'delete')}
+        self.categorizer_manager.get_prediction_cache().remove_labels(stale_labels)
 
         with self.lock:
-            # Read existing categories from file
-            categories = default_categories.copy()
-            if os.path.exists(self.category_file_path):
-                with open(self.category_file_path, 'r', encoding='utf-8') as f:
-                    categories = json.load(f)
+            # Apply the edits to a copy of the current snapshot and swap it in once
+            categories = self.categorizer_manager.get_taxonomy().to_dict()
 
             # Apply edits to categories
             for edit in self.new_categories_updates:
@@ -99,244 +243,552 @@ class UpdateCategoriesTask:
                     if sub_cat is not None and sub_cat not in categories[main_cat]:
                         categories[main_cat].append(sub_cat)
 
-            # Write updated categories back to file
-            with open(self.category_file_path, 'w', encoding='utf-8') as f:
+            # Write updated categories back to file, replaced whole since
+            # other server processes read it
+            temp_file_path = self.category_file_path + '.tmp'
+            with open(temp_file_path, 'w', encoding='utf-8') as f:
                 json.dump(categories, f, indent=4)
-                self.categorizer_manager.set_categories(categories)
+            os.replace(temp_file_path, self.category_file_path)
+            self.categorizer_manager.set_categories(categories)
         print("Finish updating categories")
 
 
 class TrainTask:
-    def __init__(self, categorizer_manager: 'CategorizerManager', master_csv_manager: MasterCSVManager, lock: threading.Lock):
+    def __init__(self, categorizer_manager: 'CategorizerManager', master_csv_manager: TransactionStorage, lock: TimedLock):
         self.categorizer_manager = categorizer_manager
         self.master_csv_manager = master_csv_manager
         self.lock = lock
+        self.progress_reporter = None
+        self.process: Union[subprocess.Popen, None] = None
+
+    def report_progress(self, **values):
+        if self.progress_reporter is not None:
+            self.progress_reporter(**values)
+
+    def terminate(self):
+        """Stop a running training process, the current model stays in use."""
+        process = self.process
+        if process is not None and process.poll() is None:
+            process.terminate()
+
+    def run_training_process(self, job: dict):
+        """Run classifier_training on the job in its own process and relay its progress."""
+        job_file_path = os.path.join(
+            self.categorizer_manager.get_training_file_path(), 'job.json')
+        os.makedirs(os.path.dirname(job_file_path), exist_ok=True)
+        with open(job_file_path, 'w', encoding='utf-8') as f:
+            json.dump(job, f)
+        self.process = subprocess.Popen(
+            get_training_command(job_file_path),
+            stdout=subprocess.PIPE, text=True, encoding='utf-8')
+        assert self.process.stdout is not None
+        for line in self.process.stdout:
+            if not line.startswith(PROGRESS_PREFIX):
+                print(line, end='')
+                continue
+            progress = json.loads(line[len(PROGRESS_PREFIX):])
+            step_seconds = progress.pop('step_seconds', None)
+            if step_seconds is not None:
+                TRAIN_STEP_SECONDS.observe(step_seconds)
+            self.report_progress(**progress)
+        return_code = self.process.wait()
+        if return_code != 0:
+            raise RuntimeError(f"Training process exited with code {return_code}")
 
     def doWork(self):
         print("Start work on training")
-        dataset = load_dataset("csv", data_files={
-                               "train": self.master_csv_manager.get_master_file_path()}, keep_in_memory=True)
-        dataset = dataset.rename_column("Name", "text")
-        dataset = dataset.rename_column("Sub Category", "label")
-        dataset = dataset.map(remove_columns=[
-            'Date', 'Transaction',
-            'Memo', 'Amount', 'Category',
-        ])
-
-        tokenizer = AutoTokenizer.from_pretrained(
-            "distilbert/distilbert-base-uncased")
-
-        def preprocess_function(examples):
-            return tokenizer(examples["text"], truncation=True)
-
-        tokenized_imdb = dataset.map(preprocess_function, batched=True)
-
-        data_collator = DataCollatorWithPadding(tokenizer=tokenizer)
-
-        accuracy = evaluate.load("accuracy")
-
-        label_to_id = self.categorizer_manager.get_label_to_id()
-        id_to_label = self.categorizer_manager.get_id_to_label()
-        all_sub_categories = self.categorizer_manager.get_all_sub_categories()
-
-        def encode_labels(example):
-            example['label'] = label_to_id[example['label']]
-            return example
-
-        tokenized_imdb = tokenized_imdb.map(encode_labels)
-
-        def compute_metrics(eval_pred):
-            predictions, labels = eval_pred
-            predictions = np.argmax(predictions, axis=1)
-            return accuracy.compute(predictions=predictions, references=labels)
-
-        small_train_dataset = tokenized_imdb["train"].shuffle(seed=42)
-        small_eval_dataset = tokenized_imdb["train"].shuffle(
-            seed=42).select(range(min(100, len(tokenized_imdb["train"]))))
-
-        model = AutoModelForSequenceClassification.from_pretrained(
-            "distilbert/distilbert-base-uncased", num_labels=len(all_sub_categories), id2label=id_to_label, label2id=label_to_id
-        )
+        taxonomy = self.categorizer_manager.get_taxonomy()
+        model_registry = self.categorizer_manager.get_model_registry()
+        current_model_path = model_registry.get_current_path()
+        training_history = self.categorizer_manager.get_training_history()
+
+        # Read through the storage engine so training works for every backend,
+        # rows without a known sub-category have nothing to learn from
+        pairs = get_training_pairs(
+            self.master_csv_manager.read_master_csv_dict(), taxonomy.labels)
+        if not pairs:
+            print("No categorized transactions to train on")
+            return
 
+        # The lexical tier trains in seconds on every pair, so it is ready
+        # long before the transformer
+        self.categorizer_manager.train_lexical_classifier(pairs)
+
+        warm_start = self.categorizer_manager.get_train_mode() == 'incremental' \
+            and os.path.exists(current_model_path)
+        if warm_start:
+            training_history.load(current_model_path)
+            new_pairs, replay_pairs = training_history.select_incremental(
+                pairs, self.categorizer_manager.get_replay_ratio(), MIN_REPLAY_PAIRS)
+            if not new_pairs:
+                print("No transactions labeled since the last training run")
+                return
+            training_pairs = new_pairs + replay_pairs
+        else:
+            new_pairs, replay_pairs = pairs, []
+            training_pairs = pairs
+        print(f"Training on {len(new_pairs)} new and {len(replay_pairs)} replayed "
+              f"pairs, {'warm-started' if warm_start else 'from the base model'}")
+        self.report_progress(training_rows=len(training_pairs),
+                             new_pairs=len(new_pairs),
+                             replay_pairs=len(replay_pairs),
+                             warm_start=warm_start)
+
+        version_path = model_registry.new_version_path()
+        validation_file_path = os.path.join(
+            self.categorizer_manager.get_training_file_path(), 'validation_pairs.json')
+        if os.path.exists(validation_file_path):
+            os.remove(validation_file_path)
+        self.run_training_process({
+            'pairs': training_pairs,
+            'label_to_id': dict(taxonomy.label_to_id),
+            'id_to_label': dict(taxonomy.id_to_label),
+            'warm_start_path': current_model_path if warm_start else None,
+            'base_model_path': model_registry.get_base_model_path(),
+            'output_dir': version_path,
+            'checkpoint_dir': self.categorizer_manager.get_training_file_path(),
+            'validation_file_path': validation_file_path,
+        })
+        # Every current pair is now known to the model, directly or from an
+        # earlier run, but those held out for validation, which count as new
+        # in the next incremental run
+        validation_pairs: set[TrainingPair] = set()
+        if os.path.exists(validation_file_path):
+            with open(validation_file_path, 'r', encoding='utf-8') as f:
+                validation_pairs = {(text, label) for text, label in json.load(f)}
+        training_history.save(
+            version_path, [pair for pair in pairs if pair not in validation_pairs])
+
+        # The old model keeps serving while the new one loads, only the swap is locked
+        classifier = self.categorizer_manager.load_classifier(version_path)
         with self.lock:
-            training_args = TrainingArguments(
-                output_dir=self.categorizer_manager.get_training_file_path(),
-                learning_rate=2e-5,
-                per_device_train_batch_size=16,
-                per_device_eval_batch_size=16,
-                num_train_epochs=15,
-                weight_decay=0.01,
-                eval_strategy="epoch",
-                save_strategy="epoch",
-            )
-
-            trainer = Trainer(
-                model=model,
-                args=training_args,
-                train_dataset=small_train_dataset,
-                eval_dataset=small_eval_dataset,
-                tokenizer=tokenizer,
-                data_collator=data_collator,
-                compute_metrics=compute_metrics,
-            )
-
-            trainer.train()
-            trainer.save_model(self.categorizer_manager.get_model_file_path())
-
-            classifier = pipeline("text-classification",
-                                      model=self.categorizer_manager.get_model_file_path())
-            self.categorizer_manager.set_classifier(classifier)            
+            model_registry.set_current(version_path)
+            self.categorizer_manager.get_prediction_cache().clear()
+            self.categorizer_manager.set_classifier(classifier)
+            self.categorizer_manager.set_model_error(None)
+        model_registry.prune()
 
         print("Finish work on training")
 
 
 class InitializedCategorizerManager:
-    def __init__(self, categorizer_manager: 'CategorizerManager', data_folder: str, lock: threading.Lock):
+    """Loads what is cheap to load, the taxonomy, the prediction cache and
+    the lexical tier, so the server is initialized within seconds. The
+    transformer loads afterwards in a LoadModelTask."""
+
+    def __init__(self, categorizer_manager: 'CategorizerManager', data_folder: str, lock: TimedLock):
         self.categorizer_manager = categorizer_manager
         self.data_folder = data_folder
         self.lock = lock
 
     def doWork(self):
         print("Initializing categorizer manager...")
-        model_folder = self.categorizer_manager.get_model_file_path()
-        categories: CategoriesDict = {}
-        with self.lock:
-            if os.path.exists(self.categorizer_manager.get_category_file_path()):
-                with open(self.categorizer_manager.get_category_file_path(), 'r', encoding='utf-8') as f:
-                    categories = json.load(f)
-            else:
-                categories = default_categories
+        try:
+            categories: CategoriesDict = {}
+            with self.lock:
+                if os.path.exists(self.categorizer_manager.get_category_file_path()):
+                    with open(self.categorizer_manager.get_category_file_path(), 'r', encoding='utf-8') as f:
+                        categories = json.load(f)
+                else:
+                    categories = default_categories
 
-            self.categorizer_manager.set_categories(categories)
-            if not os.path.exists(self.categorizer_manager.get_model_file_path()):
-                all_categories = list(chain.from_iterable(
-                    [category_types for _category, category_types in categories.items()]))
-                label_to_id = {label: i for i,
-                               label in enumerate(all_categories)}
-                id_to_label = {i: label for i,
-                               label in enumerate(all_categories)}
+                self.categorizer_manager.set_categories(categories)
+                prediction_cache = self.categorizer_manager.get_prediction_cache()
+                prediction_cache.load()
+
+            lexical_classifier = LexicalClassifier.load(
+                self.categorizer_manager.get_lexical_model_file_path())
+            if lexical_classifier is not None:
+                self.categorizer_manager.set_lexical_classifier(lexical_classifier)
+        except Exception as e:
+            # No model loads without a taxonomy, held categorization fails
+            # with the error instead of waiting for it forever
+            self.categorizer_manager.set_model_error(f"Initialization failed: {e}")
+            self.categorizer_manager.set_model_ready()
+            raise
+        finally:
+            # Release waiting tasks even if loading failed, they report the error
+            self.categorizer_manager.set_initialized()
+        self.categorizer_manager.add_load_model_task()
+        print("Categorizer Manager is initialized and ready to use.")
+
+
+class LoadModelTask:
+    """Imports the ML libraries and loads the classifier in the background.
+    Categorization waits for it, so rows uploaded meanwhile stay queued."""
+
+    def __init__(self, categorizer_manager: 'CategorizerManager', lock: TimedLock):
+        self.categorizer_manager = categorizer_manager
+        self.lock = lock
+
+    def doWork(self):
+        print("Loading the classifier model...")
+        try:
+            if self.categorizer_manager.get_lexical_classifier() is None:
+                self.categorizer_manager.train_lexical_classifier(get_training_pairs(
+                    self.categorizer_manager.get_master_csv_manager().read_master_csv_dict(),
+                    self.categorizer_manager.get_taxonomy().labels))
+
+            embedding_index = self.categorizer_manager.get_embedding_index()
+            if embedding_index is not None:
+                embedding_index.embedder.set_model_path(
+                    self.categorizer_manager.get_model_registry().get_base_model_path())
+                if not embedding_index.load():
+                    # Seed the neighbours with every categorized transaction
+                    embedding_index.set_labels(
+                        get_training_pairs(
+                            self.categorizer_manager.get_master_csv_manager().read_master_csv_dict(),
+                            self.categorizer_manager.get_taxonomy().labels))
+                # knn mode has no classifier, the embedder loads on first use
+                return
+
+            model_folder = self.categorizer_manager.get_model_file_path()
+            if not os.path.exists(model_folder):
+                from transformers import AutoModelForSequenceClassification, pipeline
+
+                # An untrained head is created fresh, so earlier predictions do not apply
+                taxonomy = self.categorizer_manager.get_taxonomy()
+                base_model_path = self.categorizer_manager.get_model_registry().get_base_model_path()
                 model = AutoModelForSequenceClassification.from_pretrained(
-                    "distilbert/distilbert-base-uncased", num_labels=len(all_categories), id2label=id_to_label, label2id=label_to_id
+                    base_model_path, num_labels=len(taxonomy.labels), id2label=dict(taxonomy.id_to_label), label2id=dict(taxonomy.label_to_id),
+                    local_files_only=True
                 )
                 classifier = pipeline("text-classification",
-                                      model=model, tokenizer="distilbert/distilbert-base-uncased")
-                self.categorizer_manager.set_classifier(classifier)
+                                      model=model, tokenizer=base_model_path)
+                with self.lock:
+                    self.categorizer_manager.get_prediction_cache().clear()
+                    self.categorizer_manager.set_classifier(classifier)
             else:
-                classifier = pipeline("text-classification",
-                                      model=model_folder)
-                self.categorizer_manager.set_classifier(classifier)
-        print("Categorizer Manager is initialized and ready to use.")
+                classifier = self.categorizer_manager.load_classifier(model_folder)
+                with self.lock:
+                    self.categorizer_manager.set_classifier(classifier)
+        except Exception as e:
+            self.categorizer_manager.set_model_error(str(e))
+            raise
+        finally:
+            # Held categorization fails with the error rather than waiting forever
+            self.categorizer_manager.set_model_ready()
+        print("Classifier model is loaded.")
 
 
 class CategorizerManager:
-    def __init__(self, master_csv_manager: MasterCSVManager, data_folder: str):
-        self.queue = queue.Queue()
-
+    def __init__(self, master_csv_manager: TransactionStorage, data_folder: str, batch_size: int = 32,
+                 interactive_workers: int = 1, background_workers: int = 1,
+                 max_categorize_rows: int = 20000, max_categorize_wait: float = 0.25,
+                 train_mode: str = 'incremental', replay_ratio: float = 1.0,
+                 inference_backend: str = 'pytorch', lexical_threshold: float = 0.9,
+                 categorize_mode: str = 'finetune', knn_k: int = 5,
+                 offline: bool = False):
+        if offline:
+            set_offline()
         self.master_csv_manager = master_csv_manager
-        self.consumer_thread = threading.Thread(
-            target=self.categorized_consumer, args=(self.queue,))
-        self.consumer_thread.daemon = True
-        self.consumer_thread.start()
         self.data_folder = data_folder
         self.category_file_path = os.path.join(
             data_folder, 'category_data.json')
-        self.model_file_path = os.path.join(
-            data_folder, 'classifier_model')
+        self.model_registry = ModelRegistry(data_folder)
         self.training_file_path = os.path.join(
             data_folder, 'training_file_path')
-        self.categories: Union[CategoriesDict, None] = None
-        self.classifier: Union[Pipeline, None] = None
-        self.lock = threading.Lock()
+        self.prediction_cache = PredictionCache(os.path.join(
+            data_folder, 'prediction_cache.json'))
+        self.training_history = TrainingHistory()
+        self.train_task: Union[ScheduledTask, None] = None
+        self.train_mode = train_mode
+        self.replay_ratio = replay_ratio
+        self.inference_backend = inference_backend
+        self.lexical_model_file_path = os.path.join(
+            data_folder, 'lexical_model.joblib')
+        self.lexical_classifier: Union[LexicalClassifier, None] = None
+        self.lexical_threshold = lexical_threshold
+        # In knn mode names are categorized by their nearest labeled names
+        self.embedding_index: Union[EmbeddingIndex, None] = None
+        if categorize_mode == 'knn':
+            self.embedding_index = EmbeddingIndex(
+                data_folder, NameEmbedder(batch_size=batch_size), k=knn_k)
+        self.taxonomy: Union[CategoryTaxonomy, None] = None
+        self.taxonomy_versions = itertools.count(1)
+        self.classifier: Union['Pipeline', None] = None
+        self.lock = TimedLock('categorizer')
         self.has_queue_initialized_task = False
-
-    def add_categorized_task(self, rows: TransactionRows):
+        self.batch_size = batch_size
+        # Set once initialization finishes, other tasks wait for it
+        self.initialized_event = threading.Event()
+        # Set once the classifier is loaded, categorization waits for it
+        self.model_ready_event = threading.Event()
+        self.model_error: Union[str, None] = None
+        self.scheduler = TaskScheduler({
+            INTERACTIVE_LANE: interactive_workers,
+            BACKGROUND_LANE: background_workers,
+        }, self.initialized_event, max_coalesce_size=max_categorize_rows,
+            max_coalesce_wait=max_categorize_wait)
+
+    def add_categorized_task(self, rows: TransactionRows,
+                             task_id: Union[str, None] = None) -> ScheduledTask:
         task = CategorizedTask(rows, self, self.master_csv_manager)
-        self.queue.put(task, block=False)
+        return self.scheduler.submit(task, 'categorize', INTERACTIVE_LANE,
+                                     PRIORITY_INTERACTIVE, coalesce_key='categorize',
+                                     wait_for=self.model_ready_event, task_id=task_id)
 
-    def add_train_task(self):
+    def add_train_task(self, task_id: Union[str, None] = None) -> ScheduledTask:
         task = TrainTask(self,
                          self.master_csv_manager, self.lock)
-        self.queue.put(task, block=False)
+        # A queued training run is replaced, the newer one sees more labels
+        self.train_task = self.scheduler.submit(
+            task, 'train', BACKGROUND_LANE, PRIORITY_TRAIN, supersede_key='train',
+            task_id=task_id)
+        return self.train_task
+
+    def submit_spooled(self, spool_id: str, kind: str, payload) -> Union[ScheduledTask, None]:
+        """Queue work spooled by another server process under its spool id."""
+        if kind == 'categorize':
+            return self.add_categorized_task(payload, task_id=spool_id)
+        if kind == 'train':
+            return self.add_train_task(task_id=spool_id)
+        if kind == 'update_categories':
+            return self.update_categories(payload, task_id=spool_id)
+        if kind == 'label_corrections':
+            self.add_label_corrections(payload)
+        return None
 
     def add_initialized_task(self):
         if (self.has_queue_initialized_task):
             return
         task = InitializedCategorizerManager(
             self, self.data_folder, self.lock)
-        self.queue.put(task, block=False)
+        self.scheduler.submit(task, 'initialize', INTERACTIVE_LANE,
+                              PRIORITY_INITIALIZE, wait_for_ready=False)
         self.has_queue_initialized_task = True
 
+    def add_load_model_task(self):
+        # The background lane keeps category edits responsive while the model loads
+        self.scheduler.submit(LoadModelTask(self, self.lock), 'load_model',
+                              BACKGROUND_LANE, PRIORITY_INITIALIZE)
+
+    def set_initialized(self):
+        self.scheduler.notify_ready()
+
+    def set_model_ready(self):
+        self.scheduler.notify_ready(self.model_ready_event)
+
+    def set_model_error(self, model_error: Union[str, None]):
+        self.model_error = model_error
+
+    def get_readiness(self) -> dict:
+        """Whether the categorizer can serve, for the readiness probe."""
+        taxonomy = self.taxonomy
+        return {
+            'initialized': self.initialized_event.is_set(),
+            'model_ready': self.model_ready_event.is_set() and self.model_error is None,
+            'model_error': self.model_error,
+            'model_version': self.model_registry.get_current_version(),
+            'taxonomy_version': taxonomy.version if taxonomy is not None else None,
+            'held_rows': self.scheduler.get_queued_size('categorize'),
+        }
+
+    def cancel_task(self, scheduled_task: ScheduledTask) -> bool:
+        return self.scheduler.cancel(scheduled_task)
+
+    def get_scheduler(self) -> TaskScheduler:
+        return self.scheduler
+
+    def get_master_csv_manager(self) -> TransactionStorage:
+        return self.master_csv_manager
+
     def get_category_file_path(self) -> str:
         return self.category_file_path
 
     def get_model_file_path(self) -> str:
-        return self.model_file_path
+        return self.model_registry.get_current_path()
+
+    def get_model_registry(self) -> ModelRegistry:
+        return self.model_registry
 
     def get_training_file_path(self) -> str:
         return self.training_file_path
 
-    def get_categories(self):
-        return self.categories
+    def get_batch_size(self) -> int:
+        return self.batch_size
+
+    def get_training_history(self) -> TrainingHistory:
+        return self.training_history
+
+    def get_train_mode(self) -> str:
+        return self.train_mode
+
+    def get_replay_ratio(self) -> float:
+        return self.replay_ratio
+
+    def get_prediction_cache(self) -> PredictionCache:
+        return self.prediction_cache
+
+    def get_categories(self) -> Union[CategoriesDict, None]:
+        if self.taxonomy is None:
+            return None
+        return self.taxonomy.to_dict()
 
     def set_categories(self, categories: CategoriesDict):
-        self.categories = categories
+        # Tasks hold on to the snapshot they started with, replacing the
+        # reference is the only mutation so readers never see a partial update
+        self.taxonomy = CategoryTaxonomy(
+            categories, next(self.taxonomy_versions))
+
+    def get_taxonomy(self) -> CategoryTaxonomy:
+        taxonomy = self.taxonomy
+        if taxonomy is None:
+            raise ValueError("Categories not set")
+        return taxonomy
 
-    def get_classifier(self) -> Pipeline:
+    def get_classifier(self) -> 'Pipeline':
         if self.classifier is None:
             raise ValueError("Classifier not set")
         return self.classifier
 
     def get_category_from_subcategory(self, sub_category: str) -> str:
-        if self.categories is None:
-            raise ValueError("Categories not set")
-        type_to_category = {
-            value: key for key, values in self.categories.items() for value in values
-        }
-        return type_to_category.get(sub_category, "Unknown")
+        return self.get_taxonomy().get_category(sub_category)
 
     def get_label_to_id(self) -> dict[str, int]:
-        if self.categories is None:
-            raise ValueError("Categories not set")
-        all_categories = list(chain.from_iterable(
-            [category_types for _category, category_types in self.categories.items()]))
-        return {label: i for i, label in enumerate(all_categories)}
+        return dict(self.get_taxonomy().label_to_id)
 
     def get_id_to_label(self) -> dict[int, str]:
-        if self.categories is None:
-            raise ValueError("Categories not set")
-        all_categories = list(chain.from_iterable(
-            [category_types for _category, category_types in self.categories.items()]))
-        return {i: label for i, label in enumerate(all_categories)}
+        return dict(self.get_taxonomy().id_to_label)
 
     def get_all_sub_categories(self) -> list[str]:
-        if self.categories is None:
-            raise ValueError("Categories not set")
-        all_sub_categories = list(chain.from_iterable(
-            [category_types for _category, category_types in self.categories.items()]))
-        return all_sub_categories
+        return list(self.get_taxonomy().labels)
 
-    def set_classifier(self, classifier: Pipeline):
+    def set_classifier(self, classifier: 'Pipeline'):
         self.classifier = classifier
 
-    def update_categories(self, new_categories):
-        self.queue.put(UpdateCategoriesTask(
-            new_categories, self.category_file_path, self.lock, self.master_csv_manager, self), block=False)
-        return True
-
-    def categorized_consumer(self, queue):
-        print('Consumer: Running')
-        while True:
-            item = queue.get()
-            if item is None:
-                queue.task_done()
-                break
-            categorized_task = cast(CategorizedTask, item)
-            categorized_task.doWork()
-            queue.task_done()
-        print('Consumer: Done')
+    def get_lexical_model_file_path(self) -> str:
+        return self.lexical_model_file_path
+
+    def get_lexical_classifier(self) -> Union[LexicalClassifier, None]:
+        return self.lexical_classifier
+
+    def set_lexical_classifier(self, lexical_classifier: Union[LexicalClassifier, None]):
+        self.lexical_classifier = lexical_classifier
+
+    def get_lexical_threshold(self) -> float:
+        return self.lexical_threshold
+
+    def get_embedding_index(self) -> Union[EmbeddingIndex, None]:
+        return self.embedding_index
+
+    def add_label_corrections(self, rows: TransactionRows):
+        """Use rows the user recategorized as neighbours right away, in knn mode."""
+        if self.embedding_index is None or not rows:
+            return
+        self.embedding_index.set_labels(
+            (row['Name'], row['Sub Category']) for row in rows)
+        # Cached predictions may have come from neighbours that just changed
+        self.prediction_cache.clear()
+
+    def train_lexical_classifier(self, pairs: list[TrainingPair]):
+        """Fit, save and swap in the lexical tier, cached predictions made
+        with the previous tiers are dropped."""
+        lexical_classifier = LexicalClassifier.fit(pairs)
+        if lexical_classifier is None:
+            return
+        lexical_classifier.save(self.lexical_model_file_path)
+        with self.lock:
+            self.set_lexical_classifier(lexical_classifier)
+            self.prediction_cache.clear()
+        print(f"Trained the lexical classifier on {len(pairs)} pairs")
+
+    def load_classifier(self, model_path: str):
+        """Build the classifier of a saved model with the configured backend."""
+        if self.inference_backend == 'onnx':
+            from onnx_classifier import OnnxTextClassifier, export_onnx_model
+            return OnnxTextClassifier(export_onnx_model(model_path))
+        from transformers import AutoTokenizer, pipeline
+        return pipeline("text-classification", model=load_mmap_model(model_path),
+                        tokenizer=AutoTokenizer.from_pretrained(model_path, local_files_only=True))
+
+    def update_categories(self, new_categories,
+                          task_id: Union[str, None] = None) -> ScheduledTask:
+        return self.scheduler.submit(UpdateCategoriesTask(
+            new_categories, self.category_file_path, self.lock, self.master_csv_manager, self),
+            'update_categories', INTERACTIVE_LANE, PRIORITY_INTERACTIVE, task_id=task_id)
+
+    def stop(self):
+        # A training run would hold up shutdown, the current model stays in use
+        train_task = self.train_task
+        if train_task is not None:
+            self.scheduler.cancel(train_task)
+            train_task.task.terminate()
+        self.scheduler.stop()
+
+
+class SpooledTask:
+    """A task handed to the categorization process, only its id is known here."""
+
+    def __init__(self, task_id: str):
+        self.task_id = task_id
+
+
+class SpooledCategorizer:
+    """Stands in for the CategorizerManager in server processes that do not
+    run background work. Tasks are spooled to the one process that does,
+    which runs them under the returned task ids and publishes their state
+    to the status store, and categories are read from the category file it
+    maintains."""
+
+    def __init__(self, data_folder: str, spool: TaskSpool, status_store: TaskStatusStore):
+        self.spool = spool
+        self.status_store = status_store
+        self.category_file_path = os.path.join(data_folder, 'category_data.json')
+        self.model_registry = ModelRegistry(data_folder)
+        self.categories: Union[CategoriesDict, None] = None
+        self.categories_mtime: Union[int, None] = None
+
+    def spool_task(self, kind: str, name: str, lane: str, priority: int, payload) -> SpooledTask:
+        task_id = self.spool.put(kind, payload)
+        # Until the categorization process picks it up the task is queued
+        self.status_store.write(task_id, {
+            'id': task_id, 'name': name, 'lane': lane, 'priority': priority,
+            'state': QUEUED, 'queue_position': None, 'merged_into': None,
+            'merged_tasks': [], 'progress': {}, 'error': None,
+            'submitted_at': time.time(), 'started_at': None, 'finished_at': None,
+            'wait_seconds': 0.0, 'run_seconds': None, 'updated': 0,
+        })
+        return SpooledTask(task_id)
+
+    def add_categorized_task(self, rows: TransactionRows) -> SpooledTask:
+        return self.spool_task('categorize', 'categorize', INTERACTIVE_LANE,
+                               PRIORITY_INTERACTIVE, rows)
+
+    def add_train_task(self) -> SpooledTask:
+        return self.spool_task('train', 'train', BACKGROUND_LANE, PRIORITY_TRAIN, None)
+
+    def update_categories(self, new_categories) -> SpooledTask:
+        return self.spool_task('update_categories', 'update_categories', INTERACTIVE_LANE,
+                               PRIORITY_INTERACTIVE, new_categories)
+
+    def add_label_corrections(self, rows: TransactionRows):
+        if rows:
+            self.spool.put('label_corrections', rows)
+
+    def get_categories(self) -> Union[CategoriesDict, None]:
+        if not os.path.exists(self.category_file_path):
+            return json.loads(json.dumps(default_categories))
+        mtime = os.stat(self.category_file_path).st_mtime_ns
+        if mtime != self.categories_mtime:
+            with open(self.category_file_path, 'r', encoding='utf-8') as f:
+                self.categories = json.load(f)
+            self.categories_mtime = mtime
+        return self.categories
+
+    def get_readiness(self) -> dict:
+        # The model is not loaded in this process, model_ready None says so
+        return {
+            'initialized': True,
+            'model_ready': None,
+            'model_error': None,
+            'model_version': self.model_registry.get_current_version(),
+            'taxonomy_version': None,
+            'held_rows': None,
+        }
+
+    def get_scheduler(self) -> None:
+        return None
 
     def stop(self):
-        self.queue.join()
-        self.queue.put(None)
-        self.consumer_thread.join()
-        self.queue.join()
+        pass
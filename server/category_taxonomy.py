@@ -0,0 +1,50 @@
+from types import MappingProxyType
+from typing import Mapping
+from categorizer_constants import CategoriesDict
+
+
+class CategoryTaxonomy:
+    """Immutable, compiled view of a categories dict.
+
+    All label maps are built once so lookups during inference and training
+    are O(1). Tasks take one snapshot and use it throughout, a newer version
+    is swapped in by CategorizerManager.set_categories.
+    """
+
+    __slots__ = ('version', 'categories', 'labels', 'label_to_id',
+                 'id_to_label', 'sub_category_to_category')
+
+    version: int
+    categories: Mapping[str, tuple[str, ...]]
+    labels: tuple[str, ...]
+    label_to_id: Mapping[str, int]
+    id_to_label: Mapping[int, str]
+    sub_category_to_category: Mapping[str, str]
+
+    def __init__(self, categories: CategoriesDict, version: int):
+        compiled = {category: tuple(sub_categories)
+                    for category, sub_categories in categories.items()}
+        labels = tuple(sub_category for sub_categories in compiled.values()
+                       for sub_category in sub_categories)
+        set_attribute = super().__setattr__
+        set_attribute('version', version)
+        set_attribute('categories', MappingProxyType(compiled))
+        set_attribute('labels', labels)
+        set_attribute('label_to_id', MappingProxyType(
+            {label: i for i, label in enumerate(labels)}))
+        set_attribute('id_to_label', MappingProxyType(
+            {i: label for i, label in enumerate(labels)}))
+        set_attribute('sub_category_to_category', MappingProxyType(
+            {sub_category: category for category, sub_categories in compiled.items()
+             for sub_category in sub_categories}))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("CategoryTaxonomy is immutable")
+
+    def get_category(self, sub_category: str) -> str:
+        return self.sub_category_to_category.get(sub_category, "Unknown")
+
+    def to_dict(self) -> CategoriesDict:
+        """Return a mutable copy of the categories."""
+        return {category: list(sub_categories)
+                for category, sub_categories in self.categories.items()}
@@ -0,0 +1,204 @@
+"""Fine-tunes the transaction classifier in its own process.
+
+The server writes a job file and runs this script with it, training never
+shares the GIL or the CPU scheduler with request handling. Progress is
+written to stdout as lines starting with PROGRESS_PREFIX followed by JSON.
+
+    python classifier_training.py <job.json>
+
+Frozen builds have no interpreter to run this script with, there the
+server binary runs it as app --train_job <job.json>.
+"""
+import json
+import sys
+import time
+from typing import Union
+from collections import Counter
+from datasets import ClassLabel, Dataset, DatasetDict
+import numpy as np
+import torch
+from transformers import AutoModelForSequenceClassification, AutoTokenizer, TrainingArguments, Trainer, DataCollatorWithPadding, TrainerCallback, EarlyStoppingCallback
+from training_history import PROGRESS_PREFIX
+
+
+# Training stops earlier once accuracy stops improving for this many epochs
+MAX_TRAIN_EPOCHS = 15
+EARLY_STOPPING_PATIENCE = 2
+# Share of the pairs held out to measure accuracy on, at most MAX_VALIDATION_ROWS
+VALIDATION_FRACTION = 0.1
+MAX_VALIDATION_ROWS = 1000
+
+
+def report_progress(**values):
+    print(PROGRESS_PREFIX + json.dumps(values), flush=True)
+
+
+def resize_classification_head(model, label_to_id: dict[str, int], id_to_label: dict[int, str]):
+    """Map a saved model's classification head onto the current labels.
+
+    Rows of labels the model already knows are copied to their new ids, so
+    renumbered labels keep what they learned. Labels added since the model
+    was trained get freshly initialized rows.
+    """
+    old_label_to_id = {label: int(label_id)
+                       for label, label_id in model.config.label2id.items()}
+    old_head = model.classifier
+    new_head = torch.nn.Linear(old_head.in_features, len(label_to_id))
+    new_head.weight.data.normal_(mean=0.0, std=model.config.initializer_range)
+    new_head.bias.data.zero_()
+    with torch.no_grad():
+        for label, label_id in label_to_id.items():
+            old_id = old_label_to_id.get(label)
+            if old_id is not None and old_id < old_head.out_features:
+                new_head.weight[label_id] = old_head.weight[old_id]
+                new_head.bias[label_id] = old_head.bias[old_id]
+    model.classifier = new_head
+    model.num_labels = len(label_to_id)
+    model.config.num_labels = len(label_to_id)
+    model.config.id2label = dict(id_to_label)
+    model.config.label2id = dict(label_to_id)
+    new_labels = [label for label in label_to_id if label not in old_label_to_id]
+    if new_labels:
+        print(f"Added {len(new_labels)} labels to the classification head")
+
+
+class TrainProgressCallback(TrainerCallback):
+    """Reports the epoch, step, step time and evaluation accuracy of a training run."""
+
+    def __init__(self):
+        self.step_start = 0.0
+
+    def on_step_begin(self, args, state, control, **kwargs):
+        self.step_start = time.perf_counter()
+
+    def on_step_end(self, args, state, control, **kwargs):
+        report_progress(
+            epoch=state.epoch, step=state.global_step, total_steps=state.max_steps,
+            step_seconds=time.perf_counter() - self.step_start)
+
+    def on_evaluate(self, args, state, control, metrics=None, **kwargs):
+        if metrics and 'eval_accuracy' in metrics:
+            report_progress(eval_accuracy=metrics['eval_accuracy'])
+
+
+def split_validation(dataset: Dataset, num_labels: int) -> tuple[Dataset, Union[Dataset, None]]:
+    """Hold out a validation split with every label in the same proportion
+    as in training. Returns no split when a label has a single row or the
+    split would leave a label out of training, early stopping then has
+    nothing trustworthy to measure."""
+    label_counts = Counter(dataset["label"])
+    validation_rows = min(max(int(len(dataset) * VALIDATION_FRACTION), len(label_counts)),
+                          MAX_VALIDATION_ROWS)
+    if min(label_counts.values(), default=0) < 2 \
+            or len(dataset) - validation_rows < len(label_counts):
+        return dataset, None
+    dataset = dataset.cast_column("label", ClassLabel(num_classes=num_labels))
+    split = dataset.train_test_split(
+        test_size=validation_rows, stratify_by_column="label", seed=42)
+    return split["train"], split["test"]
+
+
+def train_classifier(job: dict):
+    """Fine-tune on the job's (text, label) pairs and save the model to its output_dir.
+
+    The job holds pairs, label_to_id, id_to_label, output_dir,
+    checkpoint_dir, base_model_path, the stored base model,
+    warm_start_path, the saved model to continue from or None to start
+    from the base model, and validation_file_path, where the pairs held
+    out of training are written. Models are only read from local folders.
+    """
+    label_to_id: dict[str, int] = job['label_to_id']
+    id_to_label = {int(label_id): label
+                   for label_id, label in job['id_to_label'].items()}
+    warm_start_path = job['warm_start_path']
+    base_model_path = job['base_model_path']
+
+    dataset = DatasetDict({"train": Dataset.from_list(
+        [{"text": text, "label": label_to_id[label]}
+         for text, label in job['pairs']])})
+
+    tokenizer = AutoTokenizer.from_pretrained(warm_start_path or base_model_path,
+                                              local_files_only=True)
+
+    def preprocess_function(examples):
+        return tokenizer(examples["text"], truncation=True)
+
+    tokenized_imdb = dataset.map(preprocess_function, batched=True)
+
+    data_collator = DataCollatorWithPadding(tokenizer=tokenizer)
+
+    # Computed here, evaluate.load would fetch the metric from the hub
+    def compute_metrics(eval_pred):
+        predictions, labels = eval_pred
+        predictions = np.argmax(predictions, axis=1)
+        return {"accuracy": float(np.mean(predictions == labels))}
+
+    # The validation rows are never trained on, so accuracy on them shows
+    # when further epochs stop generalizing
+    small_train_dataset, small_eval_dataset = split_validation(
+        tokenized_imdb["train"], len(label_to_id))
+    small_train_dataset = small_train_dataset.shuffle(seed=42)
+    early_stopping = small_eval_dataset is not None
+    # The server leaves these out of the training history, so they are
+    # trained on in a later run
+    validation_pairs = [[text, id_to_label[label_id]] for text, label_id in zip(
+        small_eval_dataset["text"], small_eval_dataset["label"])] \
+        if early_stopping else []
+    with open(job['validation_file_path'], 'w', encoding='utf-8') as f:
+        json.dump(validation_pairs, f)
+    if not early_stopping:
+        print("Too few rows per label for a validation split, "
+              f"training {MAX_TRAIN_EPOCHS} epochs without early stopping")
+
+    if warm_start_path:
+        model = AutoModelForSequenceClassification.from_pretrained(
+            warm_start_path, local_files_only=True)
+        resize_classification_head(model, label_to_id, id_to_label)
+    else:
+        model = AutoModelForSequenceClassification.from_pretrained(
+            base_model_path, num_labels=len(label_to_id), id2label=id_to_label, label2id=label_to_id,
+            local_files_only=True
+        )
+
+    training_args = TrainingArguments(
+        output_dir=job['checkpoint_dir'],
+        learning_rate=2e-5,
+        per_device_train_batch_size=16,
+        per_device_eval_batch_size=16,
+        num_train_epochs=MAX_TRAIN_EPOCHS,
+        weight_decay=0.01,
+        eval_strategy="epoch" if early_stopping else "no",
+        save_strategy="epoch",
+        # Early stopping keeps the checkpoint with the best validation accuracy
+        load_best_model_at_end=early_stopping,
+        metric_for_best_model="accuracy" if early_stopping else None,
+        greater_is_better=True,
+        save_total_limit=2,
+        save_safetensors=True,
+    )
+
+    trainer = Trainer(
+        model=model,
+        args=training_args,
+        train_dataset=small_train_dataset,
+        eval_dataset=small_eval_dataset,
+        tokenizer=tokenizer,
+        data_collator=data_collator,
+        compute_metrics=compute_metrics,
+        callbacks=[TrainProgressCallback()] + ([
+            EarlyStoppingCallback(
+                early_stopping_patience=EARLY_STOPPING_PATIENCE),
+        ] if early_stopping else []),
+    )
+
+    trainer.train()
+    trainer.save_model(job['output_dir'])
+
+
+def run_job_file(job_file_path: str):
+    with open(job_file_path, 'r', encoding='utf-8') as f:
+        train_classifier(json.load(f))
+
+
+if __name__ == '__main__':
+    run_job_file(sys.argv[1])
@@ -0,0 +1,284 @@
+import json
+import os
+import threading
+from typing import Any, Callable, Iterable, Union
+import numpy as np
+from model_loading import BASE_MODEL
+from prediction_cache import normalize_name
+from transaction_storage import SubCategoryChanges
+
+
+EMBEDDING_MODEL = BASE_MODEL
+
+
+class NameEmbedder:
+    """Mean-pooled, L2-normalized DistilBERT sentence embeddings of names.
+
+    The base model is used rather than the fine-tuned one so stored vectors
+    stay comparable across training runs. It is loaded on first use, from
+    model_path when set, the local copy of model_name.
+    """
+
+    def __init__(self, model_name: str = EMBEDDING_MODEL, batch_size: int = 32):
+        self.model_name = model_name
+        self.model_path: Union[str, None] = None
+        self.batch_size = batch_size
+        self.lock = threading.Lock()
+        self.tokenizer = None
+        self.model = None
+
+    def set_model_path(self, model_path: str):
+        self.model_path = model_path
+
+    def _ensure_loaded(self):
+        with self.lock:
+            if self.model is not None:
+                return
+            from transformers import AutoModel, AutoTokenizer
+            model_path = self.model_path or self.model_name
+            local_files_only = self.model_path is not None
+            self.tokenizer = AutoTokenizer.from_pretrained(
+                model_path, local_files_only=local_files_only)
+            self.model = AutoModel.from_pretrained(
+                model_path, local_files_only=local_files_only)
+            self.model.eval()
+
+    def embed(self, names: list[str]) -> np.ndarray:
+        import torch
+
+        self._ensure_loaded()
+        assert self.tokenizer is not None and self.model is not None
+        batches = []
+        for start in range(0, len(names), self.batch_size):
+            encoded = self.tokenizer(names[start:start + self.batch_size], padding=True,
+                                     truncation=True, return_tensors='pt')
+            with torch.no_grad():
+                hidden = self.model(**encoded).last_hidden_state
+            mask = encoded['attention_mask'].unsqueeze(-1).to(hidden.dtype)
+            pooled = (hidden * mask).sum(dim=1) / mask.sum(dim=1).clamp(min=1)
+            batches.append(pooled.numpy().astype(np.float32))
+        vectors = np.concatenate(batches) if batches else np.zeros((0, 0), np.float32)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.maximum(norms, 1e-12)
+
+
+class EmbeddingIndex:
+    """One embedding per unique normalized transaction name, with the
+    sub-category the user gave it, for k-nearest-neighbour categorization.
+
+    Vectors live in a memory-mapped .npy matrix in the data folder that
+    grows by doubling, the names and labels in a JSON file next to it.
+    Labeling a name only sets its label, so corrections take effect on
+    the next prediction without any training.
+    """
+
+    def __init__(self, data_folder: str, embedder: NameEmbedder, k: int = 5):
+        self.matrix_file_path = os.path.join(data_folder, 'name_embeddings.npy')
+        self.names_file_path = os.path.join(data_folder, 'name_embeddings.json')
+        self.embedder = embedder
+        self.k = k
+        self.lock = threading.Lock()
+        self.matrix: Union[np.memmap, None] = None
+        self.names: list[str] = []
+        self.name_index: dict[str, int] = {}
+        # Position to sub-category for labeled names
+        self.labels: dict[int, str] = {}
+        # Labeled names without a vector yet, embedded on the next prediction
+        self.pending_labels: dict[str, tuple[str, str]] = {}
+        # Labeled rows of the matrix and their labels, rebuilt after changes
+        self.labeled_positions: Union[np.ndarray, None] = None
+        self.labeled_names: list[str] = []
+        # Nothing is written before load, it would replace the persisted
+        # index with an empty one. Corrections made meanwhile are kept as
+        # (method, argument) and applied after it.
+        self.is_loaded = False
+        self.deferred_changes: list[tuple[Callable[[Any], None], Any]] = []
+
+    def load(self) -> bool:
+        """Load the persisted index, returns False when there is none."""
+        with self.lock:
+            return self._load_and_apply_deferred()
+
+    def _load_and_apply_deferred(self) -> bool:
+        found = self._load()
+        self.is_loaded = True
+        if self.deferred_changes:
+            for method, argument in self.deferred_changes:
+                method(argument)
+            self.deferred_changes = []
+            self._save()
+        return found
+
+    def _load(self) -> bool:
+        if not os.path.exists(self.names_file_path) or \
+                not os.path.exists(self.matrix_file_path):
+            return False
+        with open(self.names_file_path, 'r', encoding='utf-8') as f:
+            saved = json.load(f)
+        if saved['model'] != self.embedder.model_name:
+            return False
+        self.names = saved['names']
+        self.name_index = {name: position
+                           for position, name in enumerate(self.names)}
+        self.labels = {int(position): label
+                       for position, label in saved['labels'].items()}
+        self.matrix = np.load(self.matrix_file_path, mmap_mode='r+')
+        self.labeled_positions = None
+        return True
+
+    def save(self):
+        with self.lock:
+            self._save()
+
+    def _save(self):
+        if not self.is_loaded:
+            return
+        if self.matrix is not None:
+            self.matrix.flush()
+        temp_file_path = self.names_file_path + '.tmp'
+        with open(temp_file_path, 'w', encoding='utf-8') as f:
+            json.dump({
+                'model': self.embedder.model_name,
+                'names': self.names,
+                'labels': {str(position): label
+                           for position, label in self.labels.items()},
+            }, f)
+        os.replace(temp_file_path, self.names_file_path)
+
+    def _reserve(self, row_count: int, dimension: int):
+        """Make room for row_count more vectors, must be called with the lock held."""
+        needed = len(self.names) + row_count
+        capacity = self.matrix.shape[0] if self.matrix is not None else 0
+        if needed <= capacity:
+            return
+        new_capacity = max(needed, capacity * 2, 1024)
+        temp_file_path = self.matrix_file_path + '.tmp'
+        grown = np.lib.format.open_memmap(
+            temp_file_path, mode='w+', dtype=np.float32,
+            shape=(new_capacity, dimension))
+        if self.matrix is not None:
+            grown[:len(self.names)] = self.matrix[:len(self.names)]
+        grown.flush()
+        # The old mapping must be closed before its file is replaced
+        self.matrix = None
+        del grown
+        os.replace(temp_file_path, self.matrix_file_path)
+        self.matrix = np.load(self.matrix_file_path, mmap_mode='r+')
+
+    def _add_names(self, names: Iterable[str]):
+        """Embed names without a vector, must be called with the lock held."""
+        missing: dict[str, str] = {}
+        for name in names:
+            name_key = normalize_name(name)
+            if name_key not in self.name_index:
+                missing.setdefault(name_key, name)
+        if not missing:
+            return
+        vectors = self.embedder.embed(list(missing.values()))
+        self._reserve(len(missing), vectors.shape[1])
+        assert self.matrix is not None
+        start = len(self.names)
+        self.matrix[start:start + len(missing)] = vectors
+        for offset, name_key in enumerate(missing):
+            self.name_index[name_key] = start + offset
+            self.names.append(name_key)
+
+    def _apply_pending_labels(self):
+        if not self.pending_labels:
+            return
+        self._add_names(name for name, _label in self.pending_labels.values())
+        for name_key, (_name, label) in self.pending_labels.items():
+            self.labels[self.name_index[name_key]] = label
+        self.pending_labels = {}
+        self.labeled_positions = None
+
+    def set_labels(self, labeled_names: Iterable[tuple[str, str]]):
+        """Record (name, sub-category) corrections, an empty sub-category
+        removes the label. Names without a vector are embedded later."""
+        with self.lock:
+            if not self.is_loaded:
+                self.deferred_changes.append((self._set_labels, list(labeled_names)))
+                return
+            self._set_labels(labeled_names)
+            self._save()
+
+    def _set_labels(self, labeled_names: Iterable[tuple[str, str]]):
+        for name, label in labeled_names:
+            name_key = normalize_name(name)
+            position = self.name_index.get(name_key)
+            if position is None:
+                if label:
+                    self.pending_labels[name_key] = (name, label)
+                else:
+                    self.pending_labels.pop(name_key, None)
+            elif label:
+                self.labels[position] = label
+            else:
+                self.labels.pop(position, None)
+        self.labeled_positions = None
+
+    def rename_labels(self, changes: SubCategoryChanges):
+        """Follow sub-category renames and deletes."""
+        with self.lock:
+            if not self.is_loaded:
+                self.deferred_changes.append((self._rename_labels, dict(changes)))
+                return
+            self._rename_labels(changes)
+            self._save()
+
+    def _rename_labels(self, changes: SubCategoryChanges):
+        for position, label in list(self.labels.items()):
+            if label in changes:
+                new_label = changes[label][1]
+                if new_label:
+                    self.labels[position] = new_label
+                else:
+                    del self.labels[position]
+        for name_key, (name, label) in list(self.pending_labels.items()):
+            if label in changes:
+                if changes[label][1]:
+                    self.pending_labels[name_key] = (name, changes[label][1])
+                else:
+                    del self.pending_labels[name_key]
+        self.labeled_positions = None
+
+    def _get_labeled(self) -> tuple[np.ndarray, list[str]]:
+        if self.labeled_positions is None:
+            positions = sorted(self.labels)
+            self.labeled_positions = np.asarray(positions, dtype=np.int64)
+            self.labeled_names = [self.labels[position] for position in positions]
+        return self.labeled_positions, self.labeled_names
+
+    def predict(self, names: list[str]) -> list[tuple[Union[str, None], float]]:
+        """Return the similarity-weighted majority label of the k nearest
+        labeled names and its share of the vote, for every name."""
+        if not names:
+            return []
+        with self.lock:
+            if not self.is_loaded:
+                self._load_and_apply_deferred()
+            self._apply_pending_labels()
+            self._add_names(names)
+            labeled_positions, labeled_names = self._get_labeled()
+            if not len(labeled_positions):
+                self._save()
+                return [(None, 0.0)] * len(names)
+            assert self.matrix is not None
+            query_positions = [self.name_index[normalize_name(name)] for name in names]
+            queries = np.asarray(self.matrix[query_positions])
+            neighbours = np.asarray(self.matrix[labeled_positions])
+            self._save()
+
+        label_names, label_codes = np.unique(labeled_names, return_inverse=True)
+        # Cosine similarity, the vectors are normalized
+        similarities = queries @ neighbours.T
+        k = min(self.k, similarities.shape[1])
+        nearest = np.argpartition(-similarities, k - 1, axis=1)[:, :k]
+        weights = np.maximum(np.take_along_axis(similarities, nearest, axis=1), 0.0)
+        votes = np.zeros((len(names), len(label_names)))
+        np.add.at(votes, (np.arange(len(names))[:, None], label_codes[nearest]), weights)
+        best = votes.argmax(axis=1)
+        totals = votes.sum(axis=1)
+        return [(str(label_names[label_code]),
+                 float(votes[i, label_code] / totals[i]) if totals[i] > 0 else 0.0)
+                for i, label_code in enumerate(best)]
@@ -0,0 +1,70 @@
+"""Incremental JSON encoding and compression of large responses.
+
+Row lists are encoded a chunk of rows at a time and compressed as they
+are produced, so a response never exists as one large string and the
+first bytes go out before the last row is encoded. brotli is an optional
+dependency, without it only gzip is offered.
+"""
+import json
+import zlib
+from typing import Any, Iterable, Iterator, Union
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+# Rows encoded per yielded chunk
+ROWS_PER_CHUNK = 1000
+
+
+def get_supported_encodings() -> list[str]:
+    """Content codings in order of preference."""
+    return ['br', 'gzip'] if brotli is not None else ['gzip']
+
+
+def stream_json_rows(fields: dict[str, Any], rows_key: str,
+                     rows: Iterable[Any]) -> Iterator[str]:
+    """Encode {**fields, rows_key: [*rows]} piece by piece."""
+    prefix = json.dumps(fields)[:-1]
+    yield f'{prefix}, "{rows_key}": [' if fields else f'{{"{rows_key}": ['
+    chunk: list[str] = []
+    first = True
+    for row in rows:
+        chunk.append(json.dumps(row))
+        if len(chunk) >= ROWS_PER_CHUNK:
+            yield ('' if first else ', ') + ', '.join(chunk)
+            chunk = []
+            first = False
+    if chunk:
+        yield ('' if first else ', ') + ', '.join(chunk)
+    yield ']}'
+
+
+def compress_stream(chunks: Iterable[str], encoding: Union[str, None]) -> Iterator[bytes]:
+    """UTF-8 encode the chunks and compress them with the content coding,
+    None leaves them uncompressed."""
+    if encoding == 'br':
+        compressor = brotli.Compressor(quality=4)
+
+        def compress(data: bytes) -> bytes:
+            return compressor.process(data)
+
+        def finish() -> bytes:
+            return compressor.finish()
+    elif encoding == 'gzip':
+        # wbits 31 writes a gzip header and trailer
+        compressobj = zlib.compressobj(6, zlib.DEFLATED, 31)
+        compress = compressobj.compress
+        finish = compressobj.flush
+    else:
+        for chunk in chunks:
+            yield chunk.encode('utf-8')
+        return
+
+    for chunk in chunks:
+        data = compress(chunk.encode('utf-8'))
+        if data:
+            yield data
+    yield finish()
@@ -0,0 +1,59 @@
+import os
+from typing import TYPE_CHECKING, Union
+from training_history import TrainingPair
+
+if TYPE_CHECKING:
+    from sklearn.pipeline import Pipeline
+
+
+class LexicalClassifier:
+    """Fast first tier of categorization: character n-gram TF-IDF features
+    with a logistic regression, trained in seconds from labeled rows.
+
+    Merchant names are short and repetitive, so most of them are predicted
+    with high confidence here and only the rest go to the transformer.
+    """
+
+    def __init__(self, model: 'Pipeline'):
+        self.model = model
+        self.labels: list[str] = [str(label) for label in model.classes_]
+
+    @classmethod
+    def fit(cls, pairs: list[TrainingPair]) -> Union['LexicalClassifier', None]:
+        """Train on (name, sub-category) pairs, None with fewer than two labels."""
+        if len({label for _text, label in pairs}) < 2:
+            return None
+        from sklearn.feature_extraction.text import TfidfVectorizer
+        from sklearn.linear_model import LogisticRegression
+        from sklearn.pipeline import make_pipeline
+
+        model = make_pipeline(
+            TfidfVectorizer(analyzer='char_wb', ngram_range=(2, 4),
+                            lowercase=True, sublinear_tf=True),
+            LogisticRegression(C=10.0, max_iter=1000))
+        model.fit([text for text, _label in pairs],
+                  [label for _text, label in pairs])
+        return cls(model)
+
+    @classmethod
+    def load(cls, model_file_path: str) -> Union['LexicalClassifier', None]:
+        if not os.path.exists(model_file_path):
+            return None
+        import joblib
+        return cls(joblib.load(model_file_path))
+
+    def save(self, model_file_path: str):
+        import joblib
+
+        temp_file_path = model_file_path + '.tmp'
+        joblib.dump(self.model, temp_file_path)
+        os.replace(temp_file_path, model_file_path)
+
+    def predict(self, names: list[str]) -> list[tuple[str, float]]:
+        """Return the most likely label and its probability for every name."""
+        if not names:
+            return []
+        probabilities = self.model.predict_proba(names)
+        best = probabilities.argmax(axis=1)
+        return [(self.labels[label_index], float(probabilities[i, label_index]))
+                for i, label_index in enumerate(best)]
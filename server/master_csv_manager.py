@@ -1,111 +1,550 @@
+from bisect import bisect_left, bisect_right
+from contextlib import contextmanager
 import csv
+import json
 import os
 import threading
-from typing import Any, Union
+import uuid
+from typing import Union
+from metrics import CSV_OPERATION_SECONDS, TimedLock
+from process_coordination import FileLock, get_files_stamp
+from transaction_query import TransactionQuery, parse_amount, parse_date, encode_cursor
+from transaction_storage import (
+    FIELDNAMES, IDENTITY_FIELDS, SubCategoryChanges, TransactionKey,
+    TransactionRows, TransactionStorage, get_row_key)
 
 
-FIELDNAMES = [
-    'Date', 'Transaction', 'Name',
-    'Memo', 'Amount', 'Category', 'Sub Category'
-]
+def fsync_folder(folder_path: str):
+    """Make renames and removals in the folder durable. Windows cannot open
+    a folder for fsync, there os.replace is durable on its own."""
+    if os.name == 'nt':
+        return
+    folder_fd = os.open(folder_path, os.O_RDONLY)
+    try:
+        os.fsync(folder_fd)
+    finally:
+        os.close(folder_fd)
 
-TransactionRows = list[dict[Union[str, Any], Union[str, Any]]]
 
+class MasterCSVManager(TransactionStorage):
+    """Memory-resident transaction store persisted to the master CSV file.
 
-class MasterCSVManager:
-    def __init__(self, data_folder: str):
+    The CSV is read once on first access. Afterwards all reads are served
+    from memory and rows are looked up through a hash index on the
+    identity key, the file is only written to persist changes. Rows are
+    append-only so a row's position in self.rows never changes, the
+    category, sub-category and date indexes refer to rows by position.
+
+    With use_journal set, added rows and category changes are appended to a
+    journal instead of rewriting the CSV. A background thread compacts the
+    journal into the CSV periodically and the journal is replayed on load.
+
+    With shared set, several server processes use the same files. Every
+    operation holds a file lock, shared for reads and exclusive for
+    writes, and first checks whether another process changed the CSV or
+    the journal since it last looked. New journal entries are replayed,
+    any other change reloads the rows. Writes are never deferred then.
+    """
+
+    def __init__(self, data_folder: str, use_journal: bool = False,
+                 compaction_interval: float = 60.0,
+                 compaction_threshold: int = 10000, shared: bool = False):
+        super().__init__()
         self.master_file_path = os.path.join(
             data_folder, 'master_transactions.csv')
-        self.lock = threading.Lock()
+        self.journal_file_path = os.path.join(
+            data_folder, 'master_transactions.journal')
+        self.lock = TimedLock('master_store')
+        self.file_lock: Union[FileLock, None] = None
+        if shared:
+            self.file_lock = FileLock(os.path.join(
+                data_folder, 'master_transactions.lock'))
+        # Files as last seen by this process and how much of the journal it replayed
+        self.disk_stamp: Union[tuple, None] = None
+        self.journal_offset = 0
+        self._reset()
+        self.version = 0
+        self.epoch = uuid.uuid4().hex[:12]
+        self.use_journal = use_journal
+        self.compaction_interval = compaction_interval
+        self.compaction_threshold = compaction_threshold
+        self.compaction_event = threading.Event()
+        self.stop_event = threading.Event()
+        self.compaction_thread = None
+        if self.use_journal:
+            self.compaction_thread = threading.Thread(
+                target=self.compaction_worker)
+            self.compaction_thread.daemon = True
+            self.compaction_thread.start()
 
-    
     def get_master_file_path(self):
         return self.master_file_path
-    
+
+    def _reset(self):
+        """Forget the rows, they are loaded again on next access."""
+        self.rows: TransactionRows = []
+        self.row_index: dict[TransactionKey, int] = {}
+        self.date_values: list[int] = []
+        self.amount_values: list[float] = []
+        self.category_index: dict[str, set[int]] = {}
+        self.sub_category_index: dict[str, set[int]] = {}
+        # Positions sorted by date and their dates, rebuilt lazily after
+        # rows are added
+        self.date_order: Union[list[int], None] = None
+        self.sorted_dates: list[int] = []
+        self.is_loaded = False
+        self.has_unsaved_rows = False
+        self.journal_entry_count = 0
+
+    @contextmanager
+    def _locked(self, exclusive: bool = True):
+        """Hold the lock, and the file lock when shared, with the rows loaded
+        and up to date."""
+        with self.lock:
+            if self.file_lock is None:
+                self._ensure_loaded()
+                yield
+                return
+            with self.file_lock.locked(exclusive):
+                self._ensure_loaded()
+                self._refresh_if_stale()
+                yield
+
+    def _get_disk_stamp(self) -> tuple:
+        stamps = []
+        for file_path in (self.master_file_path, self.journal_file_path):
+            try:
+                stat = os.stat(file_path)
+                stamps.append((stat.st_ino, stat.st_mtime_ns, stat.st_size))
+            except FileNotFoundError:
+                stamps.append(None)
+        return tuple(stamps)
+
+    def _record_disk_stamp(self):
+        """Remember the files after this process wrote them, the journal
+        then holds complete entries only."""
+        if self.file_lock is not None:
+            self.disk_stamp = self._get_disk_stamp()
+            journal_stamp = self.disk_stamp[1]
+            self.journal_offset = journal_stamp[2] if journal_stamp is not None else 0
+
+    def _refresh_if_stale(self):
+        """Pick up changes of other processes, must be called with both locks held."""
+        stamp = self._get_disk_stamp()
+        if stamp == self.disk_stamp:
+            return
+        assert self.disk_stamp is not None
+        csv_stamp, journal_stamp = stamp
+        old_csv_stamp, old_journal_stamp = self.disk_stamp
+        if csv_stamp == old_csv_stamp and journal_stamp is not None and \
+                (old_journal_stamp is None or journal_stamp[0] == old_journal_stamp[0]) and \
+                journal_stamp[2] >= self.journal_offset:
+            # Only appended to, replay the new entries
+            with CSV_OPERATION_SECONDS.time('journal_replay'):
+                self.journal_entry_count += self._replay_journal(notify=True)
+        else:
+            self._reset()
+            self._ensure_loaded()
+            self._notify_rows_reloaded(self._read_columns())
+        self.disk_stamp = stamp
+        self.version += 1
+
+    def refresh(self):
+        if self.file_lock is not None:
+            with self._locked(exclusive=False):
+                pass
+
+    def _ensure_loaded(self):
+        """Load the master CSV into memory, must be called with the lock held."""
+        if self.is_loaded:
+            return
+        self.journal_offset = 0
+        if os.path.exists(self.master_file_path):
+            with CSV_OPERATION_SECONDS.time('load'), \
+                    open(self.master_file_path, 'r', newline='', encoding='utf-8') as f:
+                reader = csv.DictReader(f)
+                for row in reader:
+                    self._insert_row(
+                        {field: row.get(field) or '' for field in FIELDNAMES})
+        self.is_loaded = True
+
+        if os.path.exists(self.journal_file_path):
+            with CSV_OPERATION_SECONDS.time('journal_replay'):
+                replayed = self._replay_journal()
+            print(f"Replayed {replayed} journal entries")
+            if self.file_lock is None:
+                # Fold the replayed entries into the CSV so a torn last line
+                # is never appended to
+                self._write_master_csv()
+                os.remove(self.journal_file_path)
+            else:
+                # Other processes may be reading, the compaction folds them later
+                self.journal_entry_count = replayed
+        if self.file_lock is not None:
+            # journal_offset stays where the replay stopped, before a partial
+            # last entry the next append truncates
+            self.disk_stamp = self._get_disk_stamp()
+
+    def _insert_row(self, row: dict) -> bool:
+        """Append a row and index it, returns False for a duplicate."""
+        row_key = get_row_key(row)
+        if row_key in self.row_index:
+            return False
+        position = len(self.rows)
+        self.rows.append(row)
+        self.row_index[row_key] = position
+        self.date_values.append(parse_date(row['Date']))
+        self.amount_values.append(parse_amount(row['Amount']))
+        self.category_index.setdefault(row['Category'], set()).add(position)
+        self.sub_category_index.setdefault(
+            row['Sub Category'], set()).add(position)
+        self.date_order = None
+        return True
+
+    def _set_row_categories(self, position: int, category: str, sub_category: str):
+        """Change a row's categories and move it between indexes."""
+        row = self.rows[position]
+        self.category_index[row['Category']].discard(position)
+        self.sub_category_index[row['Sub Category']].discard(position)
+        row['Category'] = category
+        row['Sub Category'] = sub_category
+        self.category_index.setdefault(category, set()).add(position)
+        self.sub_category_index.setdefault(sub_category, set()).add(position)
+
+    def _get_date_order(self) -> tuple[list[int], list[int]]:
+        """Positions sorted by date and the dates in that order."""
+        if self.date_order is None:
+            self.date_order = sorted(range(len(self.rows)),
+                                     key=lambda position: self.date_values[position])
+            self.sorted_dates = [self.date_values[position]
+                                 for position in self.date_order]
+        return self.date_order, self.sorted_dates
+
+    def _replay_journal(self, notify: bool = False) -> int:
+        """Apply the journal from journal_offset on to the in-memory rows,
+        must be called with the lock held. With notify the change listeners
+        are told about the replayed changes."""
+        replayed = 0
+        added_rows: TransactionRows = []
+        changes: list[tuple[dict, dict]] = []
+        with open(self.journal_file_path, 'rb') as f:
+            f.seek(self.journal_offset)
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except (json.JSONDecodeError, UnicodeDecodeError):
+                    # A crash while appending leaves a partial last line
+                    print("Ignoring incomplete journal entry")
+                    break
+                if entry['op'] == 'add':
+                    if self._insert_row(entry['row']) and notify:
+                        added_rows.append(dict(entry['row']))
+                elif entry['op'] == 'update':
+                    position = self.row_index.get(tuple(entry['key']))
+                    if position is not None:
+                        old_row = self.rows[position].copy()
+                        self._set_row_categories(
+                            position, entry['Category'], entry['Sub Category'])
+                        if notify:
+                            changes.append((old_row, self.rows[position].copy()))
+                self.journal_offset += len(line)
+                replayed += 1
+        if added_rows:
+            self._notify_rows_added(added_rows)
+        if changes:
+            self._notify_rows_recategorized(changes)
+        return replayed
+
+    def _truncate_incomplete_journal(self):
+        """Cut a partial entry left by a crashed writer off the shared
+        journal, must be called with the exclusive file lock held."""
+        if self.file_lock is None or not os.path.exists(self.journal_file_path):
+            return
+        if os.path.getsize(self.journal_file_path) > self.journal_offset:
+            # Appended after it an entry would be garbled, and every process
+            # replaying the journal would stop there
+            print("Truncating incomplete journal entry")
+            os.truncate(self.journal_file_path, self.journal_offset)
+
+    def _append_journal(self, entries: list[dict]):
+        """Durably append entries to the journal, must be called with the lock held."""
+        self._truncate_incomplete_journal()
+        with CSV_OPERATION_SECONDS.time('journal_append'), \
+                open(self.journal_file_path, 'a', encoding='utf-8') as f:
+            for entry in entries:
+                f.write(json.dumps(entry) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        self._record_disk_stamp()
+        self.journal_entry_count += len(entries)
+        if self.journal_entry_count >= self.compaction_threshold:
+            self.compaction_event.set()
+
+    def _write_master_csv(self):
+        """Persist all rows to the master CSV, must be called with the lock held."""
+        temp_file_path = self.master_file_path + '.tmp'
+        with CSV_OPERATION_SECONDS.time('write'):
+            with open(temp_file_path, 'w', newline='', encoding='utf-8') as f:
+                writer = csv.DictWriter(f, fieldnames=FIELDNAMES)
+                writer.writeheader()
+                writer.writerows(self.rows)
+                f.flush()
+                os.fsync(f.fileno())
+            # The journal is removed after this, the new CSV must be on disk
+            # under its name first or a crash could leave neither
+            os.replace(temp_file_path, self.master_file_path)
+            fsync_folder(os.path.dirname(os.path.abspath(self.master_file_path)))
+        self.has_unsaved_rows = False
+        self._record_disk_stamp()
+
+    def flush(self):
+        """Write rows added with defer_write to the master CSV."""
+        with self.lock:
+            if self.has_unsaved_rows:
+                self._write_master_csv()
+
+    def compact(self):
+        """Fold the journal into the master CSV and truncate it."""
+        if not self.is_loaded:
+            return
+        with self._locked():
+            if self.journal_entry_count == 0:
+                return
+            self._write_master_csv()
+            # The CSV already holds every entry, replaying a journal that
+            # survived a crash here is harmless since entries are idempotent
+            os.remove(self.journal_file_path)
+            self.journal_entry_count = 0
+            self._record_disk_stamp()
+
+    def compaction_worker(self):
+        while not self.stop_event.is_set():
+            self.compaction_event.wait(self.compaction_interval)
+            self.compaction_event.clear()
+            self.compact()
+
+    def stop(self):
+        self.stop_event.set()
+        self.compaction_event.set()
+        if self.compaction_thread is not None:
+            self.compaction_thread.join()
+        self.compact()
+        if self.file_lock is not None:
+            self.file_lock.close()
+
     def read_master_csv_dict(self) -> TransactionRows:
         """Read all rows and columns from the master CSV file."""
-        with self.lock:
-            if os.path.exists(self.master_file_path):
-                with open(self.master_file_path, 'r', newline='', encoding='utf-8') as f:
-                    reader = csv.DictReader(f)
-                    rows = list(reader)
-                    return rows
-            return []
-        
+        with self._locked(exclusive=False):
+            return [row.copy() for row in self.rows]
+
     def read_master_csv_list(self):
         """Read all rows and columns from the master CSV file."""
-        with self.lock:
-            if os.path.exists(self.master_file_path):
-                with open(self.master_file_path, 'r', newline='', encoding='utf-8') as f:
-                    reader = csv.reader(f)
-                    columns = next(reader, [])
-                    rows = list(reader)
-                    return {'columns': columns, 'rows': rows}
-            return {'columns': [], 'rows': []}
+        with self._locked(exclusive=False):
+            if not self.rows:
+                return {'columns': [], 'rows': []}
+            rows = [[row[field] for field in FIELDNAMES]
+                    for row in self.rows]
+            return {'columns': list(FIELDNAMES), 'rows': rows}
 
     def update_rows_with_categories(self, updated_rows: TransactionRows):
         """Update rows with categories"""
-        with self.lock:
-            existing_rows = []
-            if os.path.exists(self.master_file_path):
-                with open(self.master_file_path, 'r', newline='', encoding='utf-8') as f:
-                    reader = csv.DictReader(f)
-                    existing_rows = list(reader)
-
+        with self._locked():
+            changed_rows: TransactionRows = []
+            changes: list[tuple[dict, dict]] = []
             for row in updated_rows:
-                for existing_row in existing_rows:
-                    if (
-                        row['Date'] == existing_row['Date'] and
-                        row['Transaction'] == existing_row['Transaction'] and
-                        row['Name'] == existing_row['Name'] and
-                        row['Memo'] == existing_row['Memo'] and
-                        row['Amount'] == existing_row['Amount']
-                    ):
-                        existing_row['Category'] = row['Category']
-                        existing_row['Sub Category'] = row['Sub Category']
-                        break
-
-            with open(self.master_file_path, 'w', newline='', encoding='utf-8') as f:
-                writer = csv.DictWriter(f, fieldnames=FIELDNAMES)
-                writer.writeheader()
-                writer.writerows(existing_rows)
-            return existing_rows
+                position = self.row_index.get(get_row_key(row))
+                if position is None:
+                    continue
+                old_row = self.rows[position].copy()
+                self._set_row_categories(
+                    position, row['Category'], row['Sub Category'])
+                changed_rows.append(self.rows[position].copy())
+                changes.append((old_row, changed_rows[-1]))
 
-    def add_rows_to_master_csv(self, new_rows: TransactionRows):
-        """Update master CSV file with new rows, deduplicating based on all columns."""
-        with self.lock:
-            existing_rows = []
-            if os.path.exists(self.master_file_path):
-                with open(self.master_file_path, 'r', newline='', encoding='utf-8') as f:
-                    reader = csv.DictReader(f)
-                    existing_rows = list(reader)
-
-            existing_row_tuples = set()
-            for row in existing_rows:
-                existing_row_copy = row.copy()
-                del existing_row_copy["Category"]
-                del existing_row_copy["Sub Category"]
-                row_tuple = tuple(existing_row_copy.values())
-                existing_row_tuples.add(row_tuple)
+            self._persist_changes(changed_rows, changes)
+            return changed_rows
+
+    def change_sub_categories(self, changes: SubCategoryChanges) -> TransactionRows:
+        with self._locked():
+            # Collect every position first so swapped names are not applied twice
+            positions = [
+                (position, new_category, new_sub_category)
+                for sub_category, (new_category, new_sub_category) in changes.items()
+                for position in self.sub_category_index.get(sub_category, ())
+            ]
+            changed_rows: TransactionRows = []
+            row_changes: list[tuple[dict, dict]] = []
+            for position, new_category, new_sub_category in positions:
+                old_row = self.rows[position].copy()
+                self._set_row_categories(
+                    position,
+                    old_row['Category'] if new_category is None else new_category,
+                    new_sub_category)
+                changed_rows.append(self.rows[position].copy())
+                row_changes.append((old_row, changed_rows[-1]))
+            self._persist_changes(changed_rows, row_changes)
+            return changed_rows
+
+    def _persist_changes(self, changed_rows: TransactionRows, changes: list[tuple[dict, dict]]):
+        """Write category changes once, must be called with the lock held."""
+        if not changed_rows:
+            return
+        self.version += 1
+        self._notify_rows_recategorized(changes)
+        if self.use_journal:
+            self._append_journal([
+                {
+                    'op': 'update',
+                    'key': list(get_row_key(row)),
+                    'Category': row['Category'],
+                    'Sub Category': row['Sub Category']
+                }
+                for row in changed_rows
+            ])
+        else:
+            self._write_master_csv()
 
+    def add_rows_to_master_csv(self, new_rows: TransactionRows, defer_write: bool = False):
+        """Update master CSV file with new rows, deduplicating based on all columns.
+
+        With defer_write the CSV is not rewritten until flush is called, so a
+        chunked upload rewrites it once. Journal appends and writes of a
+        shared store are never deferred.
+        """
+        with self._locked():
             added_rows = []
-            for row in new_rows:
-                row_tuple = tuple(row.values())
-                if row_tuple not in existing_row_tuples:
-                    row['Category'] = ''
-                    row['Sub Category'] = ''
-                    existing_rows.append(row)
-                    existing_row_tuples.add(row_tuple)
-                    added_rows.append(row)
-
-            if existing_rows:
-                with open(self.master_file_path, 'w', newline='', encoding='utf-8') as f:
-                    writer = csv.DictWriter(f, fieldnames=FIELDNAMES)
-                    writer.writeheader()
-                    writer.writerows(existing_rows)
+            with CSV_OPERATION_SECONDS.time('merge'):
+                for row in new_rows:
+                    stored_row = {field: row.get(field) or ''
+                                  for field in IDENTITY_FIELDS}
+                    stored_row['Category'] = ''
+                    stored_row['Sub Category'] = ''
+                    if self._insert_row(stored_row):
+                        added_rows.append(stored_row.copy())
+            if added_rows:
+                self.version += 1
+                self._notify_rows_added(added_rows)
+
+            if added_rows and self.use_journal:
+                self._append_journal(
+                    [{'op': 'add', 'row': row} for row in added_rows])
+            elif added_rows and defer_write and self.file_lock is None:
+                self.has_unsaved_rows = True
+            elif added_rows:
+                self._write_master_csv()
+            total_rows = len(self.rows)
 
         return {
-            'total_rows': len(existing_rows),
+            'total_rows': total_rows,
             'added_rows': added_rows,
             'duplicate_rows': len(new_rows) - len(added_rows)
         }
+
+    def get_version(self) -> int:
+        self.refresh()
+        return self.version
+
+    def get_etag(self) -> str:
+        if self.file_lock is None:
+            # Versions restart with the process, the epoch keeps those of
+            # different runs apart
+            return f"{self.epoch}-{self.version}"
+        with self._locked(exclusive=False):
+            # Every write reaches the files at once when shared
+            return get_files_stamp([self.master_file_path, self.journal_file_path])
+
+    def _read_columns(self):
+        return {
+            'dates': list(self.date_values),
+            'amounts': list(self.amount_values),
+            'categories': [row['Category'] for row in self.rows],
+            'sub_categories': [row['Sub Category'] for row in self.rows],
+        }
+
+    def read_columns(self):
+        with self._locked(exclusive=False):
+            return self._read_columns()
+
+    def query_transactions(self, query: TransactionQuery):
+        """Return one page of rows matching the query, as lists in FIELDNAMES order."""
+        with self._locked(exclusive=False):
+            candidates: Union[set[int], None] = None
+            if query.categories is not None:
+                candidates = set().union(
+                    *(self.category_index.get(category, set())
+                      for category in query.categories))
+            if query.sub_categories is not None:
+                sub_category_matches = set().union(
+                    *(self.sub_category_index.get(sub_category, set())
+                      for sub_category in query.sub_categories))
+                candidates = sub_category_matches if candidates is None \
+                    else candidates & sub_category_matches
+
+            if query.start_date is not None or query.end_date is not None:
+                date_order, dates = self._get_date_order()
+                start_date = query.start_date if query.start_date is not None else 0
+                low = bisect_left(dates, start_date)
+                high = len(dates) if query.end_date is None \
+                    else bisect_right(dates, query.end_date)
+                in_range = date_order[low:high]
+                positions = in_range if candidates is None \
+                    else [position for position in in_range if position in candidates]
+            elif candidates is not None:
+                positions = list(candidates)
+            else:
+                positions = range(len(self.rows))
+
+            matches = [
+                position for position in positions
+                if self._matches_row_filters(position, query)
+            ]
+
+            sort_field = query.sort_field
+
+            def get_sort_value(position: int):
+                if sort_field == 'Date':
+                    return self.date_values[position]
+                if sort_field == 'Amount':
+                    return self.amount_values[position]
+                if sort_field is not None:
+                    return self.rows[position][sort_field].casefold()
+                return 0
+
+            # The position breaks ties so every row has a unique, stable cursor
+            sort_keys = sorted((get_sort_value(position), position)
+                               for position in matches)
+            page_size = query.limit if query.limit is not None else len(sort_keys)
+            if query.descending:
+                end = len(sort_keys) if query.cursor is None \
+                    else bisect_left(sort_keys, tuple(query.cursor))
+                page_keys = sort_keys[max(0, end - page_size):end][::-1]
+                has_more = end - page_size > 0
+            else:
+                start = 0 if query.cursor is None \
+                    else bisect_right(sort_keys, tuple(query.cursor))
+                page_keys = sort_keys[start:start + page_size]
+                has_more = start + page_size < len(sort_keys)
+
+            next_cursor = None
+            if has_more and page_keys:
+                next_cursor = encode_cursor(sort_field, *page_keys[-1])
+            return {
+                'columns': list(FIELDNAMES),
+                'rows': [[self.rows[position][field] for field in FIELDNAMES]
+                         for _sort_value, position in page_keys],
+                'total': len(sort_keys),
+                'next_cursor': next_cursor
+            }
+
+    def _matches_row_filters(self, position: int, query: TransactionQuery) -> bool:
+        amount = self.amount_values[position]
+        if query.min_amount is not None and amount < query.min_amount:
+            return False
+        if query.max_amount is not None and amount > query.max_amount:
+            return False
+        if query.text is not None:
+            row = self.rows[position]
+            if query.text not in row['Name'].casefold() and \
+                    query.text not in row['Memo'].casefold():
+                return False
+        return True
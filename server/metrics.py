@@ -0,0 +1,204 @@
+from bisect import bisect_left
+from contextlib import contextmanager
+import threading
+import time
+from typing import Callable, Union
+
+
+# Upper bounds in seconds, from a fast in-memory operation to a training run
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+LabelValues = tuple[str, ...]
+
+
+def format_labels(label_names: tuple[str, ...], label_values: LabelValues,
+                  extra: str = '') -> str:
+    pairs = [f'{name}="{escape_label_value(value)}"'
+             for name, value in zip(label_names, label_values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def escape_label_value(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class Histogram:
+    """Counts observations into fixed buckets, per combination of label values.
+
+    An observation is a bisect and three additions under a lock, so it is
+    cheap enough for every request and every lock acquisition.
+    """
+
+    def __init__(self, name: str, help_text: str, label_names: tuple[str, ...] = (),
+                 buckets: tuple[float, ...] = DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        # Label values to [per-bucket counts (last one is +Inf), sum, count]
+        self.series: dict[LabelValues, list] = {}
+
+    def observe(self, value: float, *label_values: str):
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(label_values)
+            if series is None:
+                series = self.series[label_values] = [
+                    [0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    @contextmanager
+    def time(self, *label_values: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *label_values)
+
+    def render(self) -> list[str]:
+        lines = [f'# HELP {self.name} {self.help_text}',
+                 f'# TYPE {self.name} histogram']
+        with self.lock:
+            series = [(label_values, list(counts), total, count)
+                      for label_values, (counts, total, count) in self.series.items()]
+        for label_values, counts, total, count in sorted(series):
+            cumulative = 0
+            for bound, bucket_count in zip((*self.buckets, float('inf')), counts):
+                cumulative += bucket_count
+                labels = format_labels(self.label_names, label_values,
+                                       f'le="{format_value(bound)}"')
+                lines.append(f'{self.name}_bucket{labels} {cumulative}')
+            labels = format_labels(self.label_names, label_values)
+            lines.append(f'{self.name}_sum{labels} {format_value(total)}')
+            lines.append(f'{self.name}_count{labels} {count}')
+        return lines
+
+
+class Counter:
+    def __init__(self, name: str, help_text: str, label_names: tuple[str, ...] = ()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.lock = threading.Lock()
+        self.values: dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1, *label_values: str):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def render(self) -> list[str]:
+        lines = [f'# HELP {self.name} {self.help_text}',
+                 f'# TYPE {self.name} counter']
+        with self.lock:
+            values = sorted(self.values.items())
+        for label_values, value in values:
+            lines.append(f'{self.name}{format_labels(self.label_names, label_values)} '
+                         f'{format_value(value)}')
+        return lines
+
+
+class Gauge:
+    """A value read from a callback at scrape time, the callback returns a
+    number or a dict from label values to numbers."""
+
+    def __init__(self, name: str, help_text: str, label_names: tuple[str, ...] = ()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.callback: Union[Callable[[], Union[float, dict[LabelValues, float]]], None] = None
+
+    def set_callback(self, callback: Callable[[], Union[float, dict[LabelValues, float]]]):
+        self.callback = callback
+
+    def render(self) -> list[str]:
+        lines = [f'# HELP {self.name} {self.help_text}',
+                 f'# TYPE {self.name} gauge']
+        if self.callback is None:
+            return lines
+        values = self.callback()
+        if not isinstance(values, dict):
+            values = {(): values}
+        for label_values, value in sorted(values.items()):
+            lines.append(f'{self.name}{format_labels(self.label_names, label_values)} '
+                         f'{format_value(value)}')
+        return lines
+
+
+class TimedLock:
+    """A lock that records how long every acquisition waited."""
+
+    def __init__(self, name: str, lock=None):
+        self.name = name
+        self.lock = lock if lock is not None else threading.Lock()
+
+    def acquire(self, blocking: bool = True, timeout: float = -1) -> bool:
+        start = time.perf_counter()
+        acquired = self.lock.acquire(blocking, timeout)
+        LOCK_WAIT_SECONDS.observe(time.perf_counter() - start, self.name)
+        return acquired
+
+    def release(self):
+        self.lock.release()
+
+    def locked(self) -> bool:
+        return self.lock.locked()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+CSV_OPERATION_SECONDS = Histogram(
+    'cashflow_csv_operation_seconds',
+    'Time spent loading, parsing, merging and writing transaction CSV data',
+    ('operation',))
+LOCK_WAIT_SECONDS = Histogram(
+    'cashflow_lock_wait_seconds', 'Time spent waiting to acquire a lock',
+    ('lock',))
+INFERENCE_BATCH_SECONDS = Histogram(
+    'cashflow_inference_batch_seconds',
+    'Latency of one classifier forward pass over a batch of names')
+INFERENCE_ROWS_PER_SECOND = Histogram(
+    'cashflow_inference_rows_per_second',
+    'Names classified per second by each classifier batch',
+    buckets=(10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000))
+CATEGORIZED_NAMES = Counter(
+    'cashflow_categorized_names_total',
+    'Unique transaction names categorized, by whether the prediction came from the cache or the model',
+    ('source',))
+TRAIN_STEP_SECONDS = Histogram(
+    'cashflow_train_step_seconds', 'Time of one classifier training step')
+REQUEST_SECONDS = Histogram(
+    'cashflow_http_request_seconds', 'HTTP request latency by route',
+    ('method', 'route', 'status'))
+TASK_QUEUE_DEPTH = Gauge(
+    'cashflow_task_queue_depth', 'Tasks waiting to run on each lane', ('lane',))
+
+REGISTRY = [
+    CSV_OPERATION_SECONDS, LOCK_WAIT_SECONDS, INFERENCE_BATCH_SECONDS,
+    INFERENCE_ROWS_PER_SECOND, CATEGORIZED_NAMES, TRAIN_STEP_SECONDS,
+    REQUEST_SECONDS, TASK_QUEUE_DEPTH,
+]
+
+
+def render_metrics() -> str:
+    """Return every metric in the Prometheus text exposition format."""
+    lines: list[str] = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,106 @@
+"""Local model artifacts and memory-mapped loading.
+
+The base model is fetched once into data_folder/models/base and every
+model, base or fine-tuned, is loaded from the data folder afterwards.
+Models are stored as safetensors and their weights are memory-mapped
+rather than copied, so worker processes serving the same model share
+one copy of it in the page cache. In offline mode nothing is ever looked
+up on the network, a missing base model is an error.
+
+Seed the store of a host without network from one that has it:
+
+    python model_loading.py --data_folder data
+"""
+import argparse
+import os
+import shutil
+import sys
+
+
+BASE_MODEL = "distilbert/distilbert-base-uncased"
+BASE_MODEL_FOLDER_NAME = 'base'
+SAFETENSORS_FILE_NAME = 'model.safetensors'
+
+
+def set_offline():
+    """Refuse network lookups in this process and its training subprocesses.
+
+    The hub libraries read these when first imported, which happens lazily
+    after startup.
+    """
+    os.environ['HF_HUB_OFFLINE'] = '1'
+    os.environ['TRANSFORMERS_OFFLINE'] = '1'
+    os.environ['HF_DATASETS_OFFLINE'] = '1'
+
+
+def is_offline() -> bool:
+    return os.environ.get('HF_HUB_OFFLINE') == '1'
+
+
+def get_base_model_path(models_folder: str) -> str:
+    return os.path.join(models_folder, BASE_MODEL_FOLDER_NAME)
+
+
+def fetch_base_model(models_folder: str, model_name: str = BASE_MODEL) -> str:
+    """Return the stored base model folder, downloading it into the store
+    first if needed. Raises in offline mode when it is not stored."""
+    base_model_path = get_base_model_path(models_folder)
+    if os.path.exists(os.path.join(base_model_path, SAFETENSORS_FILE_NAME)):
+        return base_model_path
+    if is_offline():
+        raise RuntimeError(
+            f"Base model is not in {base_model_path} and network lookups are "
+            f"disabled, seed it with: python model_loading.py --data_folder <data folder>")
+
+    from transformers import AutoModel, AutoTokenizer
+
+    print(f"Fetching {model_name} into {base_model_path}")
+    temp_path = base_model_path + '.tmp'
+    shutil.rmtree(temp_path, ignore_errors=True)
+    AutoTokenizer.from_pretrained(model_name).save_pretrained(temp_path)
+    AutoModel.from_pretrained(model_name).save_pretrained(
+        temp_path, safe_serialization=True)
+    shutil.rmtree(base_model_path, ignore_errors=True)
+    os.replace(temp_path, base_model_path)
+    return base_model_path
+
+
+def load_mmap_model(model_path: str):
+    """Load a saved sequence classification model with its weights backed by
+    the memory-mapped safetensors file.
+
+    The mapped tensors are assigned as the model's parameters instead of
+    being copied into them, nothing is copied until a weight is written.
+    Models without a single safetensors file, or whose file does not cover
+    every parameter, are loaded the regular way.
+    """
+    from transformers import AutoConfig, AutoModelForSequenceClassification
+
+    safetensors_path = os.path.join(model_path, SAFETENSORS_FILE_NAME)
+    if os.path.exists(safetensors_path):
+        from safetensors.torch import load_file
+
+        config = AutoConfig.from_pretrained(model_path, local_files_only=True)
+        # Buffers that are not saved keep their initial values, the
+        # initialized parameters are freed once replaced
+        model = AutoModelForSequenceClassification.from_config(config)
+        result = model.load_state_dict(load_file(safetensors_path), strict=False, assign=True)
+        if not result.missing_keys:
+            model.eval()
+            return model
+        print(f"{model_path} is missing {len(result.missing_keys)} weights, loading it without mmap")
+    return AutoModelForSequenceClassification.from_pretrained(
+        model_path, local_files_only=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fetch the base model into a data folder's model store")
+    parser.add_argument("--data_folder", required=True, help="Directory of data folder")
+    parser.add_argument("--model", default=BASE_MODEL, help="Hub name of the base model")
+    args = parser.parse_args()
+    print(fetch_base_model(os.path.join(args.data_folder, 'models'), args.model))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,73 @@
+import os
+import shutil
+import time
+from typing import Union
+from model_loading import BASE_MODEL_FOLDER_NAME, fetch_base_model
+
+
+class ModelRegistry:
+    """Versioned classifier model folders under data_folder/models.
+
+    Every training run writes a new version folder and the file
+    models/current names the version in use. The pointer is replaced
+    atomically, so a crash mid-training never leaves a half written model
+    in use. A classifier_model folder from before versioning is used until
+    the first versioned model exists. The base model is stored in
+    models/base.
+    """
+
+    def __init__(self, data_folder: str, keep_versions: int = 2):
+        self.models_folder = os.path.join(data_folder, 'models')
+        self.current_file_path = os.path.join(self.models_folder, 'current')
+        self.legacy_model_path = os.path.join(data_folder, 'classifier_model')
+        self.keep_versions = keep_versions
+
+    def get_current_version(self) -> Union[str, None]:
+        if not os.path.exists(self.current_file_path):
+            return None
+        with open(self.current_file_path, 'r', encoding='utf-8') as f:
+            version = f.read().strip()
+        return version or None
+
+    def get_current_path(self) -> str:
+        """Return the folder of the model in use, which may not exist yet."""
+        version = self.get_current_version()
+        if version is None:
+            return self.legacy_model_path
+        return os.path.join(self.models_folder, version)
+
+    def get_base_model_path(self) -> str:
+        """Return the stored base model folder, fetching it on first use."""
+        return fetch_base_model(self.models_folder)
+
+    def has_model(self) -> bool:
+        return os.path.exists(self.get_current_path())
+
+    def new_version_path(self) -> str:
+        """Return an unused folder for the next model version."""
+        os.makedirs(self.models_folder, exist_ok=True)
+        version = time.strftime('%Y%m%d-%H%M%S')
+        path = os.path.join(self.models_folder, version)
+        suffix = 1
+        while os.path.exists(path):
+            suffix += 1
+            path = os.path.join(self.models_folder, f'{version}-{suffix}')
+        return path
+
+    def set_current(self, version_path: str):
+        temp_file_path = self.current_file_path + '.tmp'
+        with open(temp_file_path, 'w', encoding='utf-8') as f:
+            f.write(os.path.basename(version_path))
+        os.replace(temp_file_path, self.current_file_path)
+
+    def prune(self):
+        """Remove all but the newest keep_versions versions, never the current one."""
+        current_version = self.get_current_version()
+        versions = sorted(
+            name for name in os.listdir(self.models_folder)
+            if os.path.isdir(os.path.join(self.models_folder, name))
+            and not name.startswith(BASE_MODEL_FOLDER_NAME))
+        for version in versions[:-self.keep_versions]:
+            if version != current_version:
+                shutil.rmtree(os.path.join(self.models_folder, version),
+                              ignore_errors=True)
@@ -0,0 +1,89 @@
+"""Compare the quantized ONNX classifier with the PyTorch pipeline.
+
+Runs both backends over the transaction names of a master CSV (or a test
+data CSV), reports how often their labels agree, the largest score
+difference and the throughput of each, and exits with status 1 when the
+agreement is below --min_agreement.
+
+    python onnx_benchmark.py --model_path data/models/<version> --csv data/master_transactions.csv
+"""
+import argparse
+import csv
+import json
+import sys
+import time
+from transformers import pipeline
+from onnx_classifier import OnnxTextClassifier, export_onnx_model
+
+
+def read_names(csv_file_path: str, limit: int) -> list[str]:
+    names: dict[str, None] = {}
+    with open(csv_file_path, 'r', newline='', encoding='utf-8-sig') as f:
+        for row in csv.DictReader(f):
+            if row.get('Name'):
+                names.setdefault(row['Name'], None)
+            if len(names) >= limit:
+                break
+    return list(names)
+
+
+def time_classifier(classifier, names: list[str], batch_size: int) -> tuple[list[dict], float]:
+    start = time.perf_counter()
+    results = classifier(names, batch_size=batch_size, truncation=True)
+    return results, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="ONNX classifier parity check and benchmark")
+    parser.add_argument("--model_path", required=True, help="Saved classifier model folder")
+    parser.add_argument("--csv", required=True, help="CSV with a Name column")
+    parser.add_argument("--limit", type=int, default=2000, help="Most unique names to classify")
+    parser.add_argument("--batch_size", type=int, default=32)
+    parser.add_argument("--min_agreement", type=float, default=0.98,
+                        help="Fraction of names that must get the same label from both backends")
+    args = parser.parse_args()
+
+    names = read_names(args.csv, args.limit)
+    if not names:
+        print("No names to classify")
+        return 1
+
+    export_start = time.perf_counter()
+    onnx_folder = export_onnx_model(args.model_path)
+    export_seconds = time.perf_counter() - export_start
+
+    pytorch_classifier = pipeline("text-classification", model=args.model_path)
+    onnx_classifier = OnnxTextClassifier(onnx_folder)
+    # One warm-up batch each so one-time initialization is not timed
+    pytorch_classifier(names[:args.batch_size], batch_size=args.batch_size, truncation=True)
+    onnx_classifier(names[:args.batch_size], batch_size=args.batch_size)
+
+    pytorch_results, pytorch_seconds = time_classifier(
+        pytorch_classifier, names, args.batch_size)
+    onnx_results, onnx_seconds = time_classifier(
+        onnx_classifier, names, args.batch_size)
+
+    agreement = sum(
+        1 for pytorch_result, onnx_result in zip(pytorch_results, onnx_results)
+        if pytorch_result['label'] == onnx_result['label']) / len(names)
+    max_score_difference = max(
+        abs(pytorch_result['score'] - onnx_result['score'])
+        for pytorch_result, onnx_result in zip(pytorch_results, onnx_results))
+    report = {
+        'names': len(names),
+        'export_seconds': export_seconds,
+        'label_agreement': agreement,
+        'max_score_difference': max_score_difference,
+        'pytorch_names_per_second': len(names) / pytorch_seconds,
+        'onnx_names_per_second': len(names) / onnx_seconds,
+        'speedup': pytorch_seconds / onnx_seconds,
+    }
+    print(json.dumps(report, indent=4))
+    if agreement < args.min_agreement:
+        print(f"Label agreement {agreement:.3f} is below {args.min_agreement}")
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,114 @@
+"""Quantized ONNX Runtime inference for the transaction classifier.
+
+A saved classifier model is exported to ONNX once, quantized to int8 with
+dynamic quantization and served through ONNX Runtime, which is several
+times faster than the PyTorch pipeline on CPU-only hosts. onnx and
+onnxruntime are optional dependencies, only needed for this backend.
+"""
+import json
+import os
+from typing import Union
+import numpy as np
+from transformers import AutoTokenizer
+
+
+ONNX_FOLDER_NAME = 'onnx'
+ONNX_MODEL_FILE_NAME = 'model.onnx'
+QUANTIZED_MODEL_FILE_NAME = 'model.int8.onnx'
+LABELS_FILE_NAME = 'labels.json'
+
+
+def get_onnx_folder(model_path: str) -> str:
+    """The export lives inside the model folder so it is replaced with the model."""
+    return os.path.join(model_path, ONNX_FOLDER_NAME)
+
+
+def export_onnx_model(model_path: str) -> str:
+    """Export and quantize a saved model unless already done, returns the ONNX folder."""
+    onnx_folder = get_onnx_folder(model_path)
+    quantized_model_path = os.path.join(onnx_folder, QUANTIZED_MODEL_FILE_NAME)
+    if os.path.exists(quantized_model_path):
+        return onnx_folder
+
+    import torch
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+    from transformers import AutoModelForSequenceClassification
+
+    print(f"Exporting {model_path} to ONNX")
+    os.makedirs(onnx_folder, exist_ok=True)
+    model = AutoModelForSequenceClassification.from_pretrained(
+        model_path, local_files_only=True)
+    model.eval()
+    tokenizer = AutoTokenizer.from_pretrained(model_path, local_files_only=True)
+    sample = tokenizer(["example transaction"], return_tensors='pt')
+    onnx_model_path = os.path.join(onnx_folder, ONNX_MODEL_FILE_NAME)
+    with torch.no_grad():
+        torch.onnx.export(
+            model, (sample['input_ids'], sample['attention_mask']),
+            onnx_model_path,
+            input_names=['input_ids', 'attention_mask'],
+            output_names=['logits'],
+            dynamic_axes={
+                'input_ids': {0: 'batch', 1: 'sequence'},
+                'attention_mask': {0: 'batch', 1: 'sequence'},
+                'logits': {0: 'batch'},
+            },
+            opset_version=14)
+    tokenizer.save_pretrained(onnx_folder)
+    with open(os.path.join(onnx_folder, LABELS_FILE_NAME), 'w', encoding='utf-8') as f:
+        json.dump({str(label_id): label
+                   for label_id, label in model.config.id2label.items()}, f)
+
+    # Written last under a temporary name, a finished export is one that has it
+    temp_model_path = quantized_model_path + '.tmp'
+    quantize_dynamic(onnx_model_path, temp_model_path,
+                     weight_type=QuantType.QInt8)
+    os.replace(temp_model_path, quantized_model_path)
+    os.remove(onnx_model_path)
+    return onnx_folder
+
+
+def softmax(logits: np.ndarray) -> np.ndarray:
+    shifted = logits - logits.max(axis=1, keepdims=True)
+    exponents = np.exp(shifted)
+    return exponents / exponents.sum(axis=1, keepdims=True)
+
+
+class OnnxTextClassifier:
+    """Drop-in for the text-classification pipeline: called with a list of
+    texts it returns a {'label', 'score'} dict per text, with the label
+    mapping of the exported model."""
+
+    def __init__(self, onnx_folder: str, intra_op_threads: Union[int, None] = None):
+        import onnxruntime
+
+        options = onnxruntime.SessionOptions()
+        if intra_op_threads is not None:
+            options.intra_op_num_threads = intra_op_threads
+        self.session = onnxruntime.InferenceSession(
+            os.path.join(onnx_folder, QUANTIZED_MODEL_FILE_NAME), options,
+            providers=['CPUExecutionProvider'])
+        self.tokenizer = AutoTokenizer.from_pretrained(onnx_folder, local_files_only=True)
+        with open(os.path.join(onnx_folder, LABELS_FILE_NAME), 'r', encoding='utf-8') as f:
+            self.id_to_label = {int(label_id): label
+                                for label_id, label in json.load(f).items()}
+
+    def predict_logits(self, texts: list[str], batch_size: int = 32) -> np.ndarray:
+        batches = []
+        for start in range(0, len(texts), batch_size):
+            encoded = self.tokenizer(texts[start:start + batch_size], padding=True,
+                                     truncation=True, return_tensors='np')
+            batches.append(self.session.run(['logits'], {
+                'input_ids': encoded['input_ids'].astype(np.int64),
+                'attention_mask': encoded['attention_mask'].astype(np.int64),
+            })[0])
+        if not batches:
+            return np.zeros((0, len(self.id_to_label)), dtype=np.float32)
+        return np.concatenate(batches)
+
+    def __call__(self, texts: list[str], batch_size: int = 32, truncation: bool = True):
+        probabilities = softmax(self.predict_logits(list(texts), batch_size))
+        label_ids = probabilities.argmax(axis=1)
+        return [{'label': self.id_to_label[int(label_id)],
+                 'score': float(probabilities[i, label_id])}
+                for i, label_id in enumerate(label_ids)]
@@ -0,0 +1,77 @@
+from collections import OrderedDict
+import json
+import os
+import threading
+from typing import Union
+
+
+Prediction = tuple[str, float]
+
+
+def normalize_name(name: str) -> str:
+    """Normalize a merchant name so trivial differences share a cache entry."""
+    return ' '.join(name.casefold().split())
+
+
+class PredictionCache:
+    """LRU cache of classifier predictions keyed by normalized merchant name.
+
+    Entries are persisted as JSON so they survive restarts. The cache has to
+    be cleared whenever the model or the sub-category labels change.
+    """
+
+    def __init__(self, cache_file_path: str, max_size: int = 10000):
+        self.cache_file_path = cache_file_path
+        self.max_size = max_size
+        self.entries: OrderedDict[str, Prediction] = OrderedDict()
+        self.lock = threading.Lock()
+
+    def load(self):
+        with self.lock:
+            self.entries = OrderedDict()
+            if not os.path.exists(self.cache_file_path):
+                return
+            with open(self.cache_file_path, 'r', encoding='utf-8') as f:
+                entries = json.load(f)
+            for name, (label, score) in entries:
+                self.entries[name] = (label, score)
+
+    def save(self):
+        with self.lock:
+            entries = [[name, list(prediction)]
+                       for name, prediction in self.entries.items()]
+        temp_file_path = self.cache_file_path + '.tmp'
+        with open(temp_file_path, 'w', encoding='utf-8') as f:
+            json.dump(entries, f)
+        os.replace(temp_file_path, self.cache_file_path)
+
+    def get(self, name: str) -> Union[Prediction, None]:
+        key = normalize_name(name)
+        with self.lock:
+            prediction = self.entries.get(key)
+            if prediction is not None:
+                self.entries.move_to_end(key)
+            return prediction
+
+    def put(self, name: str, label: str, score: float):
+        key = normalize_name(name)
+        with self.lock:
+            self.entries[key] = (label, score)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+        self.save()
+
+    def remove_labels(self, labels: set[str]):
+        """Drop every entry predicting one of the given sub-categories."""
+        with self.lock:
+            stale_names = [name for name, (label, _score) in self.entries.items()
+                           if label in labels]
+            for name in stale_names:
+                del self.entries[name]
+        if stale_names:
+            self.save()
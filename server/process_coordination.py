@@ -0,0 +1,282 @@
+"""Coordination between server processes sharing one data folder.
+
+FileLock is an advisory lock on a file, taken with fcntl.flock on POSIX
+and msvcrt.locking on Windows, which has no shared locks so every lock
+is exclusive there. TaskSpool hands work from any process to the one
+running background categorization through files in a folder, and
+TaskStatusStore hands the state of that work back the same way.
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Any, Callable, Union
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
+
+
+def get_files_stamp(file_paths: list[str]) -> str:
+    """Digest of the inode, modification time and size of the files, equal
+    in every process looking at the same unchanged files."""
+    stamps = []
+    for file_path in file_paths:
+        try:
+            stat = os.stat(file_path)
+            stamps.append((stat.st_ino, stat.st_mtime_ns, stat.st_size))
+        except FileNotFoundError:
+            stamps.append(None)
+    return hashlib.sha1(repr(stamps).encode('utf-8')).hexdigest()[:16]
+
+
+class FileLock:
+    """Lock shared by every process that opens the same file.
+
+    The lock belongs to the open file, so threads of one process must not
+    hold it at the same time, callers serialize them with a thread lock.
+    """
+
+    def __init__(self, file_path: str):
+        self.file_path = file_path
+        self.file = open(file_path, 'a+b')
+
+    def acquire(self, exclusive: bool = True, blocking: bool = True) -> bool:
+        """Returns False when not blocking and another process holds the lock."""
+        if fcntl is not None:
+            operation = fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH
+            if not blocking:
+                operation |= fcntl.LOCK_NB
+            try:
+                fcntl.flock(self.file.fileno(), operation)
+            except BlockingIOError:
+                return False
+            return True
+        self.file.seek(0)
+        while True:
+            try:
+                msvcrt.locking(self.file.fileno(), msvcrt.LK_NBLCK, 1)
+                return True
+            except OSError:
+                if not blocking:
+                    return False
+                time.sleep(0.01)
+
+    def release(self):
+        if fcntl is not None:
+            fcntl.flock(self.file.fileno(), fcntl.LOCK_UN)
+        else:
+            self.file.seek(0)
+            msvcrt.locking(self.file.fileno(), msvcrt.LK_UNLCK, 1)
+
+    @contextmanager
+    def locked(self, exclusive: bool = True):
+        self.acquire(exclusive)
+        try:
+            yield self
+        finally:
+            self.release()
+
+    def close(self):
+        self.file.close()
+
+
+class TaskSpool:
+    """Folder of pending work items, one JSON file each.
+
+    Items are written under a temporary name and renamed into place, so
+    the consumer never reads a partial item. Names start with the time of
+    submission, take returns items in submission order.
+    """
+
+    def __init__(self, folder: str):
+        self.folder = folder
+        os.makedirs(folder, exist_ok=True)
+
+    def put(self, kind: str, payload: Any) -> str:
+        """Spool an item, returns its id."""
+        spool_id = uuid.uuid4().hex
+        file_name = f"{time.time_ns():020d}-{spool_id}.json"
+        temp_file_path = os.path.join(self.folder, file_name + '.tmp')
+        with open(temp_file_path, 'w', encoding='utf-8') as f:
+            json.dump({'kind': kind, 'payload': payload}, f)
+        os.replace(temp_file_path, os.path.join(self.folder, file_name))
+        return spool_id
+
+    def take(self) -> list[tuple[str, str, Any]]:
+        """Remove and return the spooled (id, kind, payload) items."""
+        items = []
+        for file_name in sorted(os.listdir(self.folder)):
+            if not file_name.endswith('.json'):
+                continue
+            file_path = os.path.join(self.folder, file_name)
+            with open(file_path, 'r', encoding='utf-8') as f:
+                item = json.load(f)
+            os.remove(file_path)
+            spool_id = file_name[:-len('.json')].split('-', 1)[1]
+            items.append((spool_id, item['kind'], item['payload']))
+        return items
+
+
+def get_last_updated(descriptions: list[dict[str, Any]]) -> int:
+    return max((description['updated'] for description in descriptions), default=0)
+
+
+class TaskStatusStore:
+    """Folder of task descriptions, one JSON file per task id, written by
+    the process running the tasks and read by the others.
+
+    Descriptions carry the 'updated' change count of the writing process,
+    readers poll for a larger one. Only the newest max_tasks are kept.
+    """
+
+    def __init__(self, folder: str, max_tasks: int = 500):
+        self.folder = folder
+        self.max_tasks = max_tasks
+        os.makedirs(folder, exist_ok=True)
+
+    def _get_file_path(self, task_id: str) -> str:
+        # Ids come from URLs, never let them leave the folder
+        return os.path.join(self.folder, os.path.basename(task_id) + '.json')
+
+    def write(self, task_id: str, description: dict[str, Any]):
+        file_path = self._get_file_path(task_id)
+        temp_file_path = f"{file_path}.{os.getpid()}.tmp"
+        with open(temp_file_path, 'w', encoding='utf-8') as f:
+            json.dump(description, f)
+        os.replace(temp_file_path, file_path)
+
+    def read(self, task_id: str) -> Union[dict[str, Any], None]:
+        try:
+            with open(self._get_file_path(task_id), 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def read_all(self) -> list[dict[str, Any]]:
+        """Every stored description, oldest submission first."""
+        descriptions = []
+        for file_name in os.listdir(self.folder):
+            if file_name.endswith('.json'):
+                description = self.read(file_name[:-len('.json')])
+                if description is not None:
+                    descriptions.append(description)
+        return sorted(descriptions, key=lambda description: description['submitted_at'])
+
+    def wait_for_change(self, task_id: str, since: int, timeout: float,
+                        poll_interval: float = 0.25) -> Union[dict[str, Any], None]:
+        """Poll until the task's updated count passes since or the timeout
+        passes, returns its latest description."""
+        deadline = time.monotonic() + timeout
+        while True:
+            description = self.read(task_id)
+            remaining = deadline - time.monotonic()
+            if description is None or description['updated'] > since or remaining <= 0:
+                return description
+            time.sleep(min(poll_interval, remaining))
+
+    def wait_for_any_change(self, since: int, timeout: float,
+                            poll_interval: float = 0.25) -> list[dict[str, Any]]:
+        """Poll until a task's updated count passes since or the timeout
+        passes, returns every description. Files are only read again when
+        the folder changed."""
+        deadline = time.monotonic() + timeout
+        folder_stamp = None
+        descriptions: list[dict[str, Any]] = []
+        while True:
+            stamp = os.stat(self.folder).st_mtime_ns
+            if stamp != folder_stamp:
+                folder_stamp = stamp
+                descriptions = self.read_all()
+                if get_last_updated(descriptions) > since:
+                    return descriptions
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return descriptions
+            time.sleep(min(poll_interval, remaining))
+
+    def prune(self):
+        file_paths = [os.path.join(self.folder, file_name)
+                      for file_name in os.listdir(self.folder)
+                      if file_name.endswith('.json')]
+        if len(file_paths) <= self.max_tasks:
+            return
+        file_paths.sort(key=os.path.getmtime)
+        for file_path in file_paths[:-self.max_tasks]:
+            try:
+                os.remove(file_path)
+            except OSError:
+                pass
+
+
+class SpoolConsumer:
+    """Thread passing spooled items to handler(spool_id, kind, payload).
+
+    When the handler returns a task, describe(task) is published to the
+    status store under the spool id on every poll until the task finishes.
+    """
+
+    def __init__(self, spool: TaskSpool, handler, poll_interval: float = 0.5,
+                 status_store: Union[TaskStatusStore, None] = None,
+                 describe: Union[Callable[[Any], dict[str, Any]], None] = None,
+                 finished_states: tuple[str, ...] = ()):
+        self.spool = spool
+        self.handler = handler
+        self.poll_interval = poll_interval
+        self.status_store = status_store
+        self.describe = describe
+        self.finished_states = finished_states
+        # Spool id to (task, updated and queue position last published)
+        self.published: dict[str, tuple[Any, Any]] = {}
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+
+    def publish_status(self):
+        if self.status_store is None or self.describe is None:
+            return
+        finished = False
+        for spool_id, (task, last_published) in list(self.published.items()):
+            description = self.describe(task)
+            # wait_seconds and run_seconds change on their own, only state
+            # and progress changes and queue moves are worth a write
+            published = (description['updated'], description['queue_position'])
+            if published != last_published:
+                description['id'] = spool_id
+                self.status_store.write(spool_id, description)
+            if description['state'] in self.finished_states:
+                del self.published[spool_id]
+                finished = True
+            else:
+                self.published[spool_id] = (task, published)
+        if finished:
+            self.status_store.prune()
+
+    def run(self):
+        while not self.stop_event.is_set():
+            for spool_id, kind, payload in self.spool.take():
+                try:
+                    task = self.handler(spool_id, kind, payload)
+                    if task is not None:
+                        self.published[spool_id] = (task, None)
+                except Exception as e:
+                    print(f"Error handling spooled {kind} task {spool_id}: {e}")
+            try:
+                self.publish_status()
+            except Exception as e:
+                print(f"Error publishing spooled task status: {e}")
+            self.stop_event.wait(self.poll_interval)
+        self.publish_status()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread.is_alive():
+            self.thread.join()
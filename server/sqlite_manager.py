@@ -0,0 +1,341 @@
+import os
+import sqlite3
+from typing import Any, Union
+from master_csv_manager import MasterCSVManager
+from metrics import TimedLock
+from process_coordination import get_files_stamp
+from transaction_query import TransactionQuery, parse_amount, parse_date, encode_cursor
+from transaction_storage import (
+    FIELDNAMES, SubCategoryChanges, TransactionRows, TransactionStorage,
+    get_row_key)
+
+
+# Row field to table column
+COLUMNS = {
+    'Date': 'date',
+    'Transaction': 'transaction_type',
+    'Name': 'name',
+    'Memo': 'memo',
+    'Amount': 'amount',
+    'Category': 'category',
+    'Sub Category': 'sub_category',
+}
+
+# Sort field to the expression rows are ordered by, matching the cursor values.
+# casefold is registered on the connection, SQLite's lower only folds ASCII
+# and the CSV engine sorts and searches with str.casefold
+SORT_EXPRESSIONS = {
+    'Date': 'date_value',
+    'Amount': 'amount_value',
+    'Name': 'casefold(name)',
+    'Category': 'casefold(category)',
+    'Sub Category': 'casefold(sub_category)',
+}
+
+SELECT_COLUMNS = ', '.join(COLUMNS[field] for field in FIELDNAMES)
+
+IDENTITY_CONDITION = ('date = ? AND transaction_type = ? AND name = ? '
+                      'AND memo = ? AND amount = ?')
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS transactions (
+    id INTEGER PRIMARY KEY,
+    date TEXT NOT NULL,
+    transaction_type TEXT NOT NULL,
+    name TEXT NOT NULL,
+    memo TEXT NOT NULL,
+    amount TEXT NOT NULL,
+    category TEXT NOT NULL DEFAULT '',
+    sub_category TEXT NOT NULL DEFAULT '',
+    date_value INTEGER NOT NULL,
+    amount_value REAL NOT NULL
+);
+CREATE UNIQUE INDEX IF NOT EXISTS transactions_identity
+    ON transactions (date, transaction_type, name, memo, amount);
+CREATE INDEX IF NOT EXISTS transactions_date
+    ON transactions (date_value);
+CREATE INDEX IF NOT EXISTS transactions_category
+    ON transactions (category);
+CREATE INDEX IF NOT EXISTS transactions_sub_category
+    ON transactions (sub_category);
+'''
+
+
+def casefold(value: Union[str, None]) -> Union[str, None]:
+    return value.casefold() if value is not None else None
+
+
+def to_row(values: tuple) -> dict[str, Any]:
+    return dict(zip(FIELDNAMES, values))
+
+
+class SQLiteTransactionManager(TransactionStorage):
+    """Stores the master transactions in an SQLite database in WAL mode.
+
+    Deduplication relies on the unique index over the identity columns and
+    category updates and queries go through the date and category indexes.
+    An existing master CSV is migrated into the database the first time it
+    is opened. SQLite locks the database between processes itself, changes
+    committed by other processes are noticed through PRAGMA data_version.
+    """
+
+    def __init__(self, data_folder: str):
+        super().__init__()
+        self.data_folder = data_folder
+        self.database_file_path = os.path.join(
+            data_folder, 'master_transactions.db')
+        self.lock = TimedLock('sqlite_store')
+        self.version = 0
+        self.connection = sqlite3.connect(
+            self.database_file_path, check_same_thread=False)
+        self.connection.create_function('casefold', 1, casefold, deterministic=True)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.executescript(SCHEMA)
+        self.data_version = self._get_data_version()
+        self.migrate_from_csv()
+
+    def get_master_file_path(self):
+        return self.database_file_path
+
+    def migrate_from_csv(self):
+        """Import master_transactions.csv (and its journal) into an empty database."""
+        csv_manager = MasterCSVManager(self.data_folder)
+        if not os.path.exists(csv_manager.get_master_file_path()):
+            return
+        with self.lock:
+            row_count = self.connection.execute(
+                'SELECT COUNT(*) FROM transactions').fetchone()[0]
+        if row_count:
+            return
+        rows = csv_manager.read_master_csv_dict()
+        with self.lock, self.connection:
+            for row in rows:
+                self._insert_row(row)
+        print(f"Migrated {len(rows)} rows from "
+              f"{csv_manager.get_master_file_path()}")
+
+    def _insert_row(self, row: dict) -> bool:
+        """Insert a row unless it exists, must be called with the lock held."""
+        cursor = self.connection.execute(
+            'INSERT OR IGNORE INTO transactions '
+            '(date, transaction_type, name, memo, amount, category, '
+            'sub_category, date_value, amount_value) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            (*get_row_key(row), row.get('Category') or '',
+             row.get('Sub Category') or '', parse_date(row.get('Date') or ''),
+             parse_amount(row.get('Amount') or '')))
+        return cursor.rowcount == 1
+
+    def read_master_csv_dict(self) -> TransactionRows:
+        with self.lock:
+            cursor = self.connection.execute(
+                f'SELECT {SELECT_COLUMNS} FROM transactions ORDER BY id')
+            return [to_row(values) for values in cursor]
+
+    def read_master_csv_list(self):
+        with self.lock:
+            rows = [list(values) for values in self.connection.execute(
+                f'SELECT {SELECT_COLUMNS} FROM transactions ORDER BY id')]
+        if not rows:
+            return {'columns': [], 'rows': []}
+        return {'columns': list(FIELDNAMES), 'rows': rows}
+
+    def update_rows_with_categories(self, updated_rows: TransactionRows):
+        changed_rows: TransactionRows = []
+        changes: list[tuple[dict, dict]] = []
+        with self.lock, self.connection:
+            for row in updated_rows:
+                row_key = get_row_key(row)
+                existing = self.connection.execute(
+                    'SELECT id, category, sub_category FROM transactions '
+                    f'WHERE {IDENTITY_CONDITION}', row_key).fetchone()
+                if existing is None:
+                    continue
+                row_id, old_category, old_sub_category = existing
+                self.connection.execute(
+                    'UPDATE transactions SET category = ?, sub_category = ? '
+                    'WHERE id = ?',
+                    (row['Category'], row['Sub Category'], row_id))
+                changed_rows.append(to_row(
+                    (*row_key, row['Category'], row['Sub Category'])))
+                changes.append((to_row((*row_key, old_category, old_sub_category)),
+                                changed_rows[-1]))
+            if changed_rows:
+                self.version += 1
+                self._notify_rows_recategorized(changes)
+        return changed_rows
+
+    def change_sub_categories(self, changes: SubCategoryChanges) -> TransactionRows:
+        if not changes:
+            return []
+        placeholders = ', '.join('?' * len(changes))
+        # A single UPDATE with CASE applies swapped names simultaneously
+        category_cases = ' '.join(
+            'WHEN ? THEN ?' if category is not None else 'WHEN ? THEN category'
+            for category, _sub_category in changes.values())
+        sub_category_cases = ' '.join('WHEN ? THEN ?' for _change in changes)
+        parameters: list[Any] = []
+        for sub_category, (category, _new_sub_category) in changes.items():
+            parameters.append(sub_category)
+            if category is not None:
+                parameters.append(category)
+        for sub_category, (_category, new_sub_category) in changes.items():
+            parameters.extend([sub_category, new_sub_category])
+        parameters.extend(changes.keys())
+
+        changed_rows: TransactionRows = []
+        row_changes: list[tuple[dict, dict]] = []
+        with self.lock, self.connection:
+            old_rows = [to_row(values) for values in self.connection.execute(
+                f'SELECT {SELECT_COLUMNS} FROM transactions '
+                f'WHERE sub_category IN ({placeholders}) ORDER BY id',
+                list(changes.keys()))]
+            if not old_rows:
+                return []
+            self.connection.execute(
+                f'UPDATE transactions SET '
+                f'category = CASE sub_category {category_cases} END, '
+                f'sub_category = CASE sub_category {sub_category_cases} END '
+                f'WHERE sub_category IN ({placeholders})', parameters)
+            for old_row in old_rows:
+                category, sub_category = changes[old_row['Sub Category']]
+                new_row = old_row.copy()
+                if category is not None:
+                    new_row['Category'] = category
+                new_row['Sub Category'] = sub_category
+                changed_rows.append(new_row)
+                row_changes.append((old_row, new_row))
+            self.version += 1
+            self._notify_rows_recategorized(row_changes)
+        return changed_rows
+
+    def add_rows_to_master_csv(self, new_rows: TransactionRows, defer_write: bool = False):
+        added_rows = []
+        with self.lock, self.connection:
+            for row in new_rows:
+                stored_row = to_row(
+                    (*get_row_key(row), '', ''))
+                if self._insert_row(stored_row):
+                    added_rows.append(stored_row)
+            total_rows = self.connection.execute(
+                'SELECT COUNT(*) FROM transactions').fetchone()[0]
+            if added_rows:
+                self.version += 1
+                self._notify_rows_added(added_rows)
+        return {
+            'total_rows': total_rows,
+            'added_rows': added_rows,
+            'duplicate_rows': len(new_rows) - len(added_rows)
+        }
+
+    def _get_data_version(self) -> int:
+        return self.connection.execute('PRAGMA data_version').fetchone()[0]
+
+    def refresh(self):
+        with self.lock:
+            # Only changes committed by other connections move data_version
+            data_version = self._get_data_version()
+            if data_version == self.data_version:
+                return
+            self.data_version = data_version
+            self.version += 1
+            self._notify_rows_reloaded(self._read_columns())
+
+    def get_version(self) -> int:
+        self.refresh()
+        return self.version
+
+    def get_etag(self) -> str:
+        # Commits append to the write-ahead log, checkpoints rewrite the database
+        return get_files_stamp([self.database_file_path, self.database_file_path + '-wal'])
+
+    def read_columns(self):
+        with self.lock:
+            return self._read_columns()
+
+    def _read_columns(self):
+        values = self.connection.execute(
+            'SELECT date_value, amount_value, category, sub_category '
+            'FROM transactions ORDER BY id').fetchall()
+        dates, amounts, categories, sub_categories = (
+            [list(column) for column in zip(*values)] if values else ([], [], [], []))
+        return {
+            'dates': dates,
+            'amounts': amounts,
+            'categories': categories,
+            'sub_categories': sub_categories,
+        }
+
+    def query_transactions(self, query: TransactionQuery):
+        conditions: list[str] = []
+        parameters: list[Any] = []
+        if query.categories is not None:
+            conditions.append(
+                f"category IN ({', '.join('?' * len(query.categories))})")
+            parameters.extend(query.categories)
+        if query.sub_categories is not None:
+            conditions.append(
+                f"sub_category IN ({', '.join('?' * len(query.sub_categories))})")
+            parameters.extend(query.sub_categories)
+        if query.start_date is not None or query.end_date is not None:
+            # Rows with unparsable dates never match a date range
+            conditions.append('date_value >= ?')
+            parameters.append(query.start_date or 0)
+        if query.end_date is not None:
+            conditions.append('date_value <= ?')
+            parameters.append(query.end_date)
+        if query.min_amount is not None:
+            conditions.append('amount_value >= ?')
+            parameters.append(query.min_amount)
+        if query.max_amount is not None:
+            conditions.append('amount_value <= ?')
+            parameters.append(query.max_amount)
+        if query.text is not None:
+            conditions.append(
+                '(instr(casefold(name), ?) > 0 OR instr(casefold(memo), ?) > 0)')
+            parameters.extend([query.text, query.text])
+
+        # Without a sort field rows come in insertion order
+        sort_expression = SORT_EXPRESSIONS[query.sort_field] \
+            if query.sort_field is not None else 'id'
+        direction = 'DESC' if query.descending else 'ASC'
+
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+        page_conditions = list(conditions)
+        page_parameters = list(parameters)
+        if query.cursor is not None:
+            comparison = '<' if query.descending else '>'
+            page_conditions.append(
+                f'({sort_expression}, id) {comparison} (?, ?)')
+            page_parameters.extend(query.cursor)
+        page_where = f"WHERE {' AND '.join(page_conditions)}" \
+            if page_conditions else ''
+        limit = f'LIMIT {query.limit + 1}' if query.limit is not None else ''
+
+        with self.lock:
+            total = self.connection.execute(
+                f'SELECT COUNT(*) FROM transactions {where}',
+                parameters).fetchone()[0]
+            page = self.connection.execute(
+                f'SELECT {SELECT_COLUMNS}, {sort_expression}, id '
+                f'FROM transactions {page_where} '
+                f'ORDER BY {sort_expression} {direction}, id {direction} {limit}',
+                page_parameters).fetchall()
+
+        # One extra row is fetched to know whether another page exists
+        next_cursor = None
+        if query.limit is not None and len(page) > query.limit:
+            page = page[:query.limit]
+            next_cursor = encode_cursor(
+                query.sort_field, page[-1][-2], page[-1][-1])
+        return {
+            'columns': list(FIELDNAMES),
+            'rows': [list(values[:len(FIELDNAMES)]) for values in page],
+            'total': total,
+            'next_cursor': next_cursor
+        }
+
+    def stop(self):
+        with self.lock:
+            self.connection.close()
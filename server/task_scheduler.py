@@ -0,0 +1,371 @@
+from collections import deque
+import heapq
+import itertools
+import threading
+import time
+import traceback
+from typing import Any, Union
+import uuid
+
+
+# Lanes run on their own workers so a long training run never blocks
+# categorization and category edits
+INTERACTIVE_LANE = 'interactive'
+BACKGROUND_LANE = 'background'
+
+# Lower priorities run first, equal priorities run in submission order
+PRIORITY_INITIALIZE = 0
+PRIORITY_INTERACTIVE = 10
+PRIORITY_TRAIN = 50
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+SUPERSEDED = 'superseded'
+
+FINISHED_STATES = (DONE, FAILED, CANCELLED, SUPERSEDED)
+
+
+class ScheduledTask:
+    """A task submitted to the scheduler and its state."""
+
+    def __init__(self, task: Any, name: str, lane: str, priority: int, sequence: int,
+                 supersede_key: Union[str, None],
+                 ready_event: Union[threading.Event, None],
+                 coalesce_key: Union[str, None], task_id: Union[str, None] = None):
+        self.task_id = task_id or uuid.uuid4().hex
+        self.task = task
+        self.name = name
+        self.lane = lane
+        self.priority = priority
+        self.sequence = sequence
+        self.supersede_key = supersede_key
+        # The task is held until this event is set
+        self.ready_event = ready_event
+        self.coalesce_key = coalesce_key
+        self.state = QUEUED
+        # Tasks folded into this one, they finish when it does
+        self.merged_tasks: list['ScheduledTask'] = []
+        self.merged_into: Union['ScheduledTask', None] = None
+        self.progress: dict[str, Any] = {}
+        self.error: Union[str, None] = None
+        self.submitted_at = time.time()
+        self.started_at: Union[float, None] = None
+        self.finished_at: Union[float, None] = None
+        # Scheduler change count at the last state or progress change
+        self.updated = 0
+
+    def __lt__(self, other: 'ScheduledTask') -> bool:
+        return (self.priority, self.sequence) < (other.priority, other.sequence)
+
+
+def is_ready(scheduled_task: ScheduledTask) -> bool:
+    return scheduled_task.ready_event is None or scheduled_task.ready_event.is_set()
+
+
+class TaskLane:
+    def __init__(self, name: str):
+        self.name = name
+        self.heap: list[ScheduledTask] = []
+
+
+class TaskScheduler:
+    """Runs tasks by priority on per-lane worker threads.
+
+    Tasks are objects with a doWork() method. Queued tasks can be cancelled,
+    and submitting a task with the supersede_key of a queued task replaces
+    it. Tasks submitted with wait_for_ready only start once ready_event is
+    set, which lets the initialization task run first, or once the event
+    given as wait_for is set. Held tasks do not block the ready tasks
+    queued behind them.
+
+    Tasks submitted with a coalesce_key implement size() and merge(task).
+    When a worker starts one it merges the queued tasks with the same key
+    that follow it, waiting up to max_coalesce_wait seconds for more to
+    arrive, until the batch reaches max_coalesce_size.
+
+    Every task gets an id and stays listed until max_finished_tasks newer
+    tasks have finished. A task with a progress_reporter attribute gets a
+    function it can call with progress values while it runs. Every state
+    or progress change increments a change count that clients long-poll on.
+    """
+
+    def __init__(self, lane_workers: dict[str, int], ready_event: threading.Event,
+                 max_coalesce_size: int = 20000, max_coalesce_wait: float = 0.25,
+                 max_finished_tasks: int = 500):
+        self.ready_event = ready_event
+        self.max_coalesce_size = max_coalesce_size
+        self.max_coalesce_wait = max_coalesce_wait
+        self.condition = threading.Condition()
+        self.sequences = itertools.count()
+        self.lanes = {name: TaskLane(name) for name in lane_workers}
+        self.queued_by_key: dict[str, ScheduledTask] = {}
+        self.tasks: dict[str, ScheduledTask] = {}
+        self.finished_task_ids: deque[str] = deque()
+        self.max_finished_tasks = max_finished_tasks
+        self.change_count = 0
+        self.unfinished = 0
+        self.is_stopping = False
+        self.workers: list[threading.Thread] = []
+        for name, worker_count in lane_workers.items():
+            for i in range(worker_count):
+                worker = threading.Thread(
+                    target=self.worker, args=(self.lanes[name],),
+                    name=f'{name}-worker-{i}')
+                worker.daemon = True
+                worker.start()
+                self.workers.append(worker)
+
+    def submit(self, task: Any, name: str, lane: str, priority: int,
+               supersede_key: Union[str, None] = None,
+               wait_for_ready: bool = True,
+               coalesce_key: Union[str, None] = None,
+               wait_for: Union[threading.Event, None] = None,
+               task_id: Union[str, None] = None) -> ScheduledTask:
+        """Queue a task, task_id keeps an id handed out before submission."""
+        with self.condition:
+            if wait_for is None and wait_for_ready:
+                wait_for = self.ready_event
+            scheduled_task = ScheduledTask(
+                task, name, lane, priority, next(self.sequences), supersede_key,
+                wait_for, coalesce_key, task_id)
+            if hasattr(task, 'progress_reporter'):
+                task.progress_reporter = lambda **values: self.report_progress(
+                    scheduled_task, **values)
+            self.tasks[scheduled_task.task_id] = scheduled_task
+            self._touch(scheduled_task)
+            if supersede_key is not None:
+                queued_task = self.queued_by_key.get(supersede_key)
+                if queued_task is not None:
+                    self._cancel(queued_task, SUPERSEDED)
+                self.queued_by_key[supersede_key] = scheduled_task
+            heapq.heappush(self.lanes[lane].heap, scheduled_task)
+            self.unfinished += 1
+            self.condition.notify_all()
+            return scheduled_task
+
+    def cancel(self, scheduled_task: ScheduledTask) -> bool:
+        """Cancel a task that has not started, returns False otherwise."""
+        with self.condition:
+            if scheduled_task.state != QUEUED:
+                return False
+            self._cancel(scheduled_task, CANCELLED)
+            return True
+
+    def _cancel(self, scheduled_task: ScheduledTask, state: str):
+        # The task stays in its heap and is dropped when a worker pops it
+        if self.queued_by_key.get(scheduled_task.supersede_key) is scheduled_task:
+            del self.queued_by_key[scheduled_task.supersede_key]
+        self._finish(scheduled_task, state)
+        self.condition.notify_all()
+
+    def _touch(self, scheduled_task: ScheduledTask):
+        """Record a change of a task, must be called with the condition held."""
+        self.change_count += 1
+        scheduled_task.updated = self.change_count
+
+    def _start(self, scheduled_task: ScheduledTask):
+        scheduled_task.state = RUNNING
+        scheduled_task.started_at = time.time()
+        self._touch(scheduled_task)
+
+    def _finish(self, scheduled_task: ScheduledTask, state: str):
+        scheduled_task.state = state
+        scheduled_task.finished_at = time.time()
+        self._touch(scheduled_task)
+        self.unfinished -= 1
+        self.finished_task_ids.append(scheduled_task.task_id)
+        while len(self.finished_task_ids) > self.max_finished_tasks:
+            self.tasks.pop(self.finished_task_ids.popleft(), None)
+
+    def report_progress(self, scheduled_task: ScheduledTask, **values):
+        with self.condition:
+            scheduled_task.progress.update(values)
+            self._touch(scheduled_task)
+            self.condition.notify_all()
+
+    def get_task(self, task_id: str) -> Union[ScheduledTask, None]:
+        with self.condition:
+            return self.tasks.get(task_id)
+
+    def get_change_count(self) -> int:
+        with self.condition:
+            return self.change_count
+
+    def wait_for_change(self, since: int, timeout: float,
+                        scheduled_task: Union[ScheduledTask, None] = None) -> int:
+        """Block until the task, or any task, changed after the change count
+        since or the timeout passes. Returns the current change count."""
+        deadline = time.monotonic() + timeout
+        with self.condition:
+            while (scheduled_task.updated if scheduled_task is not None
+                   else self.change_count) <= since:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+            return self.change_count
+
+    def _queue_position(self, scheduled_task: ScheduledTask) -> Union[int, None]:
+        if scheduled_task.state != QUEUED:
+            return None
+        return sum(1 for queued_task in self.lanes[scheduled_task.lane].heap
+                   if queued_task.state == QUEUED and queued_task < scheduled_task)
+
+    def _describe(self, scheduled_task: ScheduledTask) -> dict[str, Any]:
+        started_at = scheduled_task.started_at
+        finished_at = scheduled_task.finished_at
+        # Merged tasks report the progress of the task that runs them
+        running_task = scheduled_task.merged_into or scheduled_task
+        return {
+            'id': scheduled_task.task_id,
+            'name': scheduled_task.name,
+            'lane': scheduled_task.lane,
+            'priority': scheduled_task.priority,
+            'state': scheduled_task.state,
+            'queue_position': self._queue_position(scheduled_task),
+            'merged_into': scheduled_task.merged_into.task_id
+            if scheduled_task.merged_into is not None else None,
+            'merged_tasks': [merged_task.task_id
+                             for merged_task in scheduled_task.merged_tasks],
+            'progress': dict(running_task.progress),
+            'error': scheduled_task.error,
+            'submitted_at': scheduled_task.submitted_at,
+            'started_at': started_at,
+            'finished_at': finished_at,
+            'wait_seconds': (started_at or finished_at or time.time()) - scheduled_task.submitted_at,
+            'run_seconds': (finished_at or time.time()) - started_at
+            if started_at is not None else None,
+            'updated': scheduled_task.updated,
+        }
+
+    def describe_task(self, scheduled_task: ScheduledTask) -> dict[str, Any]:
+        with self.condition:
+            return self._describe(scheduled_task)
+
+    def describe_tasks(self) -> dict[str, Any]:
+        """Return every listed task, oldest first, and the queue depth of every lane."""
+        with self.condition:
+            return {
+                'tasks': [self._describe(scheduled_task)
+                          for scheduled_task in self.tasks.values()],
+                'queue_depth': self.get_queue_depths(),
+                'running': sum(1 for scheduled_task in self.tasks.values()
+                               if scheduled_task.state == RUNNING),
+                'updated': self.change_count,
+            }
+
+    def get_queue_depth(self, lane: str) -> int:
+        with self.condition:
+            return sum(1 for scheduled_task in self.lanes[lane].heap
+                       if scheduled_task.state == QUEUED)
+
+    def get_queued_size(self, name: str) -> int:
+        """Total size of the queued tasks with this name, one per task
+        without a size method."""
+        with self.condition:
+            return sum(scheduled_task.task.size() if hasattr(scheduled_task.task, 'size') else 1
+                       for scheduled_task in self.tasks.values()
+                       if scheduled_task.name == name and scheduled_task.state == QUEUED)
+
+    def get_queue_depths(self) -> dict[str, int]:
+        with self.condition:
+            return {name: self.get_queue_depth(name) for name in self.lanes}
+
+    def _next_task(self, lane: TaskLane) -> Union[ScheduledTask, None]:
+        with self.condition:
+            while True:
+                while lane.heap and lane.heap[0].state != QUEUED:
+                    heapq.heappop(lane.heap)
+                if lane.heap:
+                    scheduled_task = self._first_ready(lane)
+                    if scheduled_task is not None:
+                        self._start(scheduled_task)
+                        if self.queued_by_key.get(scheduled_task.supersede_key) is scheduled_task:
+                            del self.queued_by_key[scheduled_task.supersede_key]
+                        return scheduled_task
+                elif self.is_stopping:
+                    return None
+                # Woken by submit, cancel, stop or notify_ready
+                self.condition.wait()
+
+    def _first_ready(self, lane: TaskLane) -> Union[ScheduledTask, None]:
+        """Remove and return the first queued task that is not held."""
+        if is_ready(lane.heap[0]):
+            return heapq.heappop(lane.heap)
+        for scheduled_task in sorted(scheduled_task for scheduled_task in lane.heap
+                                     if scheduled_task.state == QUEUED):
+            if is_ready(scheduled_task):
+                lane.heap.remove(scheduled_task)
+                heapq.heapify(lane.heap)
+                return scheduled_task
+        return None
+
+    def _coalesce(self, lane: TaskLane, scheduled_task: ScheduledTask):
+        """Merge queued tasks with the same coalesce key into scheduled_task."""
+        deadline = time.monotonic() + self.max_coalesce_wait
+        with self.condition:
+            while True:
+                # Only the run of tasks directly behind this one is merged so
+                # work never jumps ahead of a different kind of task
+                for queued_task in sorted(queued_task for queued_task in lane.heap
+                                          if queued_task.state == QUEUED):
+                    if queued_task.coalesce_key != scheduled_task.coalesce_key:
+                        return
+                    if scheduled_task.task.size() + queued_task.task.size() > self.max_coalesce_size:
+                        return
+                    scheduled_task.task.merge(queued_task.task)
+                    queued_task.merged_into = scheduled_task
+                    self._start(queued_task)
+                    scheduled_task.merged_tasks.append(queued_task)
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or self.is_stopping or \
+                        scheduled_task.task.size() >= self.max_coalesce_size:
+                    return
+                self.condition.wait(remaining)
+
+    def notify_ready(self, ready_event: Union[threading.Event, None] = None):
+        """Set the ready event, or the given one, and wake workers waiting on it."""
+        with self.condition:
+            (ready_event or self.ready_event).set()
+            self.condition.notify_all()
+
+    def worker(self, lane: TaskLane):
+        print(f'Worker {threading.current_thread().name}: Running')
+        while True:
+            scheduled_task = self._next_task(lane)
+            if scheduled_task is None:
+                break
+            if scheduled_task.coalesce_key is not None:
+                self._coalesce(lane, scheduled_task)
+            error = None
+            try:
+                scheduled_task.task.doWork()
+                state = DONE
+            except Exception as e:
+                # One failing task must not take the lane down with it
+                traceback.print_exc()
+                state = FAILED
+                error = str(e)
+            with self.condition:
+                for finished_task in [scheduled_task, *scheduled_task.merged_tasks]:
+                    finished_task.error = error
+                    self._finish(finished_task, state)
+                self.condition.notify_all()
+        print(f'Worker {threading.current_thread().name}: Done')
+
+    def join(self):
+        """Wait until every submitted task has finished or been cancelled."""
+        with self.condition:
+            while self.unfinished:
+                self.condition.wait()
+
+    def stop(self):
+        self.join()
+        with self.condition:
+            self.is_stopping = True
+            self.condition.notify_all()
+        for worker in self.workers:
+            worker.join()
@@ -0,0 +1,62 @@
+import json
+import os
+import random
+from typing import Iterable, Union
+from transaction_storage import TransactionRows
+
+
+# A (transaction name, sub-category) pair the classifier learns from
+TrainingPair = tuple[str, str]
+
+HISTORY_FILE_NAME = 'training_history.json'
+
+# Marks the progress lines classifier_training.py writes to stdout
+PROGRESS_PREFIX = 'PROGRESS '
+
+
+def get_training_pairs(rows: TransactionRows, labels: Iterable[str]) -> list[TrainingPair]:
+    """Return the distinct (Name, Sub Category) pairs of rows with a known
+    label, in first-seen order. Identical pairs carry no extra signal."""
+    known_labels = set(labels)
+    pairs: dict[TrainingPair, None] = {}
+    for row in rows:
+        if row['Sub Category'] in known_labels:
+            pairs.setdefault((row['Name'], row['Sub Category']), None)
+    return list(pairs)
+
+
+class TrainingHistory:
+    """The pairs a saved classifier model was trained on, persisted as JSON
+    inside the model folder so the next run can train only on what is new."""
+
+    def __init__(self):
+        self.pairs: set[TrainingPair] = set()
+
+    def load(self, model_path: str):
+        self.pairs = set()
+        history_file_path = os.path.join(model_path, HISTORY_FILE_NAME)
+        if not os.path.exists(history_file_path):
+            return
+        with open(history_file_path, 'r', encoding='utf-8') as f:
+            self.pairs = {(text, label) for text, label in json.load(f)}
+
+    def save(self, model_path: str, pairs: Iterable[TrainingPair]):
+        self.pairs = set(pairs)
+        history_file_path = os.path.join(model_path, HISTORY_FILE_NAME)
+        temp_file_path = history_file_path + '.tmp'
+        with open(temp_file_path, 'w', encoding='utf-8') as f:
+            json.dump(sorted(self.pairs), f)
+        os.replace(temp_file_path, history_file_path)
+
+    def select_incremental(self, pairs: list[TrainingPair], replay_ratio: float,
+                           min_replay: int, seed: Union[int, None] = 42
+                           ) -> tuple[list[TrainingPair], list[TrainingPair]]:
+        """Split pairs into those not trained on yet and a random replay
+        sample of the rest, replay_ratio times the new pairs but at least
+        min_replay, which keeps the model from forgetting older labels."""
+        new_pairs = [pair for pair in pairs if pair not in self.pairs]
+        old_pairs = [pair for pair in pairs if pair in self.pairs]
+        replay_size = min(len(old_pairs),
+                          max(int(len(new_pairs) * replay_ratio), min_replay))
+        replay_pairs = random.Random(seed).sample(old_pairs, replay_size)
+        return new_pairs, replay_pairs
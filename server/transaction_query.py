@@ -0,0 +1,156 @@
+import base64
+from datetime import datetime
+import json
+from typing import Any, Mapping, Union
+
+
+DATE_FORMATS = ['%m/%d/%Y', '%Y-%m-%d']
+
+# Sort field accepted in the query string to row column
+SORT_FIELDS = {
+    'date': 'Date',
+    'amount': 'Amount',
+    'name': 'Name',
+    'category': 'Category',
+    'sub_category': 'Sub Category',
+}
+
+# Sort fields compared as casefolded text, the others sort by number
+TEXT_SORT_FIELDS = ('Name', 'Category', 'Sub Category')
+
+MAX_PAGE_SIZE = 10000
+
+# Sorted before every real date so rows with unparsable dates still page
+MISSING_DATE = -1
+
+
+def parse_date(value: str) -> int:
+    """Return the proleptic ordinal of a transaction date, or MISSING_DATE."""
+    for date_format in DATE_FORMATS:
+        try:
+            return datetime.strptime(value.strip(), date_format).toordinal()
+        except ValueError:
+            continue
+    return MISSING_DATE
+
+
+def parse_amount(value: str) -> float:
+    try:
+        return float(value.replace(',', '').replace('$', ''))
+    except ValueError:
+        return 0.0
+
+
+def encode_cursor(sort_field: Union[str, None], sort_value: Any, position: int) -> str:
+    """Encode the sort key of the last row of a page as an opaque cursor."""
+    payload = json.dumps([sort_field, sort_value, position]).encode('utf-8')
+    return base64.urlsafe_b64encode(payload).decode('ascii')
+
+
+def decode_cursor(cursor: str, sort_field: Union[str, None]) -> tuple[Any, int]:
+    try:
+        cursor_field, sort_value, position = json.loads(
+            base64.urlsafe_b64decode(cursor.encode('ascii')))
+    except (ValueError, TypeError) as e:
+        raise ValueError(f"Invalid cursor: {cursor}") from e
+    # A cursor only makes sense for the sort order it was issued for
+    if cursor_field != sort_field:
+        raise ValueError("Cursor does not match the requested sort")
+    # Compared with the sort keys of the rows, a value of another type
+    # cannot be ordered against them
+    numeric = sort_field not in TEXT_SORT_FIELDS
+    if isinstance(sort_value, bool) or not isinstance(
+            sort_value, (int, float) if numeric else str) \
+            or isinstance(position, bool) or not isinstance(position, int):
+        raise ValueError(f"Invalid cursor: {cursor}")
+    return sort_value, position
+
+
+class TransactionQuery:
+    """Filters, sort order and page requested for GET /transactions."""
+
+    def __init__(self,
+                 start_date: Union[int, None] = None,
+                 end_date: Union[int, None] = None,
+                 categories: Union[list[str], None] = None,
+                 sub_categories: Union[list[str], None] = None,
+                 min_amount: Union[float, None] = None,
+                 max_amount: Union[float, None] = None,
+                 text: Union[str, None] = None,
+                 sort_field: Union[str, None] = None,
+                 descending: bool = False,
+                 limit: Union[int, None] = None,
+                 cursor: Union[str, None] = None):
+        self.start_date = start_date
+        self.end_date = end_date
+        self.categories = categories
+        self.sub_categories = sub_categories
+        self.min_amount = min_amount
+        self.max_amount = max_amount
+        self.text = text.casefold() if text else None
+        self.sort_field = sort_field
+        self.descending = descending
+        self.limit = limit
+        self.cursor = decode_cursor(cursor, sort_field) if cursor else None
+
+    @staticmethod
+    def from_args(args: Mapping[str, Any]) -> 'TransactionQuery':
+        """Build a query from request arguments, raising ValueError on bad input."""
+        def get_date(name: str) -> Union[int, None]:
+            value = args.get(name)
+            if not value:
+                return None
+            ordinal = parse_date(value)
+            if ordinal == MISSING_DATE:
+                raise ValueError(f"Invalid {name}: {value}")
+            return ordinal
+
+        def get_float(name: str) -> Union[float, None]:
+            value = args.get(name)
+            if value in (None, ''):
+                return None
+            try:
+                return float(value)
+            except ValueError as e:
+                raise ValueError(f"Invalid {name}: {value}") from e
+
+        def get_list(name: str) -> Union[list[str], None]:
+            if hasattr(args, 'getlist'):
+                values = args.getlist(name)
+            else:
+                values = [args[name]] if name in args else []
+            return values if values else None
+
+        sort = args.get('sort') or None
+        descending = False
+        sort_field = None
+        if sort:
+            descending = sort.startswith('-')
+            sort_name = sort.lstrip('-')
+            if sort_name not in SORT_FIELDS:
+                raise ValueError(f"Invalid sort: {sort}")
+            sort_field = SORT_FIELDS[sort_name]
+
+        limit = None
+        if args.get('limit'):
+            try:
+                limit = int(args['limit'])
+            except ValueError as e:
+                raise ValueError(f"Invalid limit: {args['limit']}") from e
+            if limit <= 0:
+                raise ValueError(f"Invalid limit: {limit}")
+            limit = min(limit, MAX_PAGE_SIZE)
+
+        return TransactionQuery(
+            start_date=get_date('start_date'),
+            end_date=get_date('end_date'),
+            categories=get_list('category'),
+            sub_categories=get_list('sub_category'),
+            min_amount=get_float('min_amount'),
+            max_amount=get_float('max_amount'),
+            text=args.get('q') or None,
+            sort_field=sort_field,
+            descending=descending,
+            limit=limit,
+            cursor=args.get('cursor') or None,
+        )
@@ -0,0 +1,110 @@
+from typing import Any, Union
+from transaction_query import TransactionQuery
+
+
+FIELDNAMES = [
+    'Date', 'Transaction', 'Name',
+    'Memo', 'Amount', 'Category', 'Sub Category'
+]
+
+# Columns that identify a transaction, categories are not part of the identity
+IDENTITY_FIELDS = ['Date', 'Transaction', 'Name', 'Memo', 'Amount']
+
+TransactionRows = list[dict[Union[str, Any], Union[str, Any]]]
+TransactionKey = tuple[str, ...]
+
+# Original sub-category to the new (category, sub-category), a category of
+# None keeps the row's current category
+SubCategoryChanges = dict[str, tuple[Union[str, None], str]]
+
+
+def get_row_key(row: dict) -> TransactionKey:
+    """Return the identity key of a transaction row."""
+    return tuple(row.get(field) or '' for field in IDENTITY_FIELDS)
+
+
+class TransactionStorage:
+    """Interface of the engines storing the master transactions.
+
+    Rows are dicts keyed by FIELDNAMES and identified by IDENTITY_FIELDS,
+    only the Category and Sub Category of a stored row can change.
+
+    Change listeners are told about every added row and every category
+    change, with the storage lock held so they see changes in order.
+    """
+
+    def __init__(self):
+        self.change_listeners: list = []
+
+    def add_change_listener(self, listener):
+        """Register an object with on_rows_added(rows),
+        on_rows_recategorized(changes) and on_rows_reloaded(columns)
+        methods, changes being a list of (old_row, new_row) pairs and
+        columns the read_columns of rows another process changed."""
+        self.change_listeners.append(listener)
+
+    def _notify_rows_added(self, rows: TransactionRows):
+        for listener in self.change_listeners:
+            listener.on_rows_added(rows)
+
+    def _notify_rows_recategorized(self, changes: list[tuple[dict, dict]]):
+        for listener in self.change_listeners:
+            listener.on_rows_recategorized(changes)
+
+    def _notify_rows_reloaded(self, columns: dict[str, list]):
+        for listener in self.change_listeners:
+            listener.on_rows_reloaded(columns)
+
+    def get_master_file_path(self) -> str:
+        raise NotImplementedError
+
+    def read_master_csv_dict(self) -> TransactionRows:
+        """Return copies of all rows in insertion order."""
+        raise NotImplementedError
+
+    def read_master_csv_list(self):
+        """Return {'columns': FIELDNAMES, 'rows': [[...]]} for all rows."""
+        raise NotImplementedError
+
+    def update_rows_with_categories(self, updated_rows: TransactionRows) -> TransactionRows:
+        """Set the categories of existing rows, returns the rows that changed."""
+        raise NotImplementedError
+
+    def change_sub_categories(self, changes: SubCategoryChanges) -> TransactionRows:
+        """Move every row of each original sub-category to its new category
+        and sub-category in one pass, returns the rows that changed."""
+        raise NotImplementedError
+
+    def add_rows_to_master_csv(self, new_rows: TransactionRows, defer_write: bool = False):
+        """Add rows not stored yet, returns total_rows, added_rows and duplicate_rows."""
+        raise NotImplementedError
+
+    def query_transactions(self, query: TransactionQuery):
+        """Return one page of rows matching the query."""
+        raise NotImplementedError
+
+    def read_columns(self):
+        """Return the parsed date ordinals, amounts, categories and
+        sub-categories of all rows as parallel lists."""
+        raise NotImplementedError
+
+    def get_version(self) -> int:
+        """Return a number that changes whenever the stored rows change."""
+        raise NotImplementedError
+
+    def get_etag(self) -> str:
+        """Return a string that changes whenever the stored rows change, the
+        same in every server process using the storage."""
+        raise NotImplementedError
+
+    def refresh(self):
+        """Pick up changes other server processes made to the stored rows."""
+
+    def flush(self):
+        """Persist writes deferred by add_rows_to_master_csv."""
+
+    def compact(self):
+        """Fold pending log entries into the main storage."""
+
+    def stop(self):
+        """Persist everything and release resources."""
@@ -0,0 +1,18 @@
+"""Entry point for multi-process WSGI servers, for example
+
+    CASH_FLOW_OPTIONS="--data_folder data --journal" gunicorn -w 4 -b 0.0.0.0:5000 wsgi:app
+
+The options are those of app.py, read from CASH_FLOW_OPTIONS. Every
+worker serves reads from its own copy of the ledger, the first one to
+start runs categorization and training for all of them.
+"""
+import atexit
+import os
+import shlex
+from app import build_parser, create_app, stop_app
+
+config = vars(build_parser().parse_args(
+    shlex.split(os.environ.get('CASH_FLOW_OPTIONS', ''))))
+config['multi_process'] = True
+app = create_app(config)
+atexit.register(stop_app, app)
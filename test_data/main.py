@@ -2,7 +2,7 @@ import csv
 import os
 import random
 import argparse
-from datetime import datetime, timedelta
+from datetime import date, datetime, timedelta
 
 PAYCHECK_AMOUNT = 3000.00
 APARTMENT_AMOUNT = -1500.00
@@ -16,6 +16,24 @@ EXPENSES = [
     ("Downtown Automotive", (30, 150)),
 ]
 
+# Pieces of the synthetic merchant names used for larger ledgers
+MERCHANT_PREFIXES = [
+    "SQ *", "TST* ", "PAYPAL *", "POS ", "ACH ", "", "", "", "", "",
+]
+MERCHANT_WORDS = [
+    "Blue", "Bottle", "Cedar", "Corner", "Coffee", "Market", "Fuel", "Pharmacy",
+    "Hardware", "Books", "Pizza", "Taqueria", "Sushi", "Bakery", "Cinema",
+    "Fitness", "Pet", "Garden", "Electric", "Water", "Wireless", "Insurance",
+    "Dental", "Clinic", "Airlines", "Hotel", "Parking", "Transit", "Grocery",
+    "Outlet", "Supply", "Deli", "Brewing", "Salon", "Laundry", "Auto", "Tire",
+    "Music", "Games", "Toys", "Kitchen", "Home", "Office", "Cloud", "Stream",
+    "Northwest", "Harbor", "Summit", "Pine", "River", "Golden", "Union",
+]
+MERCHANT_CITIES = [
+    "SEATTLE WA", "PORTLAND OR", "BELLEVUE WA", "TACOMA WA", "SPOKANE WA",
+    "BOISE ID", "ONLINE", "",
+]
+
 
 def generate_transactions(year, out_folder):
     rows = []
@@ -61,13 +79,116 @@ def generate_transactions(year, out_folder):
                 ])
     return rows
 
+
+def generate_merchants(count):
+    """Return count unique merchant names with an amount range each."""
+    merchants = {}
+    while len(merchants) < count:
+        words = " ".join(random.sample(MERCHANT_WORDS, random.randint(1, 3)))
+        name = f"{random.choice(MERCHANT_PREFIXES)}{words}"
+        if random.random() < 0.5:
+            name += f" #{random.randint(100, 9999)}"
+        city = random.choice(MERCHANT_CITIES)
+        if city:
+            name += f" {city}"
+        if name not in merchants:
+            low = round(random.uniform(2, 80), 2)
+            merchants[name] = (low, round(low * random.uniform(1.5, 10), 2))
+    return list(merchants.items())
+
+
+def generate_statement(account, year, row_count, merchants, cumulative_weights):
+    """Yield about row_count date-ordered rows for one account and year:
+    monthly paycheck and rent plus merchant purchases, popular merchants
+    far more often than the rest."""
+    days = (date(year, 12, 31) - date(year, 1, 1)).days + 1
+    purchases_per_day = max(row_count - 24, 0) / days
+    carry = 0.0
+    for offset in range(days):
+        day = date(year, 1, 1) + timedelta(days=offset)
+        date_text = day.strftime("%m/%d/%Y")
+        if day.day == 1:
+            yield [date_text, "credit", "Paycheck", f"ACCT {account}", PAYCHECK_AMOUNT]
+        if day.day == 3:
+            yield [date_text, "debit", "My Apartment", f"ACCT {account}", APARTMENT_AMOUNT]
+        carry += purchases_per_day
+        count = int(carry)
+        carry -= count
+        for name, (low, high) in random.choices(
+                merchants, cum_weights=cumulative_weights, k=count):
+            yield [date_text, "debit", name, f"ACCT {account}",
+                   -round(random.uniform(low, high), 2)]
+
+
+def write_statements(args):
+    """Write one CSV per account and year.
+
+    Each statement repeats the last overlap_rate of the account's previous
+    statement, like exports over overlapping date ranges, and
+    duplicate_rate of the rows appear twice in a row, like pending and
+    posted copies of the same purchase.
+    """
+    merchants = generate_merchants(args.merchants)
+    # Zipf-like popularity
+    cumulative_weights = []
+    total = 0.0
+    for rank in range(1, len(merchants) + 1):
+        total += 1.0 / rank
+        cumulative_weights.append(total)
+
+    statements = args.accounts * args.years
+    rows_per_statement = max(args.rows // statements, 1)
+    written = 0
+    for account in range(1, args.accounts + 1):
+        previous_tail = []
+        for year in range(args.year, args.year + args.years):
+            filename = os.path.join(args.out_folder, f"account{account}_{year}.csv")
+            tail_size = int(rows_per_statement * args.overlap_rate)
+            tail = []
+            with open(filename, "w", newline="") as f:
+                writer = csv.writer(f)
+                writer.writerow(["Date", "Transaction", "Name", "Memo", "Amount"])
+                writer.writerows(previous_tail)
+                written += len(previous_tail)
+                for row in generate_statement(account, year, rows_per_statement,
+                                              merchants, cumulative_weights):
+                    writer.writerow(row)
+                    written += 1
+                    if random.random() < args.duplicate_rate:
+                        writer.writerow(row)
+                        written += 1
+                    if tail_size:
+                        tail.append(row)
+                        if len(tail) > 2 * tail_size:
+                            del tail[:tail_size]
+            previous_tail = tail[-tail_size:] if tail_size else []
+            print(f"Data written to {filename}")
+    print(f"{written} rows in {statements} files")
+
+
 def main():
     parser = argparse.ArgumentParser()
-    parser.add_argument("year", type=int, help="Year for the data")
+    parser.add_argument("year", type=int, help="Year for the data, the first one with --years")
     parser.add_argument("out_folder", type=str, help="Output folder")
+    parser.add_argument("--rows", type=int, default=None,
+                        help="Generate about this many rows in total (1000 to 10000000) "
+                             "across accounts and years instead of the small sample")
+    parser.add_argument("--years", type=int, default=1, help="Number of years")
+    parser.add_argument("--accounts", type=int, default=1, help="Number of accounts")
+    parser.add_argument("--merchants", type=int, default=500,
+                        help="Size of the merchant vocabulary")
+    parser.add_argument("--duplicate_rate", type=float, default=0.01,
+                        help="Fraction of rows written twice")
+    parser.add_argument("--overlap_rate", type=float, default=0.05,
+                        help="Fraction of each statement repeated at the start of the next one")
+    parser.add_argument("--seed", type=int, default=None, help="Random seed for repeatable data")
     args = parser.parse_args()
 
+    random.seed(args.seed)
     os.makedirs(args.out_folder, exist_ok=True)
+    if args.rows is not None:
+        write_statements(args)
+        return
     filename = os.path.join(args.out_folder, f"{args.year}.csv")
     rows = generate_transactions(args.year, args.out_folder)
     with open(filename, "w", newline="") as f:
@@ -52,13 +52,26 @@ export function getOriginalAmount(row: Transaction): string {
 export const useTransactionsStore = defineStore('transactions', () => {
   const transactions = ref<Transaction[]>([])
 
+  function formatTransaction(row: Transaction): Transaction {
+    row.push(new Date(row[0])) // Date
+    row.push(Number(row[4])) // Amount
+    return row
+  }
+
+  function transactionKey(row: Transaction): string {
+    return JSON.stringify(row.slice(0, 5))
+  }
+
   function loadTransactions(data: Transaction[]) {
-    const formattedData: Transaction[] = data.map((row) => {
-      row.push(new Date(row[0])) // Date
-      row.push(Number(row[4])) // Amount
-      return row
-    })
-    transactions.value = formattedData
+    transactions.value = data.map(formatTransaction)
+  }
+
+  // Replace rows in place with the changed rows returned by the server
+  function updateTransactions(data: Transaction[]) {
+    const changedRows = new Map(data.map((row) => [transactionKey(row), formatTransaction(row)]))
+    transactions.value = transactions.value.map(
+      (row) => changedRows.get(transactionKey(row)) ?? row,
+    )
   }
 
   const hasData = computed(() => transactions.value.length !== 0)
@@ -77,5 +90,5 @@ export const useTransactionsStore = defineStore('transactions', () => {
       : undefined,
   )
 
-  return { transactions, loadTransactions, maxDate, minDate, hasData }
+  return { transactions, loadTransactions, updateTransactions, maxDate, minDate, hasData }
 })